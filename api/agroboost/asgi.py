@@ -0,0 +1,22 @@
+"""
+ASGI config for agroboost project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'agroboost.settings')
+
+# what get_asgi_application() does, with a handler that keeps streaming
+# responses off the event loop, see api/handlers.py
+django.setup(set_prefix=False)
+
+from api.handlers import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -123,3 +124,64 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "images"),
 ]
+
+# Analyzed tile cache, see api/vision/store.py. Least recently used tiles
+# are evicted once either budget is exceeded; None disables that limit.
+
+TILE_CACHE_DIR = os.path.join(BASE_DIR, "images")
+
+TILE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+TILE_CACHE_MAX_TILES = None
+
+# Overview mode: build a missing tile from its four cached z + 1 children,
+# see api/vision/overview.py, instead of downloading and analyzing it. The
+# result is the children's green share, not an analysis of the imagery at
+# that zoom, so it is off by default. Set it to True to opt in, e.g. after
+# `manage.py prefetch` has warmed the deepest zoom of an area.
+
+TILE_OVERVIEW_FROM_CHILDREN = False
+
+# Cache-Control sent with analyzed map tiles; revalidation uses their ETag
+
+TILE_CACHE_CONTROL = "public, max-age=604800"
+
+# flock files that let gunicorn workers share one download per tile
+
+TILE_LOCK_DIR = os.path.join(TILE_CACHE_DIR, "locks")
+
+# Satellite tile source, see api/vision/fetcher.py. Hosts are used
+# round-robin, each with its own pool of keep-alive connections.
+
+TILE_HOSTS = ["mt0.google.com", "mt1.google.com", "mt2.google.com", "mt3.google.com"]
+
+TILE_URL_TEMPLATE = "http://{host}/vt/lyrs=s&x={x}&y={y}&z={z}"
+
+TILE_FETCH_CONCURRENCY = 8
+
+TILE_FETCH_TIMEOUT = 10
+
+TILE_FETCH_RETRIES = 3
+
+# Work queue of the prefetch command, see api/vision/prefetch.py. An
+# interrupted warm-up resumes from here.
+
+PREFETCH_QUEUE = os.path.join(TILE_CACHE_DIR, "prefetch.sqlite3")
+
+# Worker processes for batch analysis (loadAllByXYZ), see api/vision/batch.py.
+# Every server worker (uvicorn --workers) starts its own pool, so the
+# processes add up: 3 uvicorn workers with BATCH_WORKERS = 4 run 12, each
+# with Django and cv2 loaded. None uses one per CPU this process may run on,
+# at most two, which stays inside a small container's memory limit.
+
+BATCH_WORKERS = None
+
+# Threads the async tile views hand decoding and analysis to, see
+# api/vision/async_analyzer.py. None uses one per CPU core.
+
+ANALYSIS_THREADS = None
+
+# Per-stage timings, cache and fetch counters served on /metrics, see
+# api/vision/metrics.py. Each worker process reports its own numbers.
+
+METRICS_ENABLED = True
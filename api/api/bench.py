@@ -0,0 +1,220 @@
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from django.test import Client
+
+from api.vision import analyzer, async_analyzer, batch
+from api.vision.coalesce import SingleFlight
+from api.vision.fetcher import AsyncTileFetcher, TileFetcher
+from api.vision.store import TileStore
+from api.vision.tileserver import StandInTileServer, synthetic_tile
+
+# Benchmarks for the tile pipeline: per-stage micro-benchmarks and end-to-end
+# endpoint throughput/latency, all against a local stand-in tile server.
+
+# a block of real tile coordinates over Tashkent at z15
+ORIGIN = (22692, 12100, 15)
+
+
+def tile_coords(count, offset=0):
+    x0, y0, z = ORIGIN
+    side = 64
+
+    return [(x0 + (offset + i) % side, y0 + (offset + i) // side, z) for i in range(count)]
+
+
+def load_recorded_tiles(directory):
+    """PNG/JPEG tiles from ``directory``, mapped onto the benchmark's tile coordinates."""
+    paths = sorted(p for ext in ('png', 'jpg', 'jpeg') for p in glob.glob(os.path.join(directory, '**', '*.' + ext),
+                                                                            recursive=True))
+
+    tiles = {}
+
+    for coords, path in zip(tile_coords(len(paths)), paths):
+        with open(path, 'rb') as f:
+            tiles[coords] = f.read()
+
+    return tiles
+
+
+def summarize(samples):
+    ms = np.array(samples) * 1000
+
+    return {
+        'n': len(samples),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p99_ms': float(np.percentile(ms, 99)),
+    }
+
+
+def time_calls(fn, args_list):
+    samples = []
+
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+@contextmanager
+def standin_environment(tiles=None, latency=0):
+    """Point the analyzer at a stand-in tile server and a throwaway tile cache."""
+    root = tempfile.mkdtemp(prefix='agroboost-bench-')
+    server = StandInTileServer(tiles, latency=latency).start()
+
+    replaced = [
+        (analyzer, 'tile_store', TileStore(os.path.join(root, 'images'))),
+        (analyzer, 'tile_flight', SingleFlight(os.path.join(root, 'locks'))),
+        (analyzer, 'tile_fetcher', TileFetcher([server.host], server.url_template)),
+        (async_analyzer, 'tile_fetcher', AsyncTileFetcher([server.host], server.url_template)),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, value in replaced]
+
+    for module, name, value in replaced:
+        setattr(module, name, value)
+
+    try:
+        yield server
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+        server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_stages(tiles, iterations):
+    images = [cv2.imdecode(np.frombuffer(tiles[c], np.uint8), cv2.IMREAD_COLOR) if c in tiles
+              else synthetic_tile(*c) for c in tile_coords(iterations)]
+
+    brightened = [analyzer.apply_brightness_contrast(image, 32, 0) for image in images]
+    masks = [analyzer.analyze_image(image)[0] for image in images]
+
+    results = {
+        'apply_brightness_contrast': time_calls(analyzer.apply_brightness_contrast, [(i, 32, 0) for i in images]),
+        'check_green': time_calls(analyzer.check_green, [(b.copy(),) for b in brightened]),
+        'green_gray': time_calls(analyzer.green_gray, [(i,) for i in images]),
+        'classifier_gray': time_calls(analyzer.classifier.gray, [(i,) for i in images]),
+        'treePer': time_calls(analyzer.treePer, [(m,) for m in masks]),
+        'analyze_image': time_calls(analyzer.analyze_image, [(i,) for i in images]),
+        'png_encode': time_calls(cv2.imencode, [('.png', m) for m in masks]),
+    }
+
+    with standin_environment(tiles) as server:
+        fetcher = analyzer.tile_fetcher
+        coords = tile_coords(iterations)
+
+        results['fetch_decode'] = time_calls(fetcher.fetch_tile, coords)
+        results['store_put'] = time_calls(analyzer.tile_store.put,
+                                          [(z, x, y, i, m, 0.0) for (x, y, z), i, m in zip(coords, images, masks)])
+        results['store_get_hit'] = time_calls(analyzer.tile_store.get, [(z, x, y) for x, y, z in coords])
+        results['analyze_miss'] = time_calls(analyzer.analyze, tile_coords(iterations, offset=iterations))
+        results['analyze_hit'] = time_calls(analyzer.analyze, tile_coords(iterations, offset=iterations))
+
+    return results
+
+
+def _run_load(requests, concurrency, send):
+    latencies = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run(body):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+
+        start = time.perf_counter()
+        resp = send(local.client, body)
+        elapsed = time.perf_counter() - start
+
+        if resp.status_code != 200:
+            raise RuntimeError('benchmark request failed with HTTP {}'.format(resp.status_code))
+
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run, requests))
+
+    wall = time.perf_counter() - start
+
+    return dict(summarize(latencies), concurrency=concurrency, throughput_rps=len(requests) / wall)
+
+
+def _post(path):
+    return lambda client, body: client.post(path, json.dumps(body), content_type='application/json')
+
+
+def bench_endpoints(tiles, requests, concurrencies, group_size, latency):
+    results = []
+
+    for concurrency in concurrencies:
+        for cached in (False, True):
+            with standin_environment(tiles, latency) as server:
+                bodies = [{'x': x, 'y': y, 'z': z, 'lat': 41.3, 'lng': 69.2} for x, y, z in tile_coords(requests)]
+
+                if cached:
+                    _run_load(bodies, concurrency, _post('/loadByXYZ'))
+
+                result = _run_load(bodies, concurrency, _post('/loadByXYZ'))
+                results.append(dict(result, endpoint='loadByXYZ', cached=cached, upstream_requests=server.requests))
+
+            with standin_environment(tiles, latency) as server, \
+                    ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as executor:
+                # fork every worker now, not from a request thread that may hold locks
+                executor.submit(int).result()
+
+                original = batch.get_executor
+                batch.get_executor = lambda: executor
+
+                try:
+                    coords = tile_coords(requests * group_size)
+                    bodies = [[[{'x': x, 'y': y, 'z': z, 'lat': 41.3, 'lng': 69.2}
+                                for x, y, z in coords[i * group_size:(i + 1) * group_size]]]
+                              for i in range(requests)]
+
+                    if cached:
+                        _run_load(bodies, concurrency, _post('/loadAllByXYZ'))
+
+                    result = _run_load(bodies, concurrency, _post('/loadAllByXYZ'))
+                finally:
+                    batch.get_executor = original
+
+                results.append(dict(result, endpoint='loadAllByXYZ', cached=cached, tiles_per_request=group_size,
+                                    upstream_requests=server.requests))
+
+    return results
+
+
+def run(iterations=50, requests=32, concurrencies=(1, 4, 16), group_size=16, latency=0.05, tiles_dir=None):
+    tiles = load_recorded_tiles(tiles_dir) if tiles_dir else {}
+
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpus': os.cpu_count(),
+            'tiles': 'recorded' if tiles else 'synthetic',
+            'upstream_latency_ms': latency * 1000,
+        },
+        'stages': bench_stages(tiles, iterations),
+        'endpoints': bench_endpoints(tiles, requests, concurrencies, group_size, latency),
+    }
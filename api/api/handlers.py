@@ -0,0 +1,44 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+_DONE = object()
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """Django's ASGI handler, except that streaming responses are read in a thread.
+
+    Django 3.2 iterates a StreamingHttpResponse with a plain for loop on
+    the event loop, so a generator that blocks (streamAllByXYZ waits on
+    tile analyses) would stall every other request in the worker until it
+    finished. Here each part is produced on a thread of its own.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        headers = [(header.encode('ascii') if isinstance(header, str) else header,
+                    value.encode('latin1') if isinstance(value, str) else value)
+                   for header, value in response.items()]
+
+        for c in response.cookies.values():
+            headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=False)
+
+        try:
+            while True:
+                part = await next_part(parts, _DONE)
+
+                if part is _DONE:
+                    break
+
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
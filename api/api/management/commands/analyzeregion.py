@@ -0,0 +1,30 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.vision import analyzer
+from api.vision.mosaic import analyze_region
+
+
+class Command(BaseCommand):
+    help = 'Analyze a bounding box as one stitched mosaic and write its mask and a per-tile JSON report.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+        parser.add_argument('--zoom', type=int, required=True)
+        parser.add_argument('--out', required=True, help='directory for mask.npy and report.json')
+        parser.add_argument('--chunk', type=int, default=8, help='tiles per side processed at a time')
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        report = analyze_region(analyzer.tile_store, analyzer.tile_fetcher, options['bbox'], options['zoom'],
+                                options['out'], chunk=options['chunk'])
+
+        with open(os.path.join(options['out'], 'report.json'), 'w') as f:
+            json.dump(report, f)
+
+        self.stdout.write(self.style.SUCCESS('{} tiles, {:.1f}% green, threshold {} in {:.1f}s'.format(
+            len(report['tiles']), report['percent'], report['threshold'], time.time() - start)))
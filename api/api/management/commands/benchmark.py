@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api import bench
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the tile analysis pipeline against a local stand-in tile server and print JSON results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='tiles per stage micro-benchmark')
+        parser.add_argument('--requests', type=int, default=32, help='requests per endpoint run')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+        parser.add_argument('--group-size', type=int, default=16, help='tiles per loadAllByXYZ request')
+        parser.add_argument('--upstream-latency', type=float, default=50, help='stand-in server latency in ms')
+        parser.add_argument('--tiles', help='directory of recorded satellite tiles to serve instead of synthetic ones')
+        parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        results = bench.run(iterations=options['iterations'], requests=options['requests'],
+                            concurrencies=options['concurrency'], group_size=options['group_size'],
+                            latency=options['upstream_latency'] / 1000, tiles_dir=options['tiles'])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
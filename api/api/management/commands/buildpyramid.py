@@ -0,0 +1,31 @@
+import time
+
+import mercantile
+from django.core.management.base import BaseCommand
+
+from api.vision import analyzer
+from api.vision.batch import analyze_many
+from api.vision.overview import build_pyramid
+
+
+class Command(BaseCommand):
+    help = 'Analyze every tile of a bounding box at --zoom and roll the results up into overview tiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+        parser.add_argument('--zoom', type=int, required=True, help='zoom level to analyze from imagery')
+        parser.add_argument('--min-zoom', type=int, required=True, help='lowest overview zoom to build')
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        tiles = [(t.x, t.y, t.z) for t in mercantile.tiles(*options['bbox'], [options['zoom']])]
+        analyze_many(tiles)
+
+        self.stdout.write('analyzed {} tiles at z{}'.format(len(tiles), options['zoom']))
+
+        # edge parents only partly inside the bbox get their other children analyzed too
+        built = sum(1 for _ in build_pyramid(analyzer.tile_store, tiles, options['min_zoom'], fill=analyzer.analyze))
+
+        self.stdout.write(self.style.SUCCESS('built {} overview tiles down to z{} in {:.1f}s'.format(
+            built, options['min_zoom'], time.time() - start)))
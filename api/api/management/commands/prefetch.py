@@ -0,0 +1,71 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agroboost.settings import PREFETCH_QUEUE, TILE_FETCH_CONCURRENCY
+from api.vision.prefetch import WorkQueue, area_tiles, warm
+
+
+def _load_polygon(path):
+    with open(path) as f:
+        shape = json.load(f)
+
+    # a bare [lng, lat] ring, or a GeoJSON Feature / Polygon (outer ring only)
+    if isinstance(shape, dict):
+        shape = shape.get('geometry', shape)['coordinates'][0]
+
+    return [tuple(point[:2]) for point in shape]
+
+
+class Command(BaseCommand):
+    help = 'Warm the tile cache for a region through a resumable work queue.'
+
+    def add_arguments(self, parser):
+        region = parser.add_mutually_exclusive_group()
+        region.add_argument('--bbox', nargs=4, type=float, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+        region.add_argument('--polygon', help='JSON file with a [lng, lat] ring or a GeoJSON polygon')
+
+        parser.add_argument('--zoom', type=int, help='deepest zoom to warm')
+        parser.add_argument('--min-zoom', type=int, help='shallowest zoom to warm (default: --zoom)')
+        parser.add_argument('--workers', type=int, default=TILE_FETCH_CONCURRENCY)
+        parser.add_argument('--rate', type=float, help='at most this many tiles per second miss the cache')
+        parser.add_argument('--queue', default=PREFETCH_QUEUE, help='work queue file')
+        parser.add_argument('--retry-failed', action='store_true', help='queue failed tiles again')
+        parser.add_argument('--reset', action='store_true', help='empty the queue first')
+        parser.add_argument('--interval', type=float, default=5, help='seconds between progress lines')
+
+    def handle(self, *args, **options):
+        queue = WorkQueue(options['queue'])
+
+        try:
+            if options['reset']:
+                queue.clear()
+
+            if options['bbox'] or options['polygon']:
+                if options['zoom'] is None:
+                    raise CommandError('--zoom is required with --bbox or --polygon')
+
+                zooms = range(options['min_zoom'] if options['min_zoom'] is not None else options['zoom'],
+                              options['zoom'] + 1)
+                polygon = _load_polygon(options['polygon']) if options['polygon'] else None
+
+                added = queue.add(area_tiles(zooms, bbox=options['bbox'], polygon=polygon))
+                self.stdout.write('queued {} new tiles'.format(added))
+
+            if options['retry_failed']:
+                self.stdout.write('requeued {} failed tiles'.format(queue.retry_failed()))
+
+            report = warm(queue, workers=options['workers'], rate=options['rate'], progress=self._progress,
+                          interval=options['interval'])
+        finally:
+            queue.close()
+
+        style = self.style.SUCCESS if not report['failed'] else self.style.WARNING
+        self.stdout.write(style('warmed {} tiles ({} analyzed, {} failed) in {:.1f}s'.format(
+            report['done'], report['analyzed'], report['failed'], report['elapsed'])))
+
+    def _progress(self, report):
+        eta = '{:.0f}s'.format(report['eta']) if report['eta'] is not None else '-'
+
+        self.stdout.write('{} done, {} analyzed, {} failed, {} left; {:.1f} tiles/s, eta {}'.format(
+            report['done'], report['analyzed'], report['failed'], report['remaining'], report['rate'], eta))
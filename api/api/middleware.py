@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from api.vision import metrics
+
+
+class MetricsMiddleware:
+    """Time every request into agroboost_request_seconds, labelled by view.
+
+    Works for sync and async views alike, so the async tile views are not
+    pushed onto a thread just to be measured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._acall(request)
+
+        if not metrics.enabled:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+
+        with metrics.in_flight('request'):
+            response = self.get_response(request)
+
+        self._record(request, response, start)
+
+        return response
+
+    async def _acall(self, request):
+        if not metrics.enabled:
+            return await self.get_response(request)
+
+        start = time.perf_counter()
+
+        with metrics.in_flight('request'):
+            response = await self.get_response(request)
+
+        self._record(request, response, start)
+
+        return response
+
+    def _record(self, request, response, start):
+        match = request.resolver_match
+        view = match.func.__name__ if match is not None else 'unmatched'
+
+        metrics.observe('agroboost_request_seconds', time.perf_counter() - start, view=view)
+        metrics.inc('agroboost_responses_total', view=view, status=response.status_code)
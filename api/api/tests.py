@@ -1,3 +1,1201 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import mercantile
+import numpy as np
+from django.core.management import call_command
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import SimpleTestCase
+
+from api import bench
+from api.handlers import StreamingASGIHandler
+from api.vision import analyzer, async_analyzer, batch, masks, metrics
+from api.vision.coalesce import SingleFlight
+from api.vision.fetcher import AsyncTileFetcher, FetchError, TileFetcher
+from api.vision.geo import child_tiles, getRatio, tile_lat
+from api.vision.overview import build_from_children, build_pyramid
+from api.vision.prefetch import RateLimiter, WorkQueue, area_tiles, warm
+from api.vision.mosaic import analyze_region, otsu_threshold, region_tiles
+from api.vision.stats import clip_polygon, green_area, polygon_area
+from api.vision.store import TileStore
+from api.vision.tileserver import StandInTileServer, synthetic_tile
+
+
+# Per-pixel reference implementations the vectorized engine must match.
+
+def loop_treePer(img):
+    shape = img.shape
+
+    white = 0
+
+    for x in range(shape[0]):
+        for y in range(shape[1]):
+            if img[x, y] == 255:
+                white += 1
+
+    return white * 100 / (shape[0] * shape[1])
+
+
+def loop_check_green(img):
+    shape = img.shape
+
+    for x in range(shape[0]):
+        for y in range(shape[1]):
+            # Python ints, as the pinned NumPy 1.x promoted uint8 scalars
+            r, g, b = (int(v) for v in img[x, y])
+
+            if g < r and g < b:
+                img[x, y] = [0, 0, 0]
+
+            if g + 10 < r or g + 10 < b:
+                img[x, y] = [0, 0, 0]
+
+    return img
+
+
+def random_tile(seed, shape=(256, 256, 3)):
+    return np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)
+
+
+class IsolatedAnalyzerMixin:
+    """Gives the analyzer a store, flight and fetchers of its own for each test.
+
+    The store and flock files live in a temporary ``self.root``. With
+    ``stand_in_server`` both fetchers download from a StandInTileServer
+    with ``server_latency``; ``fetcher_options`` go to TileFetcher.
+    """
+
+    stand_in_server = True
+    server_latency = 0
+    fetcher_options = {}
+
+    def setUp(self):
+        super().setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+        self.store = self.patch(analyzer, 'tile_store', TileStore(os.path.join(self.root, 'images')))
+        self.patch(analyzer, 'tile_flight', SingleFlight(os.path.join(self.root, 'locks')))
+
+        if self.stand_in_server:
+            self.server = StandInTileServer(latency=self.server_latency).start()
+            self.addCleanup(self.server.stop)
+
+            self.patch(analyzer, 'tile_fetcher',
+                       TileFetcher([self.server.host], self.server.url_template, **self.fetcher_options))
+            self.patch(async_analyzer, 'tile_fetcher', AsyncTileFetcher([self.server.host], self.server.url_template))
+
+    def patch(self, target, attribute, value):
+        patcher = mock.patch.object(target, attribute, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        return value
+
+
+class VectorizedAnalyzerTests(SimpleTestCase):
+
+    def test_check_green_matches_loop(self):
+        for seed in range(4):
+            img = random_tile(seed, (48, 64, 3))
+
+            expected = loop_check_green(img.copy())
+
+            np.testing.assert_array_equal(analyzer.check_green(img.copy()), expected)
+
+    def test_check_green_does_not_wrap(self):
+        # g + 10 stays above 255 for g >= 246, as it did in the loop
+        values = np.arange(230, 256, dtype=np.uint8)
+        img = np.stack(np.meshgrid(values, values, values), axis=-1).reshape(-1, 26, 3)
+
+        expected = loop_check_green(img.copy())
+
+        np.testing.assert_array_equal(analyzer.check_green(img.copy()), expected)
+
+    def test_check_green_is_in_place(self):
+        img = random_tile(1, (16, 16, 3))
+
+        self.assertIs(analyzer.check_green(img), img)
+
+    def test_treePer_matches_loop(self):
+        for seed in range(4):
+            img = np.where(random_tile(seed, (256, 256)) > 127, 255, 0).astype(np.uint8)
+
+            self.assertEqual(analyzer.treePer(img), loop_treePer(img))
+
+    def test_treePer_ignores_non_white(self):
+        img = np.full((8, 8), 254, dtype=np.uint8)
+        img[0, :4] = 255
+
+        self.assertEqual(analyzer.treePer(img), 4 * 100 / 64)
+
+    def test_analyze_image_matches_loop_pipeline(self):
+        for seed in range(2):
+            image = random_tile(seed)
+
+            buf = analyzer.apply_brightness_contrast(image, 32, 0)
+            mask = cv2.inRange(buf, np.array([0, 0, 0], dtype="uint8"), np.array([110, 130, 90], dtype="uint8"))
+            output = loop_check_green(cv2.bitwise_and(buf, buf, mask=mask))
+            gray = cv2.cvtColor(output, cv2.COLOR_BGR2GRAY)
+            (thresh, expected) = cv2.threshold(gray, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+            im_bw, perc = analyzer.analyze_image(image)
+
+            np.testing.assert_array_equal(im_bw, expected)
+            self.assertEqual(perc, loop_treePer(expected))
+
+
+class GreenClassifierTests(SimpleTestCase):
+
+    def test_lut_matches_addWeighted(self):
+        image = random_tile(3)
+
+        np.testing.assert_array_equal(cv2.LUT(image, analyzer.classifier.lut),
+                                      analyzer.apply_brightness_contrast(image, 32, 0))
+
+        for brightness, contrast in ((-40, 0), (0, 30), (20, -25)):
+            classifier = analyzer.GreenClassifier(*analyzer.boundaries[0], brightness=brightness, contrast=contrast)
+
+            np.testing.assert_array_equal(cv2.LUT(image, classifier.lut),
+                                          analyzer.apply_brightness_contrast(image, brightness, contrast))
+
+    def test_gray_matches_green_gray_for_every_colour(self):
+        values = np.arange(256, dtype=np.uint8)
+        image = np.stack(np.meshgrid(values, values, values, indexing='ij'), axis=-1).reshape(4096, 4096, 3)
+
+        np.testing.assert_array_equal(analyzer.classifier.gray(image), analyzer.green_gray(image))
+
+    def test_classify_matches_unfused_pipeline(self):
+        for image in [random_tile(seed) for seed in range(3)] + [synthetic_tile(x, 9, 15) for x in range(3)]:
+            gray = analyzer.green_gray(image)
+            (thresh, expected) = cv2.threshold(gray, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+            im_bw, perc = analyzer.classifier.classify(image)
+
+            np.testing.assert_array_equal(im_bw, expected)
+            self.assertEqual(perc, analyzer.treePer(expected))
+
+    def test_results_outlive_the_next_call(self):
+        first, perc = analyzer.classifier.classify(synthetic_tile(1, 1, 15))
+        kept = first.copy()
+
+        analyzer.classifier.classify(random_tile(0, (128, 64, 3)))
+        analyzer.classifier.classify(synthetic_tile(2, 1, 15))
+
+        np.testing.assert_array_equal(first, kept)
+
+    def test_threads_do_not_share_buffers(self):
+        images = [synthetic_tile(x, 9, 15) for x in range(16)]
+        expected = [analyzer.classifier.classify(image)[1] for image in images]
+
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(list(executor.map(lambda image: analyzer.classifier.classify(image)[1], images * 4)),
+                             expected * 4)
+
+
+class TileStoreTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    stand_in_server = False
+
+    def put(self, store, key, seed=0):
+        source = random_tile(seed)
+        im_bw, perc = analyzer.analyze_image(source)
+        store.put(*key, source, im_bw, perc)
+
+        return perc
+
+    def test_round_trip(self):
+        store = TileStore(self.root)
+        perc = self.put(store, (15, 100, 200))
+
+        self.assertEqual(store.get(15, 100, 200), perc)
+        self.assertEqual(store.get('15', '100', '200'), perc)
+        self.assertIsNone(store.get(15, 100, 201))
+        self.assertTrue(os.path.isfile(store.source_path(15, 100, 200)))
+        np.testing.assert_array_equal(store.mask(15, 100, 200), analyzer.analyze_image(random_tile(0))[0])
+
+        # the mask lives in the zoom's pack file only
+        self.assertFalse(os.path.exists(store.analyzed_path(15, 100, 200)))
+        self.assertEqual(os.path.getsize(store.pack_path(15)), 256 * 256 // 8)
+
+    def test_index_is_shared_between_instances(self):
+        perc = self.put(TileStore(self.root), (15, 1, 2))
+
+        self.assertEqual(TileStore(self.root).get(15, 1, 2), perc)
+
+    def test_evicts_least_recently_used_tiles(self):
+        store = TileStore(self.root, max_tiles=2)
+
+        with mock.patch('api.vision.store.time.time', side_effect=range(1000, 2000, 100)):
+            self.put(store, (15, 0, 0))
+            self.put(store, (15, 0, 1))
+            store.get(15, 0, 0)
+            self.put(store, (15, 0, 2))
+
+        self.assertEqual(len(store), 2)
+        self.assertIsNotNone(store.get(15, 0, 0))
+        self.assertIsNone(store.get(15, 0, 1))
+        self.assertIsNone(store.packed_mask(15, 0, 1))
+        self.assertFalse(os.path.exists(store.source_path(15, 0, 1)))
+
+    def test_evicts_by_size(self):
+        store = TileStore(self.root)
+        self.put(store, (15, 0, 0))
+        count, size = store.usage()
+
+        store.max_bytes = size * 2
+        for y in range(1, 4):
+            self.put(store, (15, 0, y), seed=0)
+
+        self.assertLessEqual(store.usage()[1], store.max_bytes)
+        self.assertEqual(len(store), 2)
+
+    def test_etag_follows_content(self):
+        store = TileStore(self.root)
+        self.put(store, (15, 0, 0), seed=1)
+        self.put(store, (15, 0, 1), seed=2)
+        etag = store.etag(15, 0, 0)
+
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(TileStore(self.root).etag(15, 0, 0), etag)
+        self.assertNotEqual(store.etag(15, 0, 1), etag)
+        self.assertIsNone(store.etag(15, 0, 2))
+
+    def test_adopts_legacy_perc_file(self):
+        store = TileStore(self.root)
+        directory = os.path.dirname(store.analyzed_path(15, 3, 4))
+        os.makedirs(directory)
+        os.makedirs(os.path.dirname(store.source_path(15, 3, 4)))
+        cv2.imwrite(store.analyzed_path(15, 3, 4), np.zeros((4, 4), dtype=np.uint8))
+        cv2.imwrite(store.source_path(15, 3, 4), np.zeros((4, 4, 3), dtype=np.uint8))
+        with open(os.path.join(directory, 'perc.txt'), 'w') as f:
+            f.write('12.5')
+
+        self.assertEqual(store.get(15, 3, 4), 12.5)
+        self.assertEqual(TileStore(self.root).get(15, 3, 4), 12.5)
+        self.assertIsNotNone(store.etag(15, 3, 4))
+
+    def test_analyze_skips_download_on_hit(self):
+        tile = random_tile(3)
+
+        with mock.patch.object(analyzer, 'url_to_image', return_value=tile) as fetch:
+            first = analyzer.analyze(7, 8, 15)
+            second = analyzer.analyze(7, 8, 15)
+
+        self.assertEqual(first, second)
+        self.assertEqual(fetch.call_count, 1)
+
+
+class PackedMaskTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+        self.store = TileStore(self.root)
+
+    def put(self, x, y, seed):
+        source = random_tile(seed)
+        im_bw, perc = analyzer.analyze_image(source)
+        self.store.put(15, x, y, source, im_bw, perc)
+
+        return im_bw
+
+    def test_pack_round_trip(self):
+        mask = np.where(random_tile(1, (256, 256)) > 100, 255, 0).astype(np.uint8)
+        packed = masks.pack(mask)
+
+        self.assertEqual(packed.nbytes, 8192)
+        np.testing.assert_array_equal(masks.unpack(packed), mask)
+        self.assertEqual(masks.count(packed), np.count_nonzero(mask))
+
+    def test_union_and_intersection(self):
+        a = np.where(random_tile(1, (256, 256)) > 127, 255, 0).astype(np.uint8)
+        b = np.where(random_tile(2, (256, 256)) > 127, 255, 0).astype(np.uint8)
+
+        np.testing.assert_array_equal(masks.unpack(masks.union([masks.pack(a), masks.pack(b)])), a | b)
+        np.testing.assert_array_equal(masks.unpack(masks.intersection([masks.pack(a), masks.pack(b)])), a & b)
+
+    def test_packed_masks_are_read_without_decoding(self):
+        expected = {(x, 5): self.put(x, 5, seed=x) for x in range(3)}
+
+        found = {(x, y): masks.unpack(packed) for x, y, packed in self.store.packed_masks(15, 0, 10, 0, 10)}
+
+        self.assertEqual(found.keys(), expected.keys())
+
+        for key, mask in expected.items():
+            np.testing.assert_array_equal(found[key], mask)
+
+        ((x, y, green, total, mpp, analyzed_at),) = self.store.stats(15, 1, 1, 5, 5)
+        self.assertEqual(green, np.count_nonzero(expected[(1, 5)]))
+
+    def test_evicted_slots_are_reused(self):
+        self.put(0, 0, seed=1)
+        self.put(0, 1, seed=2)
+        self.store.remove(15, 0, 0)
+
+        mask = self.put(0, 2, seed=3)
+
+        self.assertEqual(os.path.getsize(self.store.pack_path(15)), 2 * 8192)
+        np.testing.assert_array_equal(self.store.mask(15, 0, 2), mask)
+        self.assertIsNone(self.store.packed_mask(15, 0, 0))
+
+    def test_reads_are_copies(self):
+        mask = self.put(0, 0, seed=1)
+        packed = self.store.packed_mask(15, 0, 0)
+
+        # the slot goes to another tile; what was read earlier must not change with it
+        self.store.remove(15, 0, 0)
+        self.put(0, 1, seed=2)
+
+        np.testing.assert_array_equal(masks.unpack(packed), mask)
+
+    def test_slot_reused_during_a_read(self):
+        self.put(0, 0, seed=1)
+        pack = self.store._pack(15)
+        read = pack.read
+
+        def read_while_reused(slot):
+            data = read(slot)
+            # between the index lookup and the check, another worker evicts the tile and reuses its slot
+            self.store.remove(15, 0, 0)
+            self.put(0, 1, seed=2)
+            return data
+
+        with mock.patch.object(pack, 'read', side_effect=read_while_reused):
+            self.assertIsNone(self.store.packed_mask(15, 0, 0))
+
+    def test_rewrite_goes_to_a_fresh_slot(self):
+        self.put(0, 0, seed=1)
+        mask = self.put(0, 0, seed=2)
+
+        # the old slot was freed only once the new one was in place, and is reused next
+        self.put(0, 1, seed=3)
+
+        self.assertEqual(os.path.getsize(self.store.pack_path(15)), 2 * 8192)
+        np.testing.assert_array_equal(self.store.mask(15, 0, 0), mask)
+
+    def test_png_is_rendered_on_request(self):
+        mask = self.put(3, 4, seed=1)
+
+        data = self.store.analyzed_png(15, 3, 4)
+
+        np.testing.assert_array_equal(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE), mask)
+        self.assertIsNone(self.store.analyzed_png(15, 3, 5))
+
+    def test_legacy_png_masks_are_still_read(self):
+        mask = np.zeros((256, 256), dtype=np.uint8)
+        mask[:64] = 255
+        os.makedirs(os.path.dirname(self.store.analyzed_path(15, 3, 4)))
+        os.makedirs(os.path.dirname(self.store.source_path(15, 3, 4)))
+        cv2.imwrite(self.store.analyzed_path(15, 3, 4), mask)
+        cv2.imwrite(self.store.source_path(15, 3, 4), np.zeros((256, 256, 3), dtype=np.uint8))
+        with open(os.path.join(os.path.dirname(self.store.analyzed_path(15, 3, 4)), 'perc.txt'), 'w') as f:
+            f.write('25')
+
+        self.assertEqual(self.store.get(15, 3, 4), 25)
+        np.testing.assert_array_equal(self.store.mask(15, 3, 4), mask)
+
+        with open(self.store.analyzed_path(15, 3, 4), 'rb') as f:
+            self.assertEqual(self.store.analyzed_png(15, 3, 4), f.read())
+
+        # re-analyzing moves the tile into the pack
+        self.store.put(15, 3, 4, np.zeros((256, 256, 3), dtype=np.uint8), mask, 25)
+
+        self.assertFalse(os.path.exists(self.store.analyzed_path(15, 3, 4)))
+        np.testing.assert_array_equal(self.store.mask(15, 3, 4), mask)
+
+
+class TileFetcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StandInTileServer().start()
+        self.addCleanup(self.server.stop)
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        fetcher = TileFetcher([self.server.host], self.server.url_template, **kwargs)
+        self.addCleanup(fetcher.close)
+
+        return fetcher
+
+    def test_fetch_tile_decodes_image(self):
+        image = self.fetcher().fetch_tile(3, 4, 15)
+
+        np.testing.assert_array_equal(image, synthetic_tile(3, 4, 15))
+
+    def test_connections_are_kept_alive(self):
+        fetcher = self.fetcher()
+
+        for y in range(5):
+            fetcher.fetch_tile(1, y, 15)
+
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retries_server_errors(self):
+        self.server.failures = 2
+
+        image = self.fetcher(retries=2).fetch_tile(1, 2, 15)
+
+        self.assertEqual(image.shape, (256, 256, 3))
+        self.assertEqual(self.server.requests, 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = 5
+
+        with self.assertRaises(FetchError):
+            self.fetcher(retries=1).fetch_tile(1, 2, 15)
+
+        self.assertEqual(self.server.requests, 2)
+
+    def test_does_not_retry_client_errors(self):
+        fetcher = self.fetcher()
+
+        with self.assertRaises(FetchError):
+            fetcher.fetch('http://{}/vt/lyrs=s'.format(self.server.host))
+
+        self.assertEqual(self.server.requests, 1)
+
+    def test_fetch_many_runs_concurrently(self):
+        self.server.latency = 0.1
+        tiles = [(x, y, 15) for x in range(4) for y in range(4)]
+
+        start = time.perf_counter()
+        results = dict(self.fetcher(concurrency=8).fetch_many(tiles))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(set(results), set(tiles))
+        np.testing.assert_array_equal(results[(2, 3, 15)], synthetic_tile(2, 3, 15))
+        self.assertLess(elapsed, len(tiles) * self.server.latency / 2)
+        self.assertLessEqual(self.server.connections, 8)
+
+
+class BatchAnalysisTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    def expected(self, x, y, z):
+        return analyzer.analyze_image(synthetic_tile(x, y, z))[1]
+
+    def test_dedupes_tiles(self):
+        tiles = [(1, 2, 15), ('1', '2', '15'), (1, 3, 15), (1, 2, 15)]
+
+        with ThreadPoolExecutor(2) as executor, mock.patch.object(analyzer, 'analyze', return_value=5.0) as analyze:
+            percs = batch.analyze_many(tiles, executor)
+
+        self.assertEqual(percs, {(1, 2, 15): 5.0, (1, 3, 15): 5.0})
+        self.assertEqual(analyze.call_count, 2)
+
+    def test_cached_tiles_skip_the_pool(self):
+        analyzer.analyze(1, 2, 15)
+        executor = mock.Mock()
+
+        self.assertEqual(batch.analyze_many([(1, 2, 15)], executor), {(1, 2, 15): self.expected(1, 2, 15)})
+        executor.submit.assert_not_called()
+
+    def test_process_pool(self):
+        tiles = [(x, y, 15) for x in range(3) for y in range(3)]
+
+        # forked workers inherit the patched store and fetcher
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('fork')) as executor:
+            percs = batch.analyze_many(tiles, executor)
+
+        self.assertEqual(percs, {tile: self.expected(*tile) for tile in tiles})
+        self.assertEqual(self.server.requests, len(tiles))
+        self.assertEqual(analyzer.tile_store.get(15, 2, 2), self.expected(2, 2, 15))
+
+    def test_default_workers_follow_affinity(self):
+        with mock.patch.object(batch.os, 'sched_getaffinity', return_value={0}, create=True):
+            self.assertEqual(batch.default_workers(), 1)
+
+        with mock.patch.object(batch.os, 'sched_getaffinity', return_value=set(range(64)), create=True):
+            self.assertEqual(batch.default_workers(), batch.MAX_DEFAULT_WORKERS)
+
+    def test_loadAllByXYZ_aggregation(self):
+        groups = [
+            [{'x': 1, 'y': 2, 'z': 15, 'lat': 41.3, 'lng': 69.2}, {'x': 1, 'y': 3, 'z': 15, 'lat': 41.29, 'lng': 69.2}],
+            [{'x': 1, 'y': 3, 'z': 15, 'lat': 41.29, 'lng': 69.2}],
+        ]
+
+        with ThreadPoolExecutor(2) as executor, mock.patch.object(batch, 'get_executor', return_value=executor):
+            resp = self.client.post('/loadAllByXYZ', json.dumps(groups), content_type='application/json').json()
+
+        self.assertEqual(self.server.requests, 2)
+
+        for group, info in zip(groups, resp['percentage']):
+            percs = [self.expected(r['x'], r['y'], r['z']) for r in group]
+            ratios = [analyzer.getRatio(r['z'], r['lat'], r['lng']) for r in group]
+
+            self.assertEqual(info['totalArea'], sum(ratios))
+            self.assertEqual(info['totalTree'], sum(ratio * perc / 100 for ratio, perc in zip(ratios, percs)))
+            self.assertEqual(info['percent'], sum(percs) / len(percs))
+
+        self.assertEqual(resp['data'][1][0]['analyzed_img'], 'http://testserver/map/15/1/3')
+
+    def test_streamAllByXYZ_matches_loadAllByXYZ(self):
+        groups = [
+            [{'x': 1, 'y': 2, 'z': 15, 'lat': 41.3, 'lng': 69.2}, {'x': 1, 'y': 3, 'z': 15, 'lat': 41.29, 'lng': 69.2}],
+            [],
+            [{'x': 2, 'y': 3, 'z': 15, 'lat': 41.29, 'lng': 69.21}, {'x': 1, 'y': 3, 'z': 15, 'lat': 41.29, 'lng': 69.2}],
+        ]
+
+        with ThreadPoolExecutor(2) as executor, mock.patch.object(batch, 'get_executor', return_value=executor):
+            resp = self.client.post('/streamAllByXYZ', json.dumps(groups), content_type='application/json')
+            lines = [json.loads(line) for line in b''.join(resp.streaming_content).splitlines()]
+
+            expected = self.client.post('/loadAllByXYZ', json.dumps([groups[0], groups[2]]),
+                                        content_type='application/json').json()
+
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.server.requests, 3)
+
+        tiles = {(line['group'], line['index']): line for line in lines if line['type'] == 'tile'}
+        summaries = {line['group']: line for line in lines if line['type'] == 'group'}
+
+        self.assertEqual(sorted(tiles), [(0, 0), (0, 1), (2, 0), (2, 1)])
+        self.assertEqual(tiles[(2, 1)]['perc'], expected['data'][1][1]['perc'])
+        self.assertEqual(summaries[1], {'type': 'group', 'group': 1, 'totalArea': 0, 'totalTree': 0, 'percent': 0})
+
+        for g, info in ((0, expected['percentage'][0]), (2, expected['percentage'][1])):
+            self.assertEqual({k: summaries[g][k] for k in info}, info)
+
+        # a group's summary follows its last tile
+        for g in (0, 2):
+            last_tile = max(n for n, line in enumerate(lines) if line['type'] == 'tile' and line['group'] == g)
+            self.assertEqual(lines.index(summaries[g]), last_tile + 1)
+
+
+def _analyze_and_report(tile):
+    return analyzer.analyze(*tile), analyzer.tile_flight.stats()
+
+
+class CoalescingTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    server_latency = 0.2
+
+    def test_threads_share_one_analysis(self):
+        with ThreadPoolExecutor(8) as executor:
+            percs = list(executor.map(lambda _: analyzer.analyze(4, 5, 15), range(8)))
+
+        self.assertEqual(len(set(percs)), 1)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(analyzer.tile_flight.stats(), {'executed': 1, 'coalesced': 7, 'coalesced_across_workers': 0})
+
+    def test_workers_share_one_analysis(self):
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('fork')) as executor:
+            results = list(executor.map(_analyze_and_report, [(4, 5, 15)] * 2))
+
+        self.assertEqual(results[0][0], results[1][0])
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(sum(stats['coalesced_across_workers'] for perc, stats in results), 1)
+
+    def test_waiters_see_the_leaders_error(self):
+        flight = analyzer.tile_flight
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError('upstream down')
+
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(flight.do, 'key', fail)
+            started.wait()
+            follower = executor.submit(flight.do, 'key', fail)
+
+            while flight.coalesced == 0:
+                time.sleep(0.01)
+
+            release.set()
+
+            self.assertRaises(ValueError, leader.result)
+            self.assertRaises(ValueError, follower.result)
+
+        self.assertEqual(flight.executed, 1)
+
+
+class OverviewTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    stand_in_server = False
+
+    def setUp(self):
+        super().setUp()
+
+        # a Tashkent tile at z14
+        self.parent = (11346, 6050, 14)
+
+    def put(self, x, y, z):
+        source = synthetic_tile(x, y, z)
+        im_bw, perc = analyzer.analyze_image(source)
+        self.store.put(z, x, y, source, im_bw, perc)
+
+        return perc
+
+    def test_parent_is_area_weighted(self):
+        children = child_tiles(*self.parent)
+        percs = [self.put(*child) for child in children]
+        weights = [getRatio(z, tile_lat(x, y, z), 0) ** 2 for x, y, z in children]
+
+        perc = build_from_children(self.store, *self.parent)
+
+        self.assertAlmostEqual(perc, sum(p * w for p, w in zip(percs, weights)) / sum(weights))
+        self.assertEqual(self.store.get(14, 11346, 6050), perc)
+        self.assertEqual(self.store.mask(14, 11346, 6050).shape, (256, 256))
+        self.assertEqual(self.store.source(14, 11346, 6050).shape, (256, 256, 3))
+
+    def test_mask_is_halved_children(self):
+        for child in child_tiles(*self.parent):
+            self.put(*child)
+
+        build_from_children(self.store, *self.parent)
+
+        mask = self.store.mask(14, 11346, 6050)
+        top_left = self.store.mask(15, 22692, 12100)
+
+        self.assertTrue(set(np.unique(mask)) <= {0, 255})
+        self.assertAlmostEqual(analyzer.treePer(mask[:128, :128]), analyzer.treePer(top_left), delta=5)
+
+    def test_needs_every_child(self):
+        for child in child_tiles(*self.parent)[:3]:
+            self.put(*child)
+
+        self.assertIsNone(build_from_children(self.store, *self.parent))
+        self.assertIsNone(self.store.get(14, 11346, 6050))
+
+        fill = mock.Mock(side_effect=self.put)
+        self.assertIsNotNone(build_from_children(self.store, *self.parent, fill=fill))
+        fill.assert_called_once_with(22693, 12101, 15)
+
+    def test_analyze_prefers_children(self):
+        for child in child_tiles(*self.parent):
+            self.put(*child)
+
+        with mock.patch.object(analyzer, 'TILE_OVERVIEW_FROM_CHILDREN', True), \
+                mock.patch.object(analyzer, 'url_to_image') as fetch:
+            perc = analyzer.analyze(*self.parent)
+
+        fetch.assert_not_called()
+        self.assertEqual(perc, self.store.get(14, 11346, 6050))
+
+    def test_analyze_ignores_children_by_default(self):
+        for child in child_tiles(*self.parent):
+            self.put(*child)
+
+        with mock.patch.object(analyzer, 'url_to_image', return_value=synthetic_tile(*self.parent)) as fetch:
+            perc = analyzer.analyze(*self.parent)
+
+        fetch.assert_called_once()
+        self.assertEqual(perc, analyzer.analyze_image(synthetic_tile(*self.parent))[1])
+
+    def test_pyramid(self):
+        tiles = [(x, y, 15) for x in range(22692, 22696) for y in range(12100, 12104)]
+
+        for tile in tiles:
+            self.put(*tile)
+
+        built = dict(build_pyramid(self.store, tiles, 13))
+
+        self.assertEqual(sorted(built), [(5673, 3025, 13), (11346, 6050, 14), (11346, 6051, 14),
+                                         (11347, 6050, 14), (11347, 6051, 14)])
+        self.assertEqual(self.store.get(13, 5673, 3025), built[(5673, 3025, 13)])
+
+
+class AsyncTileFetcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StandInTileServer().start()
+        self.addCleanup(self.server.stop)
+
+    def run_fetches(self, urls, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        fetcher = AsyncTileFetcher([self.server.host], self.server.url_template, **kwargs)
+
+        async def main():
+            try:
+                return await asyncio.gather(*(fetcher.fetch(url) for url in urls), return_exceptions=True)
+            finally:
+                await fetcher.aclose()
+
+        return asyncio.run(main())
+
+    def tile_urls(self, count):
+        return [self.server.url_template.format(host=self.server.host, x=1, y=y, z=15) for y in range(count)]
+
+    def test_fetch_reuses_connections(self):
+        bodies = self.run_fetches(self.tile_urls(12), concurrency=3)
+
+        self.assertEqual(bodies[5], self.server.tile_bytes(1, 5, 15))
+        self.assertEqual(self.server.requests, 12)
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_requests_overlap(self):
+        self.server.latency = 0.1
+
+        start = time.perf_counter()
+        self.run_fetches(self.tile_urls(16), concurrency=16)
+
+        self.assertLess(time.perf_counter() - start, 16 * self.server.latency / 2)
+
+    def test_retries_and_gives_up(self):
+        self.server.failures = 1
+        self.assertIsInstance(self.run_fetches(self.tile_urls(1), retries=1)[0], bytes)
+
+        self.server.failures = 2
+        self.assertIsInstance(self.run_fetches(self.tile_urls(1), retries=1)[0], FetchError)
+
+    def test_stale_connection_is_retried_at_once(self):
+        self.server.drop_reused = True
+        fetcher = AsyncTileFetcher([self.server.host], self.server.url_template, concurrency=1, retries=0, backoff=10)
+
+        async def main():
+            try:
+                return [await fetcher.fetch(url) for url in self.tile_urls(3)]
+            finally:
+                await fetcher.aclose()
+
+        start = time.perf_counter()
+        bodies = asyncio.run(main())
+
+        self.assertEqual(bodies[2], self.server.tile_bytes(1, 2, 15))
+        self.assertEqual(self.server.connections, 3)
+        # neither a retry nor its backoff was spent on the closed connections
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+class StreamingASGIHandlerTests(SimpleTestCase):
+
+    def send_response(self, response):
+        sent = []
+        ticks = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def main():
+            task = asyncio.ensure_future(ticker())
+            await StreamingASGIHandler().send_response(response, send)
+            task.cancel()
+
+        asyncio.run(main())
+
+        return sent, ticks
+
+    def test_blocking_stream_leaves_the_loop_free(self):
+        def parts():
+            for part in (b'one\n', b'two\n'):
+                time.sleep(0.2)
+                yield part
+
+        sent, ticks = self.send_response(StreamingHttpResponse(parts(), content_type='application/x-ndjson'))
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'Content-Type', b'application/x-ndjson'), sent[0]['headers'])
+        self.assertEqual(b''.join(m.get('body', b'') for m in sent[1:]), b'one\ntwo\n')
+        self.assertFalse(sent[-1].get('more_body', False))
+        # the loop kept running while the generator slept
+        self.assertGreater(len(ticks), 20)
+
+    def test_plain_responses_are_unchanged(self):
+        sent, _ = self.send_response(HttpResponse(b'ok'))
+
+        self.assertEqual(sent[1], {'type': 'http.response.body', 'body': b'ok', 'more_body': False})
+
+
+class AsyncViewTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    server_latency = 0.1
+
+    def test_concurrent_requests_share_one_fetch(self):
+        async def main():
+            return await asyncio.gather(*(async_analyzer.analyze_async(7, 9, 15) for _ in range(20)))
+
+        percs = asyncio.run(main())
+
+        self.assertEqual(set(percs), {analyzer.analyze_image(synthetic_tile(7, 9, 15))[1]})
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(analyzer.tile_flight.coalesced, 19)
+
+    def test_many_tiles_in_flight(self):
+        async def main():
+            return await asyncio.gather(*(async_analyzer.analyze_async(x, 9, 15) for x in range(16)))
+
+        start = time.perf_counter()
+        asyncio.run(main())
+
+        self.assertEqual(self.server.requests, 16)
+        self.assertLess(time.perf_counter() - start, 16 * self.server.latency / 2)
+
+    def test_fetch_waits_for_another_workers_flight(self):
+        # another worker holds the tile's lock and stores the tile before letting go
+        image = synthetic_tile(7, 9, 15)
+        im_bw, perc = analyzer.analyze_image(image)
+        result = []
+
+        with analyzer.tile_flight.file_lock((15, 7, 9)):
+            thread = threading.Thread(target=lambda: result.append(asyncio.run(async_analyzer.analyze_async(7, 9, 15))))
+            thread.start()
+            time.sleep(0.2)
+            analyzer.tile_store.put(15, 7, 9, image, im_bw, perc)
+
+        thread.join()
+
+        self.assertEqual(result, [perc])
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual(analyzer.tile_flight.coalesced_across_workers, 1)
+
+    def test_store_lookups_stay_off_the_loop(self):
+        threads = []
+        cached = analyzer.cached
+
+        def spy(*args):
+            threads.append(threading.current_thread())
+            return cached(*args)
+
+        with mock.patch.object(analyzer, 'cached', spy):
+            asyncio.run(async_analyzer.analyze_async(7, 9, 15))
+            asyncio.run(async_analyzer.analyze_async(7, 9, 15))
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_loadByXYZ(self):
+        body = {'x': 7, 'y': 9, 'z': 15, 'lat': 41.3, 'lng': 69.2}
+        resp = self.client.post('/loadByXYZ', json.dumps(body), content_type='application/json').json()
+
+        self.assertEqual(resp['perc'], analyzer.analyze_image(synthetic_tile(7, 9, 15))[1])
+        self.assertEqual(resp['total_area'], getRatio(15, 41.3, 69.2))
+
+    def test_getLoadByXYZ(self):
+        resp = self.client.get('/getLoadByXYZ', {'x': 7, 'y': 9, 'z': 15, 'lat': 41.3, 'lng': 69.2}).json()
+
+        self.assertEqual(resp['source_img'], 'http://testserver/static/source/15/7/9/tile.png')
+
+    def test_loadMap_serves_the_analyzed_tile(self):
+        resp = self.client.get('/map/15/7/9')
+
+        np.testing.assert_array_equal(cv2.imdecode(np.frombuffer(resp.content, np.uint8), cv2.IMREAD_GRAYSCALE),
+                                      analyzer.analyze_image(synthetic_tile(7, 9, 15))[0])
+
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=604800')
+        self.assertEqual(resp['ETag'], analyzer.tile_store.etag(15, 7, 9))
+
+    def test_loadMap_revalidates_with_etag(self):
+        etag = self.client.get('/map/15/7/9')['ETag']
+
+        resp = self.client.get('/map/15/7/9', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b'')
+        self.assertEqual(resp['ETag'], etag)
+        self.assertEqual(self.server.requests, 1)
+
+        self.assertEqual(self.client.get('/map/15/7/9', HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+
+class StatsIndexTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    stand_in_server = False
+
+    def setUp(self):
+        super().setUp()
+
+        self.tile = mercantile.Tile(22692, 12100, 15)
+
+        # left half green
+        mask = np.zeros((256, 256), dtype=np.uint8)
+        mask[:, :128] = 255
+        self.store.put(15, self.tile.x, self.tile.y, synthetic_tile(*self.tile), mask, 50.0)
+
+        b = mercantile.bounds(self.tile)
+        self.mpp = getRatio(15, (b.north + b.south) / 2, 0)
+        self.bounds = b
+
+    def test_records_statistics(self):
+        ((x, y, green, total, mpp, analyzed_at),) = self.store.stats(15, 0, 1 << 15, 0, 1 << 15)
+
+        self.assertEqual((x, y, green, total), (self.tile.x, self.tile.y, 128 * 256, 256 * 256))
+        self.assertAlmostEqual(mpp, self.mpp)
+        self.assertAlmostEqual(analyzed_at, time.time(), delta=60)
+
+    def test_whole_tile(self):
+        b = self.bounds
+        area = green_area(self.store, 15, bbox=(b.west, b.south, b.east, b.north))
+
+        self.assertAlmostEqual(area['green_area'], 128 * 256 * self.mpp ** 2, delta=1)
+        self.assertAlmostEqual(area['percent'], 50)
+        self.assertEqual((area['tiles'], area['missing_tiles']), (1, 0))
+
+    def test_partial_tile_is_weighted(self):
+        b = self.bounds
+        area = green_area(self.store, 15, bbox=(b.west, b.south, b.east, (b.north + b.south) / 2))
+
+        self.assertAlmostEqual(area['green_area'], 128 * 256 * self.mpp ** 2 / 2, delta=self.mpp ** 2 * 256)
+
+    def test_polygon_and_missing_tiles(self):
+        b = self.bounds
+        # a triangle over half of the tile, plus a sliver of the unanalyzed tile to the east
+        east = b.east + (b.east - b.west) / 4
+        polygon = [(b.west, b.south), (east, b.south), (b.west, b.north)]
+
+        area = green_area(self.store, 15, polygon=polygon)
+
+        self.assertEqual((area['tiles'], area['missing_tiles']), (1, 1))
+        self.assertGreater(area['analyzed_area'], 256 * 256 * self.mpp ** 2 / 2)
+        self.assertLess(area['analyzed_area'], 256 * 256 * self.mpp ** 2)
+
+    def test_survives_eviction(self):
+        self.store.remove(15, self.tile.x, self.tile.y)
+
+        self.assertEqual(len(self.store.stats(15, self.tile.x, self.tile.x, self.tile.y, self.tile.y)), 1)
+
+    def test_clip_polygon(self):
+        square = [(0, 0), (4, 0), (4, 4), (0, 4)]
+
+        self.assertEqual(polygon_area(clip_polygon(square, 2, 2, 10, 10)), 4)
+        self.assertEqual(polygon_area(clip_polygon(square, 5, 5, 10, 10)), 0)
+
+    def test_greenArea_view(self):
+        b = self.bounds
+
+        resp = self.client.post('/greenArea', json.dumps({'z': 15, 'bbox': [b.west, b.south, b.east, b.north]}),
+                                content_type='application/json').json()
+
+        self.assertAlmostEqual(resp['percent'], 50)
+
+
+class MosaicTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+        self.server = StandInTileServer().start()
+        self.addCleanup(self.server.stop)
+
+        self.store = TileStore(os.path.join(self.root, 'cache'))
+        self.fetcher = TileFetcher([self.server.host], self.server.url_template)
+
+        # 3 x 2 tiles at z15
+        b0 = mercantile.bounds(22692, 12100, 15)
+        b1 = mercantile.bounds(22694, 12101, 15)
+        self.bbox = (b0.west, b1.south, b1.east, b0.north)
+
+    def test_otsu_matches_cv2(self):
+        for seed in range(6):
+            gray = analyzer.green_gray(synthetic_tile(seed, seed, 15))
+            expected, _ = cv2.threshold(gray, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+            self.assertEqual(otsu_threshold(np.bincount(gray.ravel(), minlength=256)), expected)
+
+    def test_region_tiles(self):
+        self.assertEqual(region_tiles(self.bbox, 15), (22692, 12100, 3, 2))
+
+    def test_single_threshold_over_chunks(self):
+        out = os.path.join(self.root, 'region')
+        report = analyze_region(self.store, self.fetcher, self.bbox, 15, out, chunk=2)
+
+        # one threshold for the stitched region
+        mosaic = np.vstack([np.hstack([synthetic_tile(x, y, 15) for x in range(22692, 22695)])
+                            for y in range(12100, 12102)])
+        im_bw, perc = analyzer.analyze_image(mosaic)
+        mask = np.load(report['mask'])
+
+        np.testing.assert_array_equal(mask, im_bw)
+        self.assertEqual(sorted(os.listdir(out)), ['mask.npy'])
+        self.assertAlmostEqual(report['percent'], perc)
+        self.assertEqual(len(report['tiles']), 6)
+
+        tile = report['tiles'][4]
+        self.assertEqual((tile['x'], tile['y']), (22693, 12101))
+        self.assertEqual(tile['perc'], analyzer.treePer(im_bw[256:, 256:512]))
+        self.assertEqual(tile['total_area'], getRatio(15, tile_lat(22693, 12101, 15), 0))
+        self.assertAlmostEqual(report['totalTree'], sum(t['area'] for t in report['tiles']))
+
+    def test_reuses_cached_sources(self):
+        source = synthetic_tile(22692, 12100, 15)
+        self.store.put(15, 22692, 12100, source, *analyzer.analyze_image(source))
+
+        analyze_region(self.store, self.fetcher, self.bbox, 15, os.path.join(self.root, 'region'))
+
+        self.assertEqual(self.server.requests, 5)
+
+
+class MetricsTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.patch(metrics, 'enabled', True)
+
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/map/15/7/9')
+        self.client.get('/map/15/7/9')
+
+        resp = self.client.get('/metrics')
+        lines = resp.content.decode().splitlines()
+
+        self.assertTrue(resp['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE agroboost_stage_seconds histogram', lines)
+        self.assertIn('agroboost_stage_seconds_count{stage="fetch"} 1', lines)
+        self.assertIn('agroboost_stage_seconds_count{stage="color_mask"} 1', lines)
+        self.assertIn('agroboost_tile_cache_total{result="hit"} 1', lines)
+        self.assertIn('agroboost_tile_cache_total{result="miss"} 1', lines)
+        self.assertIn('agroboost_fetched_bytes_total {}'.format(len(self.server.tile_bytes(7, 9, 15))), lines)
+        self.assertIn('agroboost_request_seconds_count{view="loadMap"} 2', lines)
+        self.assertIn('agroboost_in_flight{what="fetch"} 0', lines)
+        self.assertIn('agroboost_singleflight_total{result="executed"} 1', lines)
+        self.assertIn('agroboost_tile_cache_tiles 1', lines)
+
+    def test_histogram_buckets_are_cumulative(self):
+        metrics.observe('agroboost_stage_seconds', 0.003, stage='x')
+        metrics.observe('agroboost_stage_seconds', 20, stage='x')
+
+        lines = metrics.render().splitlines()
+
+        self.assertIn('agroboost_stage_seconds_bucket{stage="x",le="0.0025"} 0', lines)
+        self.assertIn('agroboost_stage_seconds_bucket{stage="x",le="0.005"} 1', lines)
+        self.assertIn('agroboost_stage_seconds_bucket{stage="x",le="10"} 1', lines)
+        self.assertIn('agroboost_stage_seconds_bucket{stage="x",le="+Inf"} 2', lines)
+        self.assertIn('agroboost_stage_seconds_sum{stage="x"} 20.003', lines)
+
+    def test_disabled_records_nothing(self):
+        with mock.patch.object(metrics, 'enabled', False):
+            analyzer.analyze_image(synthetic_tile(7, 9, 15))
+            self.client.get('/')
+
+        self.assertNotIn('agroboost_stage_seconds', metrics.render())
+        self.assertNotIn('agroboost_request_seconds', metrics.render())
+
+
+class PrefetchTests(IsolatedAnalyzerMixin, SimpleTestCase):
+
+    fetcher_options = {'backoff': 0}
+
+    def setUp(self):
+        super().setUp()
+
+        self.queue = WorkQueue(os.path.join(self.root, 'queue.sqlite3'))
+        self.addCleanup(self.queue.close)
+
+    def test_region_tiles(self):
+        bbox = mercantile.bounds(22692, 12100, 15)
+        inner = (bbox.west + 1e-6, bbox.south + 1e-6, bbox.east - 1e-6, bbox.north - 1e-6)
+
+        self.assertEqual(list(area_tiles([15], bbox=inner)), [(22692, 12100, 15)])
+        self.assertEqual(list(area_tiles([14, 15, 16], bbox=inner)),
+                         [(x, y, 16) for x, y, _ in sorted(child_tiles(22692, 12100, 15), key=lambda t: (t[0], t[1]))]
+                         + [(22692, 12100, 15), (11346, 6050, 14)])
+
+        # a triangle over the tile's lower-left half misses its upper-right child
+        west, south, east, north = inner
+        triangle = [(west, south), (east, south), (west, north)]
+
+        self.assertEqual(len(list(area_tiles([16], polygon=triangle))), 3)
+
+    def test_queue_is_resumable(self):
+        self.assertEqual(self.queue.add([(1, 2, 15), (1, 3, 15)]), 2)
+        self.queue.mark_done((1, 2, 15))
+
+        queue = WorkQueue(self.queue.path)
+        self.addCleanup(queue.close)
+
+        self.assertEqual(queue.add([(1, 2, 15), (1, 4, 15)]), 1)
+        self.assertEqual(queue.pending(10), [(1, 3, 15), (1, 4, 15)])
+        self.assertEqual(queue.counts(), {'pending': 2, 'done': 1, 'failed': 0})
+
+    def test_warm_analyzes_each_tile_once(self):
+        tiles = [(x, 9, 15) for x in range(6)]
+        self.queue.add(tiles)
+        reports = []
+
+        report = warm(self.queue, workers=3, progress=reports.append)
+
+        self.assertEqual((report['done'], report['analyzed'], report['remaining']), (6, 6, 0))
+        self.assertEqual(reports[-1], report)
+        self.assertEqual(self.server.requests, 6)
+
+        for x, y, z in tiles:
+            self.assertEqual(analyzer.tile_store.get(z, x, y), analyzer.analyze_image(synthetic_tile(x, y, z))[1])
+
+        self.assertEqual(warm(self.queue)['done'], 0)
+
+    def test_failures_stay_in_the_queue(self):
+        self.server.failures = 100
+        self.queue.add([(1, 2, 15)])
+
+        self.assertEqual(warm(self.queue)['failed'], 1)
+        self.assertEqual(self.queue.counts()['failed'], 1)
+
+        self.server.failures = 0
+        self.queue.retry_failed()
+
+        self.assertEqual(warm(self.queue)['done'], 1)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _: limiter.wait(), range(6)))
+
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50)
+
+    def test_command(self):
+        bbox = mercantile.bounds(22692, 12100, 15)
+        args = ['--bbox', str(bbox.west + 1e-6), str(bbox.south + 1e-6), str(bbox.east - 1e-6), str(bbox.north - 1e-6),
+                '--zoom', '16', '--min-zoom', '15', '--queue', self.queue.path, '--workers', '2']
+        out = io.StringIO()
+
+        with mock.patch.object(analyzer, 'TILE_OVERVIEW_FROM_CHILDREN', True):
+            call_command('prefetch', *args, stdout=out)
+
+        self.assertIn('queued 5 new tiles', out.getvalue())
+        self.assertIn('warmed 5 tiles (5 analyzed, 0 failed)', out.getvalue())
+
+        # the z15 parent was built from its children, not downloaded
+        self.assertEqual(self.server.requests, 4)
+
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_reports_every_stage_and_endpoint(self):
+        results = bench.run(iterations=2, requests=2, concurrencies=(2,), group_size=2, latency=0)
+
+        json.dumps(results)
+        self.assertIn('analyze_image', results['stages'])
+        self.assertEqual(results['stages']['fetch_decode']['n'], 2)
+        self.assertEqual({(e['endpoint'], e['cached']) for e in results['endpoints']},
+                         {('loadByXYZ', False), ('loadByXYZ', True), ('loadAllByXYZ', False), ('loadAllByXYZ', True)})
+
+        for endpoint in results['endpoints']:
+            self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+            self.assertEqual(endpoint['upstream_requests'], 2 * endpoint.get('tiles_per_request', 1))
+
+    def test_recorded_tiles(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        cv2.imwrite(os.path.join(directory, 'a.png'), synthetic_tile(1, 1, 1))
+
+        tiles = bench.load_recorded_tiles(directory)
+
+        self.assertEqual(list(tiles), [bench.ORIGIN])
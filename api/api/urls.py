@@ -8,4 +8,7 @@ urlpatterns = [
     path('getLoadByXYZ', views.getLoadByXYZ, name='index'),
     path('loadByXYZ', views.loadByXYZ, name='index'),
     path('loadAllByXYZ', views.loadAllByXYZ, name='index'),
+    path('streamAllByXYZ', views.streamAllByXYZ, name='index'),
+    path('greenArea', views.greenArea, name='index'),
+    path('metrics', views.metricsView, name='index'),
 ]
@@ -1,74 +1,177 @@
+import asyncio
 import json
 
-import mercantile as mercantile
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import render, redirect
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 
 # Create your views here.
 from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 
+from agroboost.settings import TILE_CACHE_CONTROL
+from api.vision import analyzer, metrics
 from api.vision.analyzer import getImageByXYZ
+from api.vision.async_analyzer import analyze_async, cpu_executor
+from api.vision.batch import analyze_many, iter_analyze, tile_key
+from api.vision.stats import green_area
 
 
 def index(request):
     return HttpResponse("Greenuzbekistan.uz api")
 
 
-def loadMap(request, z, x, y):
-    ll = mercantile.ul(x, y, z)
+async def loadMap(request, z, x, y):
+    await analyze_async(x, y, z)
 
-    resp = getImageByXYZ(x, y, z, request, ll.lat, ll.lng)
+    # the store (SQLite, pack files) and PNG encoding stay off the event loop
+    loop = asyncio.get_running_loop()
+    etag = await loop.run_in_executor(cpu_executor, analyzer.tile_store.etag, z, x, y)
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
 
-    return redirect(resp['analyzed_img'])
+    # served straight from here, so panning costs one request per tile and revisits none
+    if etag is None:
+        raise Http404('tile was evicted')
+    elif etag in etags or '*' in etags:
+        resp = HttpResponseNotModified()
+    else:
+        # masks are stored bit-packed; the PNG only exists for this response
+        data = await loop.run_in_executor(cpu_executor, analyzer.tile_store.analyzed_png, z, x, y)
 
+        if data is None:
+            raise Http404('tile was evicted')
 
-def getLoadByXYZ(request):
-    x, y, z, lat, lng = (request.GET['x'], request.GET['y'], request.GET['z'], request.GET['lat'], request.GET['lng'])
+        resp = HttpResponse(data, content_type='image/png')
 
-    resp = getImageByXYZ(x, y, z, request, lat, lng)
+    resp['ETag'] = etag
+    resp['Cache-Control'] = TILE_CACHE_CONTROL
 
     return resp
 
 
-@method_decorator(csrf_exempt)
-def loadByXYZ(request):
+async def getLoadByXYZ(request):
+    x, y, z, lat, lng = (request.GET['x'], request.GET['y'], request.GET['z'], request.GET['lat'], request.GET['lng'])
+
+    perc = await analyze_async(x, y, z)
+    resp = getImageByXYZ(x, y, z, request, lat, lng, perc)
+
+    return JsonResponse(resp)
+
+
+async def loadByXYZ(request):
     data = json.loads(request.body)
     x, y, z, lat, lng = (data['x'], data['y'], data['z'], data['lat'], data['lng'])
 
-    resp = getImageByXYZ(x, y, z, request, lat, lng)
+    perc = await analyze_async(x, y, z)
+    resp = getImageByXYZ(x, y, z, request, lat, lng, perc)
 
     return JsonResponse(resp)
 
 
-@method_decorator(csrf_exempt)
-def loadAllByXYZ(request):
+# csrf_exempt() wraps views in a sync function, which would hide that this one is async
+loadByXYZ.csrf_exempt = True
+
+
+async def loadAllByXYZ(request):
     data = json.loads(request.body)
 
+    # analyze every distinct tile up front, in parallel; the wait is on a thread of its own, so it
+    # neither blocks the event loop nor queues behind other sync work on the shared thread
+    tiles = [(region['x'], region['y'], region['z']) for groups in data for region in groups]
+    percs = await sync_to_async(analyze_many, thread_sensitive=False)(tiles)
+
     resp = []
     p = []
 
     for groups in data:
         gr = []
 
-        info = {
-            "totalArea": 0,
-            "totalTree": 0,
-            "percent": 0
-        }
-
         for region in groups:
-            perc = getImageByXYZ(region['x'], region['y'], region['z'], request, region['lat'], region['lng'])
-
-            info["totalTree"] += perc['area']
-            info["totalArea"] += perc['total_area']
-            info["percent"] += perc['perc']
+            perc = getImageByXYZ(region['x'], region['y'], region['z'], request, region['lat'], region['lng'],
+                                 percs[tile_key(region['x'], region['y'], region['z'])])
 
             gr.append(perc)
 
-        info["percent"] = info["percent"] / len(gr)
-
         resp.append(gr)
-        p.append(info)
+        p.append(_groupInfo(gr))
 
     return JsonResponse({"data": resp, "percentage": p})
+
+
+loadAllByXYZ.csrf_exempt = True
+
+
+@method_decorator(csrf_exempt)
+def greenArea(request):
+    data = json.loads(request.body)
+
+    if 'polygon' in data:
+        resp = green_area(analyzer.tile_store, data['z'], polygon=data['polygon'])
+    else:
+        resp = green_area(analyzer.tile_store, data['z'], bbox=data['bbox'])
+
+    return JsonResponse(resp)
+
+
+async def streamAllByXYZ(request):
+    data = json.loads(request.body)
+
+    # under ASGI the generator is run on worker threads, see api/handlers.py
+    return StreamingHttpResponse(_streamGroups(data, request), content_type='application/x-ndjson')
+
+
+streamAllByXYZ.csrf_exempt = True
+
+
+def _streamGroups(data, request):
+    # every (group, index) slot waiting on a tile, and what each group has collected so far
+    waiting = {}
+    collected = []
+
+    for g, groups in enumerate(data):
+        for i, region in enumerate(groups):
+            waiting.setdefault(tile_key(region['x'], region['y'], region['z']), []).append((g, i))
+
+        collected.append([None] * len(groups))
+
+        if not groups:
+            yield _line({"type": "group", "group": g, "totalArea": 0, "totalTree": 0, "percent": 0})
+
+    for tile, perc in iter_analyze(waiting):
+        for g, i in waiting.pop(tile):
+            region = data[g][i]
+            resp = getImageByXYZ(region['x'], region['y'], region['z'], request, region['lat'], region['lng'], perc)
+
+            yield _line(dict(resp, type="tile", group=g, index=i))
+
+            collected[g][i] = resp
+
+            if all(collected[g]):
+                yield _line(dict(_groupInfo(collected[g]), type="group", group=g))
+                collected[g] = None
+
+
+def metricsView(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _groupInfo(gr):
+    # summed in request order, whatever order the tiles finished in
+    info = {
+        "totalArea": 0,
+        "totalTree": 0,
+        "percent": 0
+    }
+
+    for perc in gr:
+        info["totalTree"] += perc['area']
+        info["totalArea"] += perc['total_area']
+        info["percent"] += perc['perc']
+
+    info["percent"] = info["percent"] / len(gr)
+
+    return info
+
+
+def _line(obj):
+    return json.dumps(obj) + "\n"
@@ -1,18 +1,30 @@
-import math
-import os
-import urllib.request
+import threading
 
 import numpy as np
 import cv2
-import random
 
-from agroboost.settings import BASE_DIR
-from django.contrib.staticfiles.templatetags.staticfiles import static
+from agroboost.settings import TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, TILE_CACHE_MAX_TILES, TILE_LOCK_DIR, \
+    TILE_OVERVIEW_FROM_CHILDREN, TILE_HOSTS, TILE_URL_TEMPLATE, TILE_FETCH_CONCURRENCY, TILE_FETCH_TIMEOUT, \
+    TILE_FETCH_RETRIES
+
+from api.vision import metrics
+from api.vision.coalesce import SingleFlight
+from api.vision.fetcher import TileFetcher
+from api.vision.geo import getRatio
+from api.vision.overview import build_from_children
+from api.vision.store import TileStore
 
 boundaries = [
     ([0, 0, 0], [110, 130, 90]),
 ]
 
+tile_store = TileStore(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, TILE_CACHE_MAX_TILES)
+
+tile_flight = SingleFlight(TILE_LOCK_DIR)
+
+tile_fetcher = TileFetcher(TILE_HOSTS, TILE_URL_TEMPLATE, concurrency=TILE_FETCH_CONCURRENCY,
+                           timeout=TILE_FETCH_TIMEOUT, retries=TILE_FETCH_RETRIES)
+
 
 def apply_brightness_contrast(input_img, brightness=0, contrast=0):
     if brightness != 0:
@@ -42,106 +54,186 @@ def apply_brightness_contrast(input_img, brightness=0, contrast=0):
 def treePer(img):
     shape = img.shape
 
-    white = 0
-
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            if img[x, y] == 255:
-                white += 1
+    white = np.count_nonzero(img == 255)
 
     return white * 100 / (shape[0] * shape[1])
 
 
 def check_green(img):
-    shape = img.shape
-
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            r, g, b = img[x, y]
+    # channels are read as r, g, b to match the original per-pixel loop;
+    # in int16, because the loop's uint8 scalars were promoted by NumPy 1.x
+    # value-based casting and g + 10 never wrapped for g >= 246
+    r, g, b = (img[..., i].astype(np.int16) for i in range(3))
 
-            if g < r and g < b:
-                img[x, y] = [0, 0, 0]
+    drop = (g < r) & (g < b)
+    drop |= g + 10 < r
+    drop |= g + 10 < b
 
-            if g + 10 < r or g + 10 < b:
-                img[x, y] = [0, 0, 0]
+    img[drop] = 0
 
     return img
 
 
-def analyze(x, y, z):
-    path = "http://{}.google.com/vt/lyrs=s&x={}&y={}&z={}".format(
-        ['mt0', 'mt1', 'mt2', 'mt3'][random.randint(0, 3)], x, y, z)
-    image = url_to_image(path)
-
-    source_file = (BASE_DIR + '/images/source/{}/{}/{}').format(z, x, y)
-    analyzed_file = (BASE_DIR + '/images/analyzed/{}/{}/{}').format(z, x, y)
-    perc_file = analyzed_file + '/perc.txt'
-
-    os.makedirs(source_file, exist_ok=True)
-    os.makedirs(analyzed_file, exist_ok=True)
-
-    if (os.path.isfile(perc_file)):
-        with open(perc_file) as f:
-            return float(f.readline())
-
-    cv2.imwrite(source_file + '/tile.png', image)
-    # image = cv2.imread(path)
-
+def green_gray(image):
     for (lower, upper) in boundaries:
         # create NumPy arrays from the boundaries
         lower = np.array(lower, dtype="uint8")
         upper = np.array(upper, dtype="uint8")
 
-        image = apply_brightness_contrast(image, 32, 0)
+        with metrics.timer('brightness_contrast'):
+            image = apply_brightness_contrast(image, 32, 0)
 
         # find the colors within the specified boundaries and apply
         # the mask
-        mask = cv2.inRange(image, lower, upper)
-        output = cv2.bitwise_and(image, image, mask=mask)
+        with metrics.timer('color_mask'):
+            mask = cv2.inRange(image, lower, upper)
+            output = cv2.bitwise_and(image, image, mask=mask)
+
+        with metrics.timer('check_green'):
+            output = check_green(output)
+
+        with metrics.timer('grayscale'):
+            return cv2.cvtColor(output, cv2.COLOR_BGR2GRAY)
+
+
+class GreenClassifier:
+    """green_gray() and the Otsu threshold, fused into a few single passes.
+
+    Brightness/contrast is a 256-entry lookup table built by running
+    apply_brightness_contrast() over every byte value, so it is exact. The
+    boundaries test and the check_green() conditions are comparisons
+    written into per-thread buffers that are reused from tile to tile.
+    """
+
+    def __init__(self, lower, upper, brightness=32, contrast=0):
+        self.lower = np.array(lower, dtype="uint8")
+        self.upper = np.array(upper, dtype="uint8")
+        self.lut = apply_brightness_contrast(np.arange(256, dtype=np.uint8).reshape(1, 256), brightness, contrast)
+
+        self._local = threading.local()
+
+    def _buffers(self, shape):
+        buffers = getattr(self._local, 'buffers', None)
+
+        if buffers is None or buffers['shape'] != shape:
+            plane = shape[:2]
+            buffers = self._local.buffers = {
+                'shape': shape,
+                'bright': np.empty(shape, np.uint8),
+                'channels': [np.empty(plane, np.uint8) for _ in range(3)],
+                'green10': np.empty(plane, np.uint8),
+                'keep': np.empty(plane, np.uint8),
+                'test': np.empty(plane, np.uint8),
+                'test2': np.empty(plane, np.uint8),
+                'gray': np.empty(plane, np.uint8),
+            }
+
+        return buffers
+
+    def gray(self, image):
+        """Same values as green_gray(image), in a buffer the next call on this thread overwrites."""
+        buf = self._buffers(image.shape)
+        bright, (c0, c1, c2), keep = buf['bright'], buf['channels'], buf['keep']
+        test, test2, green10 = buf['test'], buf['test2'], buf['green10']
+
+        with metrics.timer('color_lut'):
+            cv2.LUT(image, self.lut, dst=bright)
+
+        with metrics.timer('color_mask'):
+            cv2.inRange(bright, self.lower, self.upper, dst=keep)
+
+            for i, channel in enumerate((c0, c1, c2)):
+                cv2.extractChannel(bright, i, dst=channel)
+
+            # check_green() keeps a pixel when none of its drop conditions hold. Its
+            # uint8 wraparound only hits green above 245, which inRange has dropped.
+            cv2.add(c1, 10, dst=green10)
 
-        output = check_green(output)
+            cv2.compare(green10, c0, cv2.CMP_GE, dst=test)
+            cv2.bitwise_and(keep, test, dst=keep)
+            cv2.compare(green10, c2, cv2.CMP_GE, dst=test)
+            cv2.bitwise_and(keep, test, dst=keep)
 
-        gray_output = cv2.cvtColor(output, cv2.COLOR_BGR2GRAY)
-        (thresh, im_bw) = cv2.threshold(gray_output, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+            cv2.compare(c1, c0, cv2.CMP_GE, dst=test)
+            cv2.compare(c1, c2, cv2.CMP_GE, dst=test2)
+            cv2.bitwise_or(test, test2, dst=test)
+            cv2.bitwise_and(keep, test, dst=keep)
 
-        cv2.imwrite(analyzed_file + '/tile.png', im_bw)
+        with metrics.timer('grayscale'):
+            cv2.cvtColor(bright, cv2.COLOR_BGR2GRAY, dst=buf['gray'])
+            cv2.bitwise_and(buf['gray'], keep, dst=buf['gray'])
 
-        perc = treePer(im_bw)
+        return buf['gray']
 
-        with open(perc_file, "w") as f:
-            f.write(str(perc))
+    def classify(self, image):
+        gray_output = self.gray(image)
 
+        with metrics.timer('threshold'):
+            (thresh, im_bw) = cv2.threshold(gray_output, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+        # the threshold leaves only 0 and 255, so this is treePer(im_bw)
+        with metrics.timer('tree_percent'):
+            return im_bw, cv2.countNonZero(im_bw) * 100 / (im_bw.shape[0] * im_bw.shape[1])
+
+
+classifier = GreenClassifier(*boundaries[0])
+
+
+def analyze_image(image):
+    return classifier.classify(image)
+
+
+def analyze(x, y, z):
+    perc = cached(x, y, z)
+
+    if perc is not None:
         return perc
 
+    # concurrent requests for the same tile share one download and analysis
+    return tile_flight.do((int(z), int(x), int(y)), lambda: _analyze(x, y, z),
+                          recheck=lambda: tile_store.get(z, x, y))
 
-def url_to_image(url):
-    # download the image, convert it to a NumPy array, and then read
-    # it into OpenCV format
-    req = urllib.request.Request(
-        url,
-        data=None,
-        headers={
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
-        }
-    )
 
-    resp = urllib.request.urlopen(req)
+def cached(x, y, z):
+    with metrics.timer('cache_lookup'):
+        perc = tile_store.get(z, x, y)
 
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+    metrics.inc('agroboost_tile_cache_total', result='miss' if perc is None else 'hit')
 
-    # return the image
-    return image
+    return perc
 
 
-def getRatio(z, lat, lng):
-    return 156543.03392 * math.cos(float(lat) * math.pi / 180) / math.pow(2, int(z))
+def _analyze(x, y, z):
+    with metrics.in_flight('analysis'):
+        if TILE_OVERVIEW_FROM_CHILDREN:
+            with metrics.timer('overview'):
+                perc = build_from_children(tile_store, x, y, z)
 
+            if perc is not None:
+                return perc
 
-def getImageByXYZ(x, y, z, request, lat, lng):
-    perc = analyze(x, y, z)
+        image = url_to_image(tile_fetcher.tile_url(x, y, z))
 
-    analyzed_img = "{}/static/analyzed/{}/{}/{}/tile.png".format(request._current_scheme_host, z, x, y)
+        im_bw, perc = analyze_image(image)
+
+        with metrics.timer('store_put'):
+            tile_store.put(z, x, y, image, im_bw, perc)
+
+        return perc
+
+
+def url_to_image(url):
+    # download the image over a pooled keep-alive connection and read
+    # it into OpenCV format
+    return tile_fetcher.fetch_image(url)
+
+
+def getImageByXYZ(x, y, z, request, lat, lng, perc=None):
+    if perc is None:
+        perc = analyze(x, y, z)
+
+    # the mask PNG is rendered by loadMap on demand, there is no static file for it
+    analyzed_img = "{}/map/{}/{}/{}".format(request._current_scheme_host, z, x, y)
     source_img = "{}/static/source/{}/{}/{}/tile.png".format(request._current_scheme_host, z, x, y)
 
     area = getRatio(z, lat, lng) * perc / 100
@@ -149,3 +241,20 @@ def getImageByXYZ(x, y, z, request, lat, lng):
 
     return {'perc': perc, 'analyzed_img': analyzed_img, 'source_img': source_img, 'area': area,
             'total_area': total_area}
+
+
+def _collect():
+    # read at scrape time, so they follow whichever store and flight are installed
+    count, size = tile_store.usage()
+    samples = [
+        ('agroboost_tile_cache_tiles', 'gauge', {}, count),
+        ('agroboost_tile_cache_bytes', 'gauge', {}, size),
+    ]
+
+    for kind, value in tile_flight.stats().items():
+        samples.append(('agroboost_singleflight_total', 'counter', {'result': kind}, value))
+
+    return samples
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from agroboost.settings import TILE_HOSTS, TILE_URL_TEMPLATE, TILE_FETCH_CONCURRENCY, TILE_FETCH_TIMEOUT, \
+    TILE_FETCH_RETRIES, TILE_OVERVIEW_FROM_CHILDREN, ANALYSIS_THREADS
+from api.vision import analyzer, metrics
+from api.vision.fetcher import AsyncTileFetcher, decode_image
+from api.vision.overview import build_from_children
+
+tile_fetcher = AsyncTileFetcher(TILE_HOSTS, TILE_URL_TEMPLATE, concurrency=TILE_FETCH_CONCURRENCY,
+                                timeout=TILE_FETCH_TIMEOUT, retries=TILE_FETCH_RETRIES)
+
+# decoding, analysis and tile store calls (SQLite, files) must stay off the event loop
+cpu_executor = ThreadPoolExecutor(max_workers=ANALYSIS_THREADS or os.cpu_count())
+
+# threads that wait for a tile's tile_flight lock, which another worker may hold for a whole
+# download, so there are a few per concurrent fetch
+flight_executor = ThreadPoolExecutor(max_workers=4 * TILE_FETCH_CONCURRENCY)
+
+_inflight = weakref.WeakKeyDictionary()
+
+
+async def analyze_async(x, y, z):
+    """Awaitable analyze(): store lookups and the analysis run in cpu_executor, the download on the loop.
+
+    A tile that is not cached is looked up, downloaded and analyzed while
+    its tile_flight lock is held, so other workers (and sync views in this
+    one) share the download, not just the write.
+    """
+    loop = asyncio.get_running_loop()
+    perc = await loop.run_in_executor(cpu_executor, analyzer.cached, x, y, z)
+
+    if perc is not None:
+        return perc
+
+    key = (int(z), int(x), int(y))
+    inflight = _inflight.setdefault(loop, {})
+    task = inflight.get(key)
+
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(_analyze(x, y, z))
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    else:
+        analyzer.tile_flight.note_coalesced()
+
+    # a disconnecting client must not cancel the analysis other requests wait on
+    return await asyncio.shield(task)
+
+
+async def _analyze(x, y, z):
+    loop = asyncio.get_running_loop()
+
+    with metrics.in_flight('analysis'):
+        if TILE_OVERVIEW_FROM_CHILDREN:
+            perc = await loop.run_in_executor(cpu_executor, _overview, x, y, z)
+
+            if perc is not None:
+                return perc
+
+        return await analyzer.tile_flight.do_async((int(z), int(x), int(y)), lambda: _fetch_and_analyze(x, y, z),
+                                                   flight_executor, recheck=lambda: analyzer.tile_store.get(z, x, y))
+
+
+def _overview(x, y, z):
+    with metrics.timer('overview'):
+        return build_from_children(analyzer.tile_store, x, y, z)
+
+
+async def _fetch_and_analyze(x, y, z):
+    url = tile_fetcher.tile_url(x, y, z)
+    data = await tile_fetcher.fetch(url)
+
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, _analyze_data, x, y, z, url, data)
+
+
+def _analyze_data(x, y, z, url, data):
+    image = decode_image(data, url)
+    im_bw, perc = analyzer.analyze_image(image)
+
+    with metrics.timer('store_put'):
+        analyzer.tile_store.put(z, x, y, image, im_bw, perc)
+
+    return perc
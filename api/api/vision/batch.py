@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+
+from agroboost.settings import BATCH_WORKERS
+from api.vision import analyzer, metrics
+
+# each worker process loads Django and cv2, so the default pool stays small
+MAX_DEFAULT_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker():
+    # workers start from a clean interpreter and bring Django up themselves
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'agroboost.settings')
+    django.setup()
+
+
+def _analyze_tile(tile):
+    return tile, analyzer.analyze(*tile)
+
+
+def default_workers():
+    # the CPUs this process may run on, not the host's, and only a few of
+    # them: every server worker process starts a pool of its own
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    return max(1, min(cpus, MAX_DEFAULT_WORKERS))
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            # forkserver: forking a threaded server process could copy locks held by other threads
+            _executor = ProcessPoolExecutor(max_workers=BATCH_WORKERS or default_workers(), initializer=_init_worker,
+                                            mp_context=multiprocessing.get_context('forkserver'))
+
+        return _executor
+
+
+def tile_key(x, y, z):
+    return int(x), int(y), int(z)
+
+
+def iter_analyze(tiles, executor=None):
+    """Yield ``((x, y, z), perc)`` once per distinct tile, in completion order.
+
+    Cached tiles are answered in-process straight away; the rest are fanned
+    out over the process pool (or ``executor``), unless there is only one.
+    """
+    pending = []
+
+    for tile in dict.fromkeys(tile_key(*tile) for tile in tiles):
+        x, y, z = tile
+        perc = analyzer.tile_store.get(z, x, y)
+
+        if perc is None:
+            pending.append(tile)
+        else:
+            metrics.inc('agroboost_tile_cache_total', result='hit')
+            yield tile, perc
+
+    if len(pending) == 1:
+        # analyze() looks the tile up again and counts the miss itself
+        yield _analyze_tile(pending[0])
+        return
+
+    if not pending:
+        return
+
+    # pool workers keep their own stage timings; only the misses are visible here
+    metrics.inc('agroboost_tile_cache_total', len(pending), result='miss')
+
+    executor = executor or get_executor()
+    futures = [executor.submit(_analyze_tile, tile) for tile in pending]
+
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def analyze_many(tiles, executor=None):
+    return dict(iter_analyze(tiles, executor))
@@ -0,0 +1,162 @@
+import asyncio
+import fcntl
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution.
+
+    Within a process, callers that arrive while a key is in flight wait for
+    the leader and share its result (or exception). Across worker processes
+    the leader holds one of ``stripes`` ``flock`` files under ``lock_dir``
+    while it runs, and asks ``recheck`` first once it has the lock, so a
+    result another worker produced in the meantime is reused, not recomputed.
+    """
+
+    def __init__(self, lock_dir, stripes=256):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.executed = 0
+        self.coalesced = 0
+        self.coalesced_across_workers = 0
+
+    def do(self, key, fn, recheck=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = self._run_locked(key, fn, recheck)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+    async def do_async(self, key, fn, executor, recheck=None):
+        """``do`` for a coroutine function ``fn``, awaited on the event loop.
+
+        The caller coalesces its own tasks and counts them with
+        ``note_coalesced``. The flock is waited for and ``recheck`` runs on
+        ``executor``, so neither blocks the loop; the same files keep sync
+        callers in this process and other workers out.
+        """
+        with self._lock:
+            self.executed += 1
+
+        acquiring = executor.submit(self._acquire, key)
+
+        try:
+            f = await asyncio.wrap_future(acquiring)
+        except asyncio.CancelledError:
+            # the thread may still get the lock; it must not be kept
+            acquiring.add_done_callback(_release_acquired)
+            raise
+
+        try:
+            if recheck is not None:
+                result = await asyncio.get_running_loop().run_in_executor(executor, recheck)
+
+                if result is not None:
+                    with self._lock:
+                        self.coalesced_across_workers += 1
+
+                    return result
+
+            return await fn()
+        finally:
+            _release(f)
+
+    def note_coalesced(self):
+        # for callers that coalesce on their own, e.g. asyncio tasks
+        with self._lock:
+            self.coalesced += 1
+
+    def _run_locked(self, key, fn, recheck):
+        with self.file_lock(key):
+            if recheck is not None:
+                result = recheck()
+
+                if result is not None:
+                    with self._lock:
+                        self.coalesced_across_workers += 1
+
+                    return result
+
+            return fn()
+
+    def _acquire(self, key):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        stripe = zlib.crc32(repr(key).encode()) % self.stripes
+        f = open(os.path.join(self.lock_dir, '{}.lock'.format(stripe)), 'a')
+
+        try:
+            # the lock belongs to the open file, so any thread may release it
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+
+        return f
+
+    @contextmanager
+    def file_lock(self, key):
+        f = self._acquire(key)
+
+        try:
+            yield
+        finally:
+            _release(f)
+
+    def stats(self):
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'coalesced_across_workers': self.coalesced_across_workers,
+        }
+
+
+def _release(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        f.close()
+
+
+def _release_acquired(future):
+    if not future.cancelled() and future.exception() is None:
+        _release(future.result())
+
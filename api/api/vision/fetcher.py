@@ -0,0 +1,279 @@
+import asyncio
+import http.client
+import itertools
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import cv2
+import httpx
+import numpy as np
+
+from api.vision import metrics
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
+}
+
+# upstream answers worth retrying; anything else non-200 fails immediately
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# how a request on a kept-alive connection the server has just closed fails
+STALE_CONNECTION_ERRORS = (httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError)
+
+
+class FetchError(Exception):
+    pass
+
+
+def decode_image(data, url):
+    with metrics.timer('decode'):
+        image = cv2.imdecode(np.frombuffer(data, dtype="uint8"), cv2.IMREAD_COLOR)
+
+    if image is None:
+        raise FetchError('{} is not an image'.format(url))
+
+    return image
+
+
+class ConnectionPool:
+    """Keep-alive connections to one scheme://host, at most ``size`` of them idle."""
+
+    def __init__(self, scheme, netloc, size, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            return cls(self.netloc, timeout=self.timeout)
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class TileFetcher:
+    """Downloads satellite tiles over pooled keep-alive connections.
+
+    Hosts from ``hosts`` are used round-robin to fill ``url_template``; a
+    batch is fetched by at most ``concurrency`` threads at a time, and each
+    tile is retried ``retries`` times with exponential backoff.
+    """
+
+    def __init__(self, hosts, url_template, concurrency=8, timeout=10, retries=3, backoff=0.5):
+        self.hosts = list(hosts)
+        self.url_template = url_template
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._hosts = itertools.cycle(self.hosts)
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pid = os.getpid()
+
+    def tile_url(self, x, y, z):
+        with self._lock:
+            host = next(self._hosts)
+
+        return self.url_template.format(host=host, x=x, y=y, z=z)
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            # sockets inherited through fork() belong to the parent
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+
+            pool = self._pools.get((scheme, netloc))
+
+            if pool is None:
+                pool = self._pools[(scheme, netloc)] = ConnectionPool(scheme, netloc, self.concurrency, self.timeout)
+
+            return pool
+
+    def fetch(self, url):
+        with metrics.timer('fetch'), metrics.in_flight('fetch'):
+            body = self._fetch(url)
+
+        metrics.inc('agroboost_fetched_bytes_total', len(body))
+
+        return body
+
+    def _fetch(self, url):
+        parts = urlsplit(url)
+        pool = self._pool(parts.scheme, parts.netloc)
+        target = parts.path + ('?' + parts.query if parts.query else '')
+
+        error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.inc('agroboost_fetch_retries_total')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            conn = pool.acquire()
+
+            try:
+                conn.request('GET', target, headers=HEADERS)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                error = e
+                continue
+
+            if resp.will_close:
+                conn.close()
+            else:
+                pool.release(conn)
+
+            if resp.status == 200:
+                return body
+
+            error = FetchError('{} returned HTTP {}'.format(url, resp.status))
+
+            if resp.status not in RETRY_STATUSES:
+                break
+
+        raise FetchError('could not fetch {}: {}'.format(url, error)) from error
+
+    def fetch_image(self, url):
+        return decode_image(self.fetch(url), url)
+
+    def fetch_tile(self, x, y, z):
+        return self.fetch_image(self.tile_url(x, y, z))
+
+    def fetch_many(self, tiles):
+        """Yield ``((x, y, z), image)`` for each tile as soon as it is decoded.
+
+        A tile that still fails after its retries raises when its turn comes.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.fetch_tile, *tile): tile for tile in tiles}
+
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+            self._pools = {}
+
+
+class AsyncTileFetcher:
+    """asyncio counterpart of TileFetcher, for the ASGI views, on httpx.
+
+    Same URLs, timeouts, retries and backoff. Each event loop gets an
+    ``httpx.AsyncClient`` of its own that keeps connections alive and has
+    at most ``concurrency`` requests in flight; the rest wait for a
+    connection without timing out. A kept-alive connection the server had
+    already closed is retried at once on a fresh one, without using up a
+    retry.
+    """
+
+    def __init__(self, hosts, url_template, concurrency=8, timeout=10, retries=3, backoff=0.5):
+        self.hosts = list(hosts)
+        self.url_template = url_template
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._hosts = itertools.cycle(self.hosts)
+        self._lock = threading.Lock()
+        self._clients = weakref.WeakKeyDictionary()
+
+    def tile_url(self, x, y, z):
+        with self._lock:
+            host = next(self._hosts)
+
+        return self.url_template.format(host=host, x=x, y=y, z=z)
+
+    def _client(self):
+        # an AsyncClient's connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            client = self._clients.get(loop)
+
+            if client is None:
+                limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+                client = self._clients[loop] = httpx.AsyncClient(
+                    headers=HEADERS, limits=limits, timeout=httpx.Timeout(self.timeout, pool=None))
+
+            return client
+
+    async def fetch(self, url):
+        with metrics.timer('fetch'), metrics.in_flight('fetch'):
+            body = await self._fetch(url)
+
+        metrics.inc('agroboost_fetched_bytes_total', len(body))
+
+        return body
+
+    async def _get(self, client, url):
+        try:
+            return await client.get(url)
+        except STALE_CONNECTION_ERRORS:
+            # most likely a pooled connection the server closed while it sat idle;
+            # httpx has dropped it, so the second try opens a new one
+            return await client.get(url)
+
+    async def _fetch(self, url):
+        client = self._client()
+        error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.inc('agroboost_fetch_retries_total')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                response = await self._get(client, url)
+            except httpx.HTTPError as e:
+                error = e
+                continue
+
+            if response.status_code == 200:
+                return response.content
+
+            error = FetchError('{} returned HTTP {}'.format(url, response.status_code))
+
+            if response.status_code not in RETRY_STATUSES:
+                break
+
+        raise FetchError('could not fetch {}: {}'.format(url, error)) from error
+
+    async def aclose(self):
+        # closes the running loop's client
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+
+        if client is not None:
+            await client.aclose()
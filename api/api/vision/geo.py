@@ -0,0 +1,19 @@
+import math
+
+import mercantile
+
+
+def getRatio(z, lat, lng):
+    return 156543.03392 * math.cos(float(lat) * math.pi / 180) / math.pow(2, int(z))
+
+
+def tile_lat(x, y, z):
+    # the latitude loadMap passes for a tile: its upper-left corner
+    return mercantile.ul(int(x), int(y), int(z)).lat
+
+
+def child_tiles(x, y, z):
+    # the four z + 1 tiles covering (x, y, z), in row-major order
+    x, y, z = 2 * int(x), 2 * int(y), int(z) + 1
+
+    return [(x, y, z), (x + 1, y, z), (x, y + 1, z), (x + 1, y + 1, z)]
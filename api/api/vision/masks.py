@@ -0,0 +1,100 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+# Analyzed masks are strictly binary, so they are kept bit-packed: one bit
+# per pixel, row-major, 8 KiB per 256x256 tile. Counting and unions work on
+# the packed bytes directly; a PNG is only rendered for a browser.
+
+TILE_SHAPE = (256, 256)
+
+# set bits per byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack(mask):
+    return np.packbits(mask.reshape(-1) == 255)
+
+
+def unpack(packed, shape=TILE_SHAPE):
+    return np.unpackbits(packed)[:shape[0] * shape[1]].reshape(shape) * np.uint8(255)
+
+
+def count(packed):
+    """Number of mask pixels set, without unpacking."""
+    return int(POPCOUNT[packed].sum(dtype=np.int64))
+
+
+def union(masks):
+    return np.bitwise_or.reduce(np.stack(masks))
+
+
+def intersection(masks):
+    return np.bitwise_and.reduce(np.stack(masks))
+
+
+def render_png(packed, shape=TILE_SHAPE):
+    ok, data = cv2.imencode('.png', unpack(packed, shape))
+
+    if not ok:
+        raise ValueError('could not encode mask')
+
+    return data.tobytes()
+
+
+class MaskPack:
+    """Packed masks of one zoom level, in fixed-size slots of a single file.
+
+    Slots are handed out by the caller (the tile store keeps them in its
+    index). Reads go through a read-only memory map that is widened as the
+    file grows, so loading a mask is an 8 KB copy, not a decode.
+    """
+
+    def __init__(self, path, shape=TILE_SHAPE):
+        self.path = path
+        self.shape = shape
+        self.slot_size = shape[0] * shape[1] // 8
+
+        self._lock = threading.Lock()
+        self._map = None
+        self._pid = None
+
+    def write(self, slot, packed):
+        if packed.nbytes != self.slot_size:
+            raise ValueError('mask of {} bytes does not fit a {} byte slot'.format(packed.nbytes, self.slot_size))
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            os.pwrite(fd, packed.tobytes(), slot * self.slot_size)
+        finally:
+            os.close(fd)
+
+    def _mapped(self, end):
+        with self._lock:
+            # widen the map once another writer (or process) has grown the file past it
+            if self._map is None or self._pid != os.getpid() or len(self._map) < end:
+                if not os.path.isfile(self.path) or os.path.getsize(self.path) < end:
+                    return None
+
+                self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+                self._pid = os.getpid()
+
+            return self._map
+
+    def read(self, slot):
+        """A copy of the packed mask in ``slot``; None past the end of the file.
+
+        Never a view into the map: the slot may be reused for another tile
+        as soon as this one is evicted.
+        """
+        start = slot * self.slot_size
+        data = self._mapped(start + self.slot_size)
+
+        if data is None:
+            return None
+
+        return np.array(data[start:start + self.slot_size])
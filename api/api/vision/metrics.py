@@ -0,0 +1,175 @@
+import threading
+import time
+
+from agroboost.settings import METRICS_ENABLED
+
+# In-process metrics for the tile pipeline, rendered in the Prometheus text
+# format by the /metrics view. Every worker process keeps its own numbers.
+# With METRICS_ENABLED off, timer() hands back a shared no-op object and
+# the counters return before taking any lock.
+
+enabled = METRICS_ENABLED
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_collectors = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+
+    key = _key(name, labels)
+
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def add(name, value, **labels):
+    if not enabled:
+        return
+
+    key = _key(name, labels)
+
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not enabled:
+        return
+
+    key = _key(name, labels)
+
+    with _lock:
+        hist = _histograms.get(key)
+
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(BUCKETS), 0, 0.]
+
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist[0][i] += 1
+                break
+
+        hist[1] += 1
+        hist[2] += value
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _InFlight:
+    __slots__ = ('labels',)
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        add('agroboost_in_flight', 1, **self.labels)
+
+    def __exit__(self, *exc):
+        add('agroboost_in_flight', -1, **self.labels)
+
+
+class _Noop:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP = _Noop()
+
+
+def timer(stage):
+    """``with timer('fetch'):`` records the block in agroboost_stage_seconds."""
+    if not enabled:
+        return _NOOP
+
+    return _Timer('agroboost_stage_seconds', {'stage': stage})
+
+
+def in_flight(what):
+    if not enabled:
+        return _NOOP
+
+    return _InFlight({'what': what})
+
+
+def register_collector(fn):
+    """``fn()`` is called at scrape time and returns ``(name, type, labels, value)`` samples."""
+    _collectors.append(fn)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render():
+    samples = {}
+
+    with _lock:
+        for (name, labels), value in _counters.items():
+            samples.setdefault((name, 'counter'), []).append('{}{} {}'.format(name, _labels(labels), value))
+
+        for (name, labels), value in _gauges.items():
+            samples.setdefault((name, 'gauge'), []).append('{}{} {}'.format(name, _labels(labels), value))
+
+        for (name, labels), (counts, count, total) in _histograms.items():
+            lines = samples.setdefault((name, 'histogram'), [])
+            cumulative = 0
+
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', '+Inf')]), count))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+
+    for collect in _collectors:
+        for name, kind, labels, value in collect():
+            samples.setdefault((name, kind), []).append('{}{} {}'.format(name, _labels(sorted(labels.items())), value))
+
+    out = []
+
+    for (name, kind), lines in sorted(samples.items()):
+        out.append('# TYPE {} {}'.format(name, kind))
+        out.extend(lines)
+
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,141 @@
+import os
+
+import mercantile
+import numpy as np
+
+from api.vision.analyzer import green_gray
+from api.vision.geo import getRatio, tile_lat
+
+TILE_SIZE = 256
+
+
+def otsu_threshold(hist):
+    """cv2's THRESH_OTSU threshold, computed from a 256-bin histogram instead of an image."""
+    scale = 1. / hist.sum()
+    mu = sum(i * float(h) for i, h in enumerate(hist)) * scale
+    q1 = mu1 = max_sigma = 0.
+    max_val = 0
+    eps = np.finfo(np.float32).eps
+
+    for i, h in enumerate(hist):
+        p_i = float(h) * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1. - q1
+
+        if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+            continue
+
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+
+    return max_val
+
+
+def region_tiles(bbox, z):
+    west, south, east, north = bbox
+
+    ul = mercantile.tile(west, north, z)
+    lr = mercantile.tile(east - 1e-9, south + 1e-9, z)
+
+    return ul.x, ul.y, lr.x - ul.x + 1, lr.y - ul.y + 1
+
+
+def _chunks(cols, rows, chunk):
+    for row in range(0, rows, chunk):
+        for col in range(0, cols, chunk):
+            yield col, row, min(chunk, cols - col), min(chunk, rows - row)
+
+
+def _load_chunk(store, fetcher, x0, y0, z, w, h):
+    image = np.empty((h * TILE_SIZE, w * TILE_SIZE, 3), dtype=np.uint8)
+    missing = []
+
+    for j in range(h):
+        for i in range(w):
+            tile = store.source(z, x0 + i, y0 + j)
+
+            if tile is None:
+                missing.append((x0 + i, y0 + j, z))
+            else:
+                image[j * TILE_SIZE:(j + 1) * TILE_SIZE, i * TILE_SIZE:(i + 1) * TILE_SIZE] = tile
+
+    for (x, y, z), tile in fetcher.fetch_many(missing):
+        i, j = x - x0, y - y0
+        image[j * TILE_SIZE:(j + 1) * TILE_SIZE, i * TILE_SIZE:(i + 1) * TILE_SIZE] = tile
+
+    return image
+
+
+def analyze_region(store, fetcher, bbox, z, out_dir, chunk=8):
+    """Analyze every z tile of ``bbox`` as one mosaic with a single Otsu threshold.
+
+    The region is processed ``chunk`` x ``chunk`` tiles at a time: a first
+    pass builds the green-channel gray mosaic and its histogram, a second
+    thresholds it into ``out_dir/mask.npy``. Both mosaics are memory-mapped,
+    so memory use depends on ``chunk`` and not on the size of the region.
+    Cached source tiles are reused, the rest are fetched.
+    """
+    x0, y0, cols, rows = region_tiles(bbox, z)
+
+    os.makedirs(out_dir, exist_ok=True)
+    shape = (rows * TILE_SIZE, cols * TILE_SIZE)
+    gray_path = os.path.join(out_dir, 'gray.npy')
+    mask_path = os.path.join(out_dir, 'mask.npy')
+
+    gray = np.lib.format.open_memmap(gray_path, mode='w+', dtype=np.uint8, shape=shape)
+    hist = np.zeros(256, dtype=np.int64)
+
+    for col, row, w, h in _chunks(cols, rows, chunk):
+        image = _load_chunk(store, fetcher, x0 + col, y0 + row, z, w, h)
+        part = green_gray(image)
+
+        gray[row * TILE_SIZE:(row + h) * TILE_SIZE, col * TILE_SIZE:(col + w) * TILE_SIZE] = part
+        hist += np.bincount(part.ravel(), minlength=256)
+
+    threshold = otsu_threshold(hist)
+
+    mask = np.lib.format.open_memmap(mask_path, mode='w+', dtype=np.uint8, shape=shape)
+    green = np.zeros((rows, cols), dtype=np.int64)
+
+    for col, row, w, h in _chunks(cols, rows, chunk):
+        window = (slice(row * TILE_SIZE, (row + h) * TILE_SIZE), slice(col * TILE_SIZE, (col + w) * TILE_SIZE))
+        part = np.where(gray[window] > threshold, 255, 0).astype(np.uint8)
+
+        mask[window] = part
+        green[row:row + h, col:col + w] = \
+            np.count_nonzero(part.reshape(h, TILE_SIZE, w, TILE_SIZE), axis=(1, 3))
+
+    mask.flush()
+    del gray, mask
+    os.remove(gray_path)
+
+    tiles = []
+    info = {
+        "totalArea": 0,
+        "totalTree": 0,
+        "percent": 0
+    }
+
+    # same per-tile figures getImageByXYZ reports
+    for j in range(rows):
+        for i in range(cols):
+            x, y = x0 + i, y0 + j
+            perc = green[j, i] * 100 / (TILE_SIZE * TILE_SIZE)
+            total_area = getRatio(z, tile_lat(x, y, z), 0)
+
+            tiles.append({'x': x, 'y': y, 'z': z, 'perc': perc, 'area': total_area * perc / 100,
+                          'total_area': total_area})
+
+            info["totalTree"] += total_area * perc / 100
+            info["totalArea"] += total_area
+            info["percent"] += perc
+
+    info["percent"] = info["percent"] / len(tiles)
+
+    return dict(info, threshold=threshold, mask=mask_path, tiles=tiles)
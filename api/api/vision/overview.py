@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+
+from api.vision.geo import child_tiles, getRatio, tile_lat
+
+
+def mosaic(tiles):
+    # [top-left, top-right, bottom-left, bottom-right] -> one 2x image
+    return np.vstack([np.hstack(tiles[:2]), np.hstack(tiles[2:])])
+
+
+def build_from_children(store, x, y, z, fill=None):
+    """Derive tile (x, y, z) from its four z + 1 children instead of fetching it.
+
+    The parent perc is the children's perc weighted by their ground area.
+    ``getRatio`` (the latitude math ``getImageByXYZ`` uses) is metres per
+    pixel, a length that scales with cos(latitude), so the area weight is
+    its square. Source and mask are the children stitched and halved.
+    Missing children are computed with ``fill(x, y, z)`` if given,
+    otherwise nothing is built and None returned.
+    """
+    children = child_tiles(x, y, z)
+    percs = []
+
+    for cx, cy, cz in children:
+        perc = store.get(cz, cx, cy)
+
+        if perc is None and fill is not None:
+            perc = fill(cx, cy, cz)
+
+        if perc is None:
+            return None
+
+        percs.append(perc)
+
+    weights = [getRatio(cz, tile_lat(cx, cy, cz), 0) ** 2 for cx, cy, cz in children]
+    perc = sum(p * w for p, w in zip(percs, weights)) / sum(weights)
+
+    sources = [store.source(cz, cx, cy) for cx, cy, cz in children]
+    masks = [store.mask(cz, cx, cy) for cx, cy, cz in children]
+
+    # a child evicted between get() and imread() leaves nothing to stitch
+    if any(tile is None for tile in sources + masks):
+        return None
+
+    source = mosaic(sources)
+    source = cv2.resize(source, (source.shape[1] // 2, source.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+    mask = mosaic(masks)
+    mask = cv2.resize(mask, (mask.shape[1] // 2, mask.shape[0] // 2), interpolation=cv2.INTER_AREA)
+    (thresh, mask) = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+
+    store.put(z, x, y, source, mask, perc)
+
+    return perc
+
+
+def build_pyramid(store, tiles, min_zoom, fill=None):
+    """Roll already-analyzed ``(x, y, z)`` tiles up into overviews down to ``min_zoom``.
+
+    Yields ``((x, y, z), perc)`` for every parent built.
+    """
+    level = {(int(x), int(y), int(z)) for x, y, z in tiles}
+
+    while level:
+        z = max(tile[2] for tile in level)
+
+        if z <= min_zoom:
+            return
+
+        parents = sorted({(x // 2, y // 2, z - 1) for x, y, tz in level if tz == z})
+        level = {tile for tile in level if tile[2] != z}
+
+        for parent in parents:
+            perc = build_from_children(store, *parent, fill=fill)
+
+            if perc is not None:
+                level.add(parent)
+                yield parent, perc
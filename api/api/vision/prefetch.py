@@ -0,0 +1,200 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import mercantile
+
+from api.vision import analyzer
+from api.vision.stats import clip_polygon, polygon_area
+
+# Cache warm-up: a region's tiles go into a SQLite work queue and are run
+# through analyzer.analyze() by a pool of threads, so an interrupted run
+# resumes where it stopped instead of starting over.
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def area_tiles(zooms, bbox=None, polygon=None):
+    """``(x, y, z)`` of every tile at ``zooms`` that overlaps ``bbox`` or ``polygon``, deepest zoom first.
+
+    Deepest first, so with TILE_OVERVIEW_FROM_CHILDREN the shallower tiles
+    are built from their children rather than downloaded.
+    """
+    if polygon is None:
+        west, south, east, north = bbox
+        polygon = [(west, south), (east, south), (east, north), (west, north)]
+
+    ring = [mercantile.xy(lng, lat) for lng, lat in polygon]
+    lngs = [lng for lng, lat in polygon]
+    lats = [lat for lng, lat in polygon]
+
+    for z in sorted(set(zooms), reverse=True):
+        for tile in mercantile.tiles(min(lngs), min(lats), max(lngs), max(lats), [z]):
+            b = mercantile.xy_bounds(tile)
+
+            if polygon_area(clip_polygon(ring, b.left, b.bottom, b.right, b.top)) > 0:
+                yield tile.x, tile.y, tile.z
+
+
+class WorkQueue:
+    """Tiles to warm and how far each got, kept in a SQLite file."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS queue ('
+                          'z INTEGER, x INTEGER, y INTEGER, state TEXT, attempts INTEGER, error TEXT, finished_at REAL, '
+                          'PRIMARY KEY (z, x, y))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_state ON queue (state, z)')
+
+    def add(self, tiles):
+        # tiles already queued keep their state, so re-running a region only adds what is new
+        before = self.conn.total_changes
+
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO queue VALUES (?, ?, ?, 'pending', 0, NULL, NULL)",
+                                  ((z, x, y) for x, y, z in tiles))
+
+        return self.conn.total_changes - before
+
+    def pending(self, limit):
+        rows = self.conn.execute("SELECT x, y, z FROM queue WHERE state = 'pending' ORDER BY z DESC, rowid LIMIT ?",
+                                 (limit,))
+
+        return [tuple(row) for row in rows]
+
+    def mark_done(self, tile):
+        x, y, z = tile
+        self.conn.execute("UPDATE queue SET state = 'done', error = NULL, finished_at = ? "
+                          "WHERE z = ? AND x = ? AND y = ?", (time.time(), z, x, y))
+
+    def mark_failed(self, tile, error):
+        x, y, z = tile
+        self.conn.execute("UPDATE queue SET state = 'failed', attempts = attempts + 1, error = ?, finished_at = ? "
+                          "WHERE z = ? AND x = ? AND y = ?", (str(error), time.time(), z, x, y))
+
+    def retry_failed(self):
+        return self.conn.execute("UPDATE queue SET state = 'pending' WHERE state = 'failed'").rowcount
+
+    def clear(self):
+        self.conn.execute('DELETE FROM queue')
+
+    def counts(self):
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        counts.update(self.conn.execute('SELECT state, COUNT(*) FROM queue GROUP BY state'))
+
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+class RateLimiter:
+    """Spaces calls to ``wait()`` at least ``1 / rate`` seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+
+        if at > now:
+            time.sleep(at - now)
+
+
+def warm(queue, workers=8, rate=None, progress=None, interval=5):
+    """Analyze every pending tile of ``queue`` and return the run's counts.
+
+    At most ``workers`` tiles are in flight and at most ``rate`` per second
+    miss the cache. ``progress(report)`` is called every ``interval``
+    seconds and once at the end.
+    """
+    limiter = RateLimiter(rate) if rate else None
+
+    def work(tile):
+        x, y, z = tile
+
+        if analyzer.tile_store.get(z, x, y) is not None:
+            return False
+
+        if limiter is not None:
+            limiter.wait()
+
+        analyzer.analyze(x, y, z)
+
+        return True
+
+    report = {'done': 0, 'analyzed': 0, 'failed': 0}
+    start = last = time.monotonic()
+
+    def finish(futures, running):
+        for future in futures:
+            tile = running.pop(future)
+            error = future.exception()
+
+            if error is None:
+                queue.mark_done(tile)
+                report['done'] += 1
+                report['analyzed'] += future.result()
+            else:
+                queue.mark_failed(tile, error)
+                report['failed'] += 1
+
+    def snapshot():
+        elapsed = time.monotonic() - start
+        rate = (report['done'] + report['failed']) / elapsed if elapsed else 0
+        remaining = queue.counts()[PENDING]
+
+        return dict(report, remaining=remaining, elapsed=elapsed, rate=rate,
+                    eta=remaining / rate if rate else None)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    running = {}
+    zoom = None
+
+    try:
+        while True:
+            tiles = queue.pending(workers * 64)
+
+            if not tiles:
+                break
+
+            for tile in tiles:
+                # a zoom level is finished before the next one up, whose tiles may be built from it
+                if running and tile[2] != zoom:
+                    finish(wait(running).done, running)
+
+                zoom = tile[2]
+                running[executor.submit(work, tile)] = tile
+
+                if len(running) >= workers * 2:
+                    finish(wait(running, return_when=FIRST_COMPLETED).done, running)
+
+                if progress is not None and time.monotonic() - last >= interval:
+                    progress(snapshot())
+                    last = time.monotonic()
+
+            finish(wait(running).done, running)
+    finally:
+        # whatever was still queued stays pending for the next run
+        executor.shutdown(cancel_futures=True)
+
+    result = snapshot()
+
+    if progress is not None:
+        progress(result)
+
+    return result
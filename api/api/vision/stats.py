@@ -0,0 +1,90 @@
+import mercantile
+
+# Area queries over the per-tile statistics the tile store records. Shapes
+# are clipped against tiles in Web Mercator metres, so a tile that is only
+# partly inside contributes the same fraction of its green pixels.
+
+
+def polygon_area(points):
+    # shoelace formula; orientation does not matter
+    return abs(sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]))) / 2
+
+
+def clip_polygon(points, left, bottom, right, top):
+    # Sutherland-Hodgman against an axis-aligned box
+    edges = (
+        (lambda p: p[0] >= left, lambda p, q: (left, p[1] + (q[1] - p[1]) * (left - p[0]) / (q[0] - p[0]))),
+        (lambda p: p[0] <= right, lambda p, q: (right, p[1] + (q[1] - p[1]) * (right - p[0]) / (q[0] - p[0]))),
+        (lambda p: p[1] >= bottom, lambda p, q: (p[0] + (q[0] - p[0]) * (bottom - p[1]) / (q[1] - p[1]), bottom)),
+        (lambda p: p[1] <= top, lambda p, q: (p[0] + (q[0] - p[0]) * (top - p[1]) / (q[1] - p[1]), top)),
+    )
+
+    for inside, intersect in edges:
+        if not points:
+            break
+
+        clipped = []
+
+        for p, q in zip(points[-1:] + points[:-1], points):
+            if inside(q):
+                if not inside(p):
+                    clipped.append(intersect(p, q))
+                clipped.append(q)
+            elif inside(p):
+                clipped.append(intersect(p, q))
+
+        points = clipped
+
+    return points
+
+
+def green_area(store, z, bbox=None, polygon=None):
+    """Green area inside ``bbox`` (west, south, east, north) or ``polygon`` ([lng, lat] ring) at zoom ``z``.
+
+    Answered from the statistics index alone; tiles that were never analyzed
+    are counted in ``missing_tiles`` rather than fetched.
+    """
+    if polygon is None:
+        west, south, east, north = bbox
+        polygon = [(west, south), (east, south), (east, north), (west, north)]
+
+    ring = [mercantile.xy(lng, lat) for lng, lat in polygon]
+    lngs = [lng for lng, lat in polygon]
+    lats = [lat for lng, lat in polygon]
+
+    # tile range of the shape's bounding box; the epsilon keeps edges on tile seams from spilling over
+    ul = mercantile.tile(min(lngs), max(lats), int(z))
+    lr = mercantile.tile(max(lngs) - 1e-9, min(lats) + 1e-9, int(z))
+
+    # fraction of every tile in range that lies inside the shape
+    coverage = {}
+
+    for x in range(ul.x, lr.x + 1):
+        for y in range(ul.y, lr.y + 1):
+            b = mercantile.xy_bounds(x, y, int(z))
+            part = polygon_area(clip_polygon(ring, b.left, b.bottom, b.right, b.top))
+
+            if part > 0:
+                coverage[(x, y)] = part / ((b.right - b.left) * (b.top - b.bottom))
+
+    green = 0
+    analyzed = 0
+    tiles = 0
+
+    for x, y, green_px, total_px, mpp, analyzed_at in store.stats(z, ul.x, lr.x, ul.y, lr.y):
+        part = coverage.get((x, y))
+
+        if part is None:
+            continue
+
+        green += green_px * part * mpp * mpp
+        analyzed += total_px * part * mpp * mpp
+        tiles += 1
+
+    return {
+        'green_area': green,
+        'analyzed_area': analyzed,
+        'percent': green * 100 / analyzed if analyzed else 0,
+        'tiles': tiles,
+        'missing_tiles': len(coverage) - tiles,
+    }
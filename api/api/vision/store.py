@@ -0,0 +1,461 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import mercantile
+
+from api.vision import masks
+from api.vision.geo import getRatio
+
+# how often (in seconds) a cache hit refreshes the persisted access time
+TOUCH_INTERVAL = 60
+
+
+class TileStore:
+    """Cache of analyzed tiles.
+
+    Source PNGs keep their public layout under ``root/source/z/x/y`` so
+    ``/static/...`` URLs stay valid. Masks are bit-packed into one
+    ``root/masks/<z>.pack`` file per zoom (see api/vision/masks.py); caches
+    from before that still have ``root/analyzed/z/x/y`` PNGs, which are read
+    as they are. ``perc``, mask slots and the LRU bookkeeping live in one
+    SQLite index shared by every worker process. Each process mirrors the
+    index in memory, so hits never touch the network or the disk beyond a
+    single stat.
+    """
+
+    def __init__(self, root, max_bytes=None, max_tiles=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_tiles = max_tiles
+        self.db_path = os.path.join(root, 'tiles.sqlite3')
+
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._index = None
+        self._index_pid = None
+        self._packs = {}
+
+    def source_path(self, z, x, y):
+        return os.path.join(self.root, 'source', str(z), str(x), str(y), 'tile.png')
+
+    def analyzed_path(self, z, x, y):
+        return os.path.join(self.root, 'analyzed', str(z), str(x), str(y), 'tile.png')
+
+    def pack_path(self, z):
+        return os.path.join(self.root, 'masks', '{}.pack'.format(int(z)))
+
+    def _pack(self, z):
+        pack = self._packs.get(int(z))
+
+        if pack is None:
+            pack = self._packs.setdefault(int(z), masks.MaskPack(self.pack_path(z)))
+
+        return pack
+
+    def source(self, z, x, y):
+        return _read_png(self.source_path(z, x, y), cv2.IMREAD_COLOR)
+
+    def packed_mask(self, z, x, y):
+        """The bit-packed mask of a cached tile, or None (also for tiles with a legacy PNG mask)."""
+        key = (int(z), int(x), int(y))
+
+        # a slot can be freed and reused while it is read; its generation then moves on and the
+        # copy is thrown away, so a reader never gets another tile's mask
+        for _ in range(3):
+            row = self._connect().execute('SELECT slot, gen FROM mask_slots WHERE z = ? AND x = ? AND y = ?',
+                                          key).fetchone()
+
+            if row is None:
+                return None
+
+            packed = self._pack(z).read(row[0])
+
+            if packed is None or self._slot_gen(key[0], row[0]) == row[1]:
+                return packed
+
+        return None
+
+    def packed_masks(self, z, xmin, xmax, ymin, ymax):
+        """``(x, y, packed)`` of every packed mask in the inclusive range, for aggregation without decoding."""
+        pack = self._pack(z)
+        query = ('SELECT x, y, slot, gen FROM mask_slots '
+                 'WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?')
+        args = (int(z), xmin, xmax, ymin, ymax)
+        rows = self._connect().execute(query, args).fetchall()
+
+        copies = [(row, pack.read(row[2])) for row in rows]
+        current = set(self._connect().execute(query, args).fetchall())
+
+        for row, packed in copies:
+            x, y = row[:2]
+
+            # moved or reused while we read it
+            if row not in current:
+                packed = self.packed_mask(z, x, y)
+
+            if packed is not None:
+                yield x, y, packed
+
+    def _slot_gen(self, z, slot):
+        row = self._connect().execute('SELECT gen FROM mask_slots WHERE z = ? AND slot = ?', (z, slot)).fetchone()
+
+        return None if row is None else row[0]
+
+    def mask(self, z, x, y):
+        packed = self.packed_mask(z, x, y)
+
+        if packed is None:
+            return _read_png(self.analyzed_path(z, x, y), cv2.IMREAD_GRAYSCALE)
+
+        return masks.unpack(packed, self._pack(z).shape)
+
+    def analyzed_png(self, z, x, y):
+        """The mask as PNG bytes, rendered from the packed bits; None if the tile is not cached."""
+        packed = self.packed_mask(z, x, y)
+
+        if packed is not None:
+            return masks.render_png(packed, self._pack(z).shape)
+
+        try:
+            with open(self.analyzed_path(z, x, y), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+
+        # never reuse a connection inherited through fork()
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.root, exist_ok=True)
+
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'z INTEGER, x INTEGER, y INTEGER, perc REAL, size INTEGER, atime REAL, '
+                         'PRIMARY KEY (z, x, y))')
+            conn.execute('CREATE INDEX IF NOT EXISTS tiles_atime ON tiles (atime)')
+
+            # per-tile statistics outlive eviction of the images, see api/vision/stats.py
+            conn.execute('CREATE TABLE IF NOT EXISTS tile_stats ('
+                         'z INTEGER, x INTEGER, y INTEGER, green INTEGER, total INTEGER, mpp REAL, analyzed_at REAL, '
+                         'PRIMARY KEY (z, x, y))')
+
+            # which slot of the zoom's pack file holds a tile's mask; free and reserved slots keep
+            # x and y NULL. gen moves on whenever a slot is reserved or freed, see put()
+            conn.execute('CREATE TABLE IF NOT EXISTS mask_slots ('
+                         'z INTEGER, slot INTEGER, x INTEGER, y INTEGER, gen INTEGER DEFAULT 0, '
+                         'reserved INTEGER DEFAULT 0, PRIMARY KEY (z, slot))')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS mask_slots_tile ON mask_slots (z, x, y)')
+
+            # slot tables created before generations were tracked
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(mask_slots)')]
+
+            for column in ('gen', 'reserved'):
+                if column not in columns:
+                    conn.execute('ALTER TABLE mask_slots ADD COLUMN {} INTEGER DEFAULT 0'.format(column))
+
+            # indexes created before ETags were tracked
+            if 'etag' not in [row[1] for row in conn.execute('PRAGMA table_info(tiles)')]:
+                conn.execute('ALTER TABLE tiles ADD COLUMN etag TEXT')
+
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def _load(self):
+        if self._index is not None and self._index_pid == os.getpid():
+            return self._index
+
+        with self._lock:
+            index = OrderedDict()
+
+            for z, x, y, perc, size, atime, etag in self._connect().execute(
+                    'SELECT z, x, y, perc, size, atime, etag FROM tiles ORDER BY atime'):
+                index[(z, x, y)] = [perc, size, atime, etag]
+
+            self._index = index
+            self._index_pid = os.getpid()
+
+        return self._index
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def get(self, z, x, y):
+        key = (int(z), int(x), int(y))
+        index = self._load()
+
+        with self._lock:
+            entry = index.get(key)
+
+            if entry is not None:
+                # another worker may have evicted the files since we indexed them
+                if not os.path.isfile(self.source_path(*key)):
+                    del index[key]
+                    return None
+
+                index.move_to_end(key)
+                now = time.time()
+
+                if now - entry[2] > TOUCH_INTERVAL:
+                    entry[2] = now
+                    self._connect().execute('UPDATE tiles SET atime = ? WHERE z = ? AND x = ? AND y = ?',
+                                            (now,) + key)
+
+                return entry[0]
+
+        # fall back to tiles written by other workers, then to the legacy perc.txt layout
+        row = self._connect().execute('SELECT perc, size, atime, etag FROM tiles WHERE z = ? AND x = ? AND y = ?',
+                                      key).fetchone()
+
+        if row is None:
+            return self._adopt_legacy(key)
+
+        if not os.path.isfile(self.source_path(*key)):
+            return None
+
+        with self._lock:
+            index[key] = list(row)
+
+        return row[0]
+
+    def _adopt_legacy(self, key):
+        perc_file = os.path.join(os.path.dirname(self.analyzed_path(*key)), 'perc.txt')
+        files = (self.source_path(*key), self.analyzed_path(*key))
+
+        if not os.path.isfile(perc_file) or not all(os.path.isfile(f) for f in files):
+            return None
+
+        with open(perc_file) as f:
+            perc = float(f.readline())
+
+        self._index_row(key, perc, sum(os.path.getsize(f) for f in files))
+        os.remove(perc_file)
+
+        return perc
+
+    def put(self, z, x, y, source, analyzed, perc):
+        key = (int(z), int(x), int(y))
+
+        size = len(_write_png(self.source_path(*key), source))
+
+        # the mask goes into a slot nobody reads yet, and the tile only points at it once it is
+        # written, so readers see the old mask or the new one, never a half-written slot
+        packed = masks.pack(analyzed)
+        slot = self._reserve_slot(key[0])
+
+        try:
+            self._pack(key[0]).write(slot, packed)
+        except BaseException:
+            self._free_slot(key[0], slot)
+            raise
+
+        self._publish_slot(key, slot)
+
+        # a mask PNG from before packing is superseded by the pack
+        _remove(self.analyzed_path(*key))
+
+        self._index_row(key, perc, size + packed.nbytes, _etag(packed.tobytes()))
+        self._record_stats(key, masks.count(packed), analyzed.size)
+        self.evict()
+
+    def _reserve_slot(self, z):
+        conn = self._connect()
+
+        # IMMEDIATE takes the write lock up front, so two workers never hand out the same slot
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            row = conn.execute('SELECT slot FROM mask_slots WHERE z = ? AND x IS NULL AND reserved = 0 LIMIT 1',
+                               (z,)).fetchone()
+
+            if row is None:
+                row = conn.execute('SELECT COALESCE(MAX(slot) + 1, 0) FROM mask_slots WHERE z = ?', (z,)).fetchone()
+                conn.execute('INSERT INTO mask_slots (z, slot, gen, reserved) VALUES (?, ?, 1, 1)', (z, row[0]))
+            else:
+                conn.execute('UPDATE mask_slots SET gen = gen + 1, reserved = 1 WHERE z = ? AND slot = ?',
+                             (z, row[0]))
+
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return row[0]
+
+    def _publish_slot(self, key, slot):
+        z, x, y = key
+        conn = self._connect()
+
+        # the tile moves to its new slot and its old one is freed in one step
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            conn.execute('UPDATE mask_slots SET x = NULL, y = NULL, gen = gen + 1 WHERE z = ? AND x = ? AND y = ?',
+                         key)
+            conn.execute('UPDATE mask_slots SET x = ?, y = ?, reserved = 0 WHERE z = ? AND slot = ?', (x, y, z, slot))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _free_slot(self, z, slot):
+        self._connect().execute('UPDATE mask_slots SET x = NULL, y = NULL, gen = gen + 1, reserved = 0 '
+                                'WHERE z = ? AND slot = ?', (z, slot))
+
+    def _record_stats(self, key, green, total):
+        z, x, y = key
+        bounds = mercantile.bounds(x, y, z)
+        mpp = getRatio(z, (bounds.north + bounds.south) / 2, 0)
+
+        self._connect().execute('INSERT OR REPLACE INTO tile_stats (z, x, y, green, total, mpp, analyzed_at) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)', key + (green, total, mpp, time.time()))
+
+    def stats(self, z, xmin, xmax, ymin, ymax):
+        """``(x, y, green, total, mpp, analyzed_at)`` of every analyzed tile in the inclusive range."""
+        return self._connect().execute('SELECT x, y, green, total, mpp, analyzed_at FROM tile_stats '
+                                       'WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?',
+                                       (int(z), xmin, xmax, ymin, ymax)).fetchall()
+
+    def etag(self, z, x, y):
+        """Strong ETag of the mask, or None if the tile is not cached."""
+        key = (int(z), int(x), int(y))
+
+        if self.get(*key) is None:
+            return None
+
+        with self._lock:
+            entry = self._load().get(key)
+
+        if entry is None:
+            return None
+
+        if entry[3] is None:
+            # only tiles adopted from the legacy layout are indexed without one
+            data = self.analyzed_png(*key)
+
+            if data is None:
+                return None
+
+            entry[3] = _etag(data)
+
+            self._connect().execute('UPDATE tiles SET etag = ? WHERE z = ? AND x = ? AND y = ?', (entry[3],) + key)
+
+        return entry[3]
+
+    def _index_row(self, key, perc, size, etag=None):
+        now = time.time()
+
+        self._connect().execute('INSERT OR REPLACE INTO tiles (z, x, y, perc, size, atime, etag) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)', key + (perc, size, now, etag))
+
+        index = self._load()
+
+        with self._lock:
+            index[key] = [perc, size, now, etag]
+            index.move_to_end(key)
+
+    def usage(self):
+        count, size = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tiles').fetchone()
+
+        return count, size
+
+    def evict(self):
+        if self.max_bytes is None and self.max_tiles is None:
+            return 0
+
+        count, size = self.usage()
+        evicted = 0
+
+        while (self.max_tiles is not None and count > self.max_tiles) or \
+                (self.max_bytes is not None and size > self.max_bytes):
+            rows = self._connect().execute('SELECT z, x, y, size FROM tiles ORDER BY atime LIMIT 64').fetchall()
+
+            if not rows:
+                break
+
+            for z, x, y, tile_size in rows:
+                if (self.max_tiles is None or count <= self.max_tiles) and \
+                        (self.max_bytes is None or size <= self.max_bytes):
+                    break
+
+                self.remove(z, x, y)
+
+                count -= 1
+                size -= tile_size
+                evicted += 1
+
+        return evicted
+
+    def remove(self, z, x, y):
+        key = (int(z), int(x), int(y))
+
+        self._connect().execute('DELETE FROM tiles WHERE z = ? AND x = ? AND y = ?', key)
+        self._connect().execute('UPDATE mask_slots SET x = NULL, y = NULL, gen = gen + 1 '
+                                'WHERE z = ? AND x = ? AND y = ?', key)
+
+        with self._lock:
+            self._load().pop(key, None)
+
+        for path in (self.source_path(*key), self.analyzed_path(*key)):
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+def _read_png(path, flags):
+    # cv2.imread() logs a warning for every missing file
+    if not os.path.isfile(path):
+        return None
+
+    return cv2.imread(path, flags)
+
+
+def _write_png(path, image):
+    ok, data = cv2.imencode('.png', image)
+
+    if not ok:
+        raise ValueError('could not encode {}'.format(path))
+
+    data = data.tobytes()
+    _write_atomic(path, data)
+
+    return data
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,136 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+
+def synthetic_tile(x, y, z, size=256):
+    """A deterministic fake satellite tile: noisy fields with a few tree-like blobs."""
+    rnd = np.random.RandomState((int(x) * 73856093 ^ int(y) * 19349663 ^ int(z) * 83492791) & 0xffffffff)
+
+    tile = rnd.randint(60, 200, (size, size, 3)).astype(np.uint8)
+
+    for _ in range(rnd.randint(3, 12)):
+        center = tuple(int(c) for c in rnd.randint(0, size, 2))
+        color = tuple(int(c) for c in (rnd.randint(20, 70), rnd.randint(60, 110), rnd.randint(20, 60)))
+        cv2.circle(tile, center, int(rnd.randint(5, 40)), color, -1)
+
+    return tile
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # a burst of parallel connects must not overflow the listen backlog
+    request_queue_size = 128
+
+
+class StandInTileServer:
+    """Local HTTP stand-in for the Google tile hosts, for tests and benchmarks.
+
+    Serves ``/vt/lyrs=s&x=..&y=..&z=..`` with keep-alive. Tiles come from
+    ``tiles`` (a ``{(x, y, z): png_bytes}`` mapping) or are synthesized.
+    ``latency`` delays every response and ``failures`` makes the first N
+    requests answer 503. With ``drop_reused`` a connection is closed,
+    unanswered, when a second request arrives on it, as servers do with
+    connections they consider idle.
+    """
+
+    url_template = 'http://{host}/vt/lyrs=s&x={x}&y={y}&z={z}'
+
+    def __init__(self, tiles=None, latency=0, failures=0, drop_reused=False):
+        self.tiles = tiles or {}
+        self.latency = latency
+        self.failures = failures
+        self.drop_reused = drop_reused
+        self.requests = 0
+        self.connections = 0
+
+        self._lock = threading.Lock()
+        self._encoded = {}
+        self._server = None
+        self._thread = None
+
+    @property
+    def host(self):
+        return '127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def tile_bytes(self, x, y, z):
+        key = (x, y, z)
+
+        if key in self.tiles:
+            return self.tiles[key]
+
+        with self._lock:
+            if key not in self._encoded:
+                self._encoded[key] = cv2.imencode('.png', synthetic_tile(x, y, z))[1].tobytes()
+
+            return self._encoded[key]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.served = 0
+
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                if server.drop_reused and self.served:
+                    self.close_connection = True
+                    return
+
+                self.served += 1
+
+                with server._lock:
+                    server.requests += 1
+                    fail = server.failures > 0
+                    server.failures -= fail
+
+                if server.latency:
+                    time.sleep(server.latency)
+
+                # the Google URLs carry their parameters in the path, not a query string
+                params = parse_qs(urlsplit(self.path).path.rsplit('/', 1)[-1])
+
+                try:
+                    body = b'' if fail else server.tile_bytes(*(int(params[k][0]) for k in 'xyz'))
+                except (KeyError, ValueError):
+                    self.send_error(404)
+                    return
+
+                self.send_response(503 if fail else 200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
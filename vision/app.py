@@ -1,87 +1,291 @@
 import os
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import boto3
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import time
+from typing import List, Optional
 from pydantic import BaseModel
-from segment_anything import SamPredictor, sam_model_registry
+from variants import load_predictor
 import cv2
 import numpy as np
-import requests
+from batch import BatchProcessor
+from embeddings import EmbeddingCache
+from jobs import Jobs
+from ledger import Ledger
+from loader import ModelLoader
+from tiling import TILE_OVERLAP, TILE_SIZE, segment_tiled
+from uploads import ChecksumMismatch, StreamReader, upload_stream
 
-app = FastAPI()
+# MinIO configuration; point MINIO_URL at any S3 compatible server (a local MinIO in tests)
+MINIO_URL = os.environ.get("MINIO_URL", "http://minio:9000")
+MINIO_BUCKET = os.environ.get("MINIO_BUCKET", "images")
+MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY", "your_access_key")
+MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY", "your_secret_key")
 
-# MinIO configuration
-MINIO_URL = "http://minio:9000"  # Adjust according to your setup
-MINIO_BUCKET = "images"
-MINIO_ACCESS_KEY = "your_access_key"
-MINIO_SECRET_KEY = "your_secret_key"
+# Backend URL for sending results; empty disables posting
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://api.ecomobile.uz/api/results")
 
-# Backend URL for sending results
-BACKEND_URL = "http://api.ecomobile.uz/api/results"
+# /api/process: parallel downloads, results posted to the backend this many per request
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "8"))
+POST_BATCH_SIZE = int(os.environ.get("POST_BATCH_SIZE", "32"))
+POST_CONCURRENCY = int(os.environ.get("POST_CONCURRENCY", "4"))
 
-# Initialize MinIO client
-s3_client = boto3.client('s3', endpoint_url=MINIO_URL,
-                          aws_access_key_id=MINIO_ACCESS_KEY,
-                          aws_secret_access_key=MINIO_SECRET_KEY)
+# Uploads stream to MinIO in parts; memory per upload stays at a few times the part size
+UPLOAD_PART_SIZE = int(os.environ.get("UPLOAD_PART_SIZE", str(8 * 2**20)))
+UPLOAD_PART_CONCURRENCY = int(os.environ.get("UPLOAD_PART_CONCURRENCY", "2"))
+UPLOAD_FILE_CONCURRENCY = int(os.environ.get("UPLOAD_FILE_CONCURRENCY", "3"))
 
-# Load SAM model
-MODEL_TYPE = "vit_h"
-sam_checkpoint = os.path.join("models", f"sam_{MODEL_TYPE}.pth")
-sam = sam_model_registry[MODEL_TYPE](checkpoint=sam_checkpoint)
-predictor = SamPredictor(sam)
+# Processed objects (key + ETag) and background jobs, so only new or changed images are processed
+LEDGER_PATH = os.environ.get("LEDGER_PATH", "ledger.sqlite3")
+
+# MinIO client, created on first use (in the worker process, not before a fork)
+@lru_cache(maxsize=None)
+def s3_client():
+    return boto3.client('s3', endpoint_url=MINIO_URL,
+                        aws_access_key_id=MINIO_ACCESS_KEY,
+                        aws_secret_access_key=MINIO_SECRET_KEY)
+
+@lru_cache(maxsize=None)
+def ledger():
+    return Ledger(LEDGER_PATH)
+
+# SAM model; vit_b with SAM_QUANTIZE=1 fits CPU-only replicas, see benchmark_variants.py
+MODEL_TYPE = os.environ.get("SAM_MODEL_TYPE", "vit_h")
+QUANTIZE = os.environ.get("SAM_QUANTIZE", "0") == "1"
+# SAM_PRELOAD=1 loads it at import; gunicorn.conf.py sets it so workers fork after the load
+SAM_PRELOAD = os.environ.get("SAM_PRELOAD", "0") == "1"
+
+# Re-prompting an image that was already encoded only runs the mask decoder
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "32"))
+EMBEDDING_SPILL_DIR = os.environ.get("EMBEDDING_SPILL_DIR")  # e.g. /tmp/embeddings
+
+def load_embeddings():
+    return EmbeddingCache(load_predictor(MODEL_TYPE, QUANTIZE), max_items=EMBEDDING_CACHE_SIZE,
+                          spill_dir=EMBEDDING_SPILL_DIR)
+
+# The predictor is not thread safe; loading and all inference run on this one thread, off the event loop
+inference_executor = ThreadPoolExecutor(1, thread_name_prefix="sam")
+
+models = ModelLoader(load_embeddings)
+if SAM_PRELOAD:
+    models.load()
+
+async def get_embeddings():
+    # requests that arrive during warm-up wait for it
+    try:
+        return await asyncio.wrap_future(models.start(inference_executor))
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"model failed to load: {e}")
+
+# /api/process segments only inside the example bounding box (use your bbox logic here). PROCESS_TILED=1
+# opts in to segmenting every image whole in overlapping windows at full resolution instead; that is many
+# encoder passes per large image, so check the throughput on your hardware before turning it on
+PROCESS_TILED = os.environ.get("PROCESS_TILED", "0") == "1"
+PROCESS_TILE_SIZE = int(os.environ.get("PROCESS_TILE_SIZE", str(TILE_SIZE)))
+PROCESS_TILE_OVERLAP = int(os.environ.get("PROCESS_TILE_OVERLAP", str(TILE_OVERLAP)))
+PROCESS_BBOX = (50, 50, 600, 400)
+
+def segmenter(embeddings):
+    if PROCESS_TILED:
+        return lambda image: segment_tiled(embeddings.predictor, image, tile=PROCESS_TILE_SIZE,
+                                           overlap=PROCESS_TILE_OVERLAP, model_type=MODEL_TYPE)[0]
+    return lambda image: embeddings.segment(image, [PROCESS_BBOX])[0]
+
+async def process(objects=None, prefix="", force=False, summary=None):
+    embeddings = await get_embeddings()
+    processor = BatchProcessor(s3_client(), MINIO_BUCKET, segmenter(embeddings),
+                               inference_executor, backend_url=BACKEND_URL or None,
+                               download_concurrency=DOWNLOAD_CONCURRENCY, post_batch_size=POST_BATCH_SIZE,
+                               post_concurrency=POST_CONCURRENCY, ledger=ledger())
+    async for result in processor.run(objects, prefix, force, summary):
+        yield result
+
+async def run_job(params, summary):
+    async for result in process(params.get("objects"), params.get("prefix", ""), params.get("force", False), summary):
+        yield result
+
+jobs = Jobs(LEDGER_PATH, run_job)
+
+@asynccontextmanager
+async def lifespan(app):
+    # runs in each worker; returns at once and the model loads in the background,
+    # so routes that don't need it are served straight away
+    models.start(inference_executor)
+    await jobs.start()
+    yield
+    await jobs.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 class InferenceResult(BaseModel):
     filename: str
     result: str
 
-@app.post("api/upload/")
-async def upload_image(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        file_name = file.filename
+class JobRequest(BaseModel):
+    prefix: str = ""
+    force: bool = False  # also process objects the ledger already holds
+
+@app.get("/health/")
+async def health():
+    return {"status": "ok"}
 
-        # Save to MinIO
-        s3_client.put_object(Bucket=MINIO_BUCKET, Key=file_name, Body=contents)
-        return JSONResponse(content={"message": "Image uploaded successfully."})
+@app.get("/ready/")
+async def ready():
+    # 503 until the model is loaded, for load balancers and readiness probes
+    return JSONResponse(status_code=200 if models.ready else 503, content={"model": MODEL_TYPE, **models.status()})
+
+async def upload(key, read, sha256=None):
+    return await upload_stream(s3_client(), MINIO_BUCKET, key, read, part_size=UPLOAD_PART_SIZE,
+                               concurrency=UPLOAD_PART_CONCURRENCY, expected_sha256=sha256)
+
+async def queue_uploaded(reports):
+    return await jobs.submit({"objects": [{"Key": r["key"], "ETag": r["etag"]} for r in reports]})
+
+@app.post("/api/upload/")
+async def upload_image(file: UploadFile = File(...), sha256: Optional[str] = Form(None), process: bool = False):
+    # with ?process=true the image is queued for processing straight away
+    try:
+        # Save to MinIO, a part at a time
+        report = await upload(file.filename, file.read, sha256)
+        content = {"message": "Image uploaded successfully.", **report}
+        if process:
+            content["job"] = await queue_uploaded([report])
+        return JSONResponse(content=content)
+    except ChecksumMismatch as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("api/process/")
-async def process_images():
+@app.put("/api/upload/{key:path}")
+async def upload_raw(key: str, request: Request, x_checksum_sha256: Optional[str] = Header(None),
+                     process: bool = False):
+    # for large orthophotos and videos: the raw body is the file and goes to MinIO as it arrives,
+    # without the temporary copy a form upload makes
     try:
-        # List all images in the bucket
-        objects = s3_client.list_objects_v2(Bucket=MINIO_BUCKET)
-        results = []
+        report = await upload(key, StreamReader(request.stream()).read, x_checksum_sha256)
+        if process:
+            report["job"] = await queue_uploaded([report])
+        return JSONResponse(content=report)
+    except ChecksumMismatch as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/upload/batch/")
+async def upload_batch(files: List[UploadFile] = File(...), checksums: Optional[str] = Form(None),
+                       process: bool = False):
+    # checksums is an optional JSON object of filename -> sha256; one failed file doesn't fail the others
+    checksums = json.loads(checksums) if checksums else {}
+    semaphore = asyncio.Semaphore(UPLOAD_FILE_CONCURRENCY)
+
+    async def upload_one(file):
+        async with semaphore:
+            try:
+                return await upload(file.filename, file.read, checksums.get(file.filename))
+            except Exception as e:
+                return {"key": file.filename, "error": str(e)}
+
+    start = time.perf_counter()
+    reports = await asyncio.gather(*(upload_one(file) for file in files))
+    seconds = time.perf_counter() - start
+
+    uploaded = [r for r in reports if "error" not in r]
+    size = sum(r["size"] for r in uploaded)
+    content = {"files": reports, "uploaded": len(uploaded), "failed": len(reports) - len(uploaded), "size": size,
+               "seconds": round(seconds, 3), "mb_per_s": round(size / 2**20 / seconds, 2) if seconds else None}
+    if process and uploaded:
+        content["job"] = await queue_uploaded(uploaded)
+    return JSONResponse(content=content)
 
-        for obj in objects.get('Contents', []):
-            file_name = obj['Key']
+@app.get("/api/process/")
+async def process_images(prefix: str = "", force: bool = False):
+    # one JSON object per line as each new or changed image finishes, then {"summary": ...}
+    await get_embeddings()  # a model that failed to load is a 503, not an error line
 
-            # Download image from MinIO
-            image_obj = s3_client.get_object(Bucket=MINIO_BUCKET, Key=file_name)
-            image_data = image_obj['Body'].read()
-            nparr = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    async def lines():
+        try:
+            async for result in process(prefix=prefix, force=force):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
 
-            # Perform inference (use your bbox logic here)
-            bbox = (50, 50, 600, 400)  # Example bounding box
-            mask = segment_frame(predictor, image, bbox)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-            # Save or process the mask as needed
-            result_text = f"Processed {file_name}"
-            results.append(InferenceResult(filename=file_name, result=result_text))
+@app.post("/api/jobs/", status_code=202)
+async def create_job(request: Optional[JobRequest] = None):
+    # the same as /api/process/, in the background
+    request = request or JobRequest()
+    return {"job": await jobs.submit({"prefix": request.prefix, "force": request.force})}
 
-            # Send results to another backend
-            requests.post(BACKEND_URL, json={"filename": file_name, "result": result_text})
+@app.get("/api/jobs/")
+async def list_jobs(limit: int = 50):
+    return {"jobs": await jobs.list(limit)}
 
-        return JSONResponse(content={"results": [result.dict() for result in results]})
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="no such job")
+    return job
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = await jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="no such job")
+    return job
+
+@app.post("/api/segment/")
+async def segment_image(file: UploadFile = File(...), boxes: str = Form(...)):
+    # boxes is a JSON list of [x0, y0, x1, y1]; send the same image again with new boxes to re-prompt
+    try:
+        boxes = json.loads(boxes)
+        image = cv2.imdecode(np.frombuffer(await file.read(), np.uint8), cv2.IMREAD_COLOR)
+        if image is None or not boxes:
+            raise HTTPException(status_code=400, detail="expected an image and at least one box")
+
+        embeddings = await get_embeddings()
+        masks = await asyncio.get_running_loop().run_in_executor(inference_executor, embeddings.segment, image, boxes)
+        pixels = image.shape[0] * image.shape[1]
+
+        return JSONResponse(content={
+            "image": embeddings.key(image),
+            "results": [{"box": box, "area": int(mask.sum()), "coverage": float(mask.sum()) / pixels}
+                        for box, mask in zip(boxes, masks)],
+            "cache": embeddings.stats(),
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def segment_frame(predictor, frame, bbox):
-    input_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-    predictor.set_image(input_frame)
-    masks, _, _ = predictor.predict(boxes=np.array([bbox]), multimask_output=False)
-    return masks[0]
+@app.post("/api/segment/tiled/")
+async def segment_image_tiled(file: UploadFile = File(...), boxes: Optional[str] = Form(None),
+                              gsd: Optional[float] = Form(None), tile: int = Form(TILE_SIZE),
+                              overlap: int = Form(TILE_OVERLAP)):
+    # large drone stills: overlapping windows at full resolution instead of one downscaled frame.
+    # boxes (JSON, image coordinates) limit the prompts; gsd in metres per pixel adds green area in m2/ha
+    try:
+        image = cv2.imdecode(np.frombuffer(await file.read(), np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise HTTPException(status_code=400, detail="expected an image")
+        if not 0 <= overlap < tile:
+            raise HTTPException(status_code=400, detail="overlap must be smaller than tile")
+
+        embeddings = await get_embeddings()
+        _, stats = await asyncio.get_running_loop().run_in_executor(
+            inference_executor, lambda: segment_tiled(embeddings.predictor, image, json.loads(boxes) if boxes else None,
+                                                      tile, overlap, gsd=gsd, model_type=MODEL_TYPE))
+        return JSONResponse(content={"filename": file.filename, **stats})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,200 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import httpx
+import numpy as np
+
+from greenness import is_green
+
+_DONE = object()
+
+class BatchProcessor:
+    """Segments every object in a bucket and streams the results as they are ready.
+
+    Listing is paginated, downloads run `download_concurrency` at a time on
+    a thread pool (boto3 blocks), and `segment(image)` runs on
+    `inference_executor`, normally a single dedicated thread that owns the
+    model. Results are posted to `backend_url` in batches of
+    `post_batch_size` over one pooled client. Bounded queues between the
+    steps keep at most a few images in memory whatever the bucket size.
+
+    With a `ledger`, objects whose key and ETag it already holds are
+    skipped, and results are recorded in it once the backend has taken them.
+    """
+
+    def __init__(self, s3, bucket, segment, inference_executor, backend_url=None, download_concurrency=8,
+                 post_batch_size=32, post_concurrency=4, queue_size=16, ledger=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.segment = segment
+        self.inference_executor = inference_executor
+        self.backend_url = backend_url
+        self.download_concurrency = download_concurrency
+        self.post_batch_size = post_batch_size
+        self.post_concurrency = post_concurrency
+        self.queue_size = queue_size
+        self.ledger = ledger
+
+    def list_objects(self, prefix=""):
+        # list_objects_v2 returns at most 1000 keys per call
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def download(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def infer(self, key, data):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"{key} is not an image")
+        mask = self.segment(image)
+        # the mask is what SAM segmented; green pixels are the vegetation inside it
+        masked = int(np.count_nonzero(mask))
+        green = int(np.count_nonzero(mask & is_green(image)))
+        return {"filename": key, "result": f"Processed {key}", "mask_pixels": masked, "green_pixels": green,
+                "coverage": green / mask.size}
+
+    async def run(self, objects=None, prefix="", force=False, summary=None):
+        """Yield one dict per object in completion order, then a summary.
+
+        `objects` (dicts with at least "Key", and "ETag" for the ledger)
+        defaults to the whole listing. `force` processes objects the ledger
+        already holds. Counts are kept in `summary` as the run goes, so a
+        caller can pass in a dict to watch its progress. If listing fails,
+        the objects listed so far are finished and then the error is raised.
+        """
+        loop = asyncio.get_running_loop()
+        io_executor = ThreadPoolExecutor(self.download_concurrency, thread_name_prefix="batch-io")
+        listed = asyncio.Queue(self.queue_size)
+        downloaded = asyncio.Queue(self.queue_size)
+        summary = summary if summary is not None else {}
+        summary.update({"listed": 0, "skipped": 0, "processed": 0, "failed": 0, "posted": 0, "post_errors": 0})
+
+        def next_new(items):
+            # pages are fetched lazily and the ledger is a database, so this runs off the loop
+            for obj in items:
+                summary["listed"] += 1
+                if self.ledger is not None and not force and self.ledger.is_current(obj["Key"], obj.get("ETag")):
+                    summary["skipped"] += 1
+                    continue
+                return obj
+            return _DONE
+
+        async def stop_downloaders():
+            for _ in range(self.download_concurrency):
+                await listed.put(_DONE)
+
+        async def lister():
+            try:
+                items = iter(objects) if objects is not None else self.list_objects(prefix)
+                while True:
+                    obj = await loop.run_in_executor(io_executor, next_new, items)
+                    if obj is _DONE: break
+                    await listed.put(obj)
+            except Exception:
+                # the downloaders still finish what was listed, then gather() below raises this in run()
+                await stop_downloaders()
+                raise
+            await stop_downloaders()
+
+        async def downloader():
+            while (obj := await listed.get()) is not _DONE:
+                try:
+                    data = await loop.run_in_executor(io_executor, self.download, obj["Key"])
+                except Exception as e:
+                    data = e
+                await downloaded.put((obj, data))
+            await downloaded.put(_DONE)
+
+        tasks = [asyncio.create_task(lister())]
+        tasks += [asyncio.create_task(downloader()) for _ in range(self.download_concurrency)]
+        poster = _Poster(self.backend_url, self.post_batch_size, self.post_concurrency, summary,
+                         self.ledger.record if self.ledger is not None else None)
+
+        try:
+            running = self.download_concurrency
+            while running:
+                item = await downloaded.get()
+                if item is _DONE:
+                    running -= 1
+                    continue
+
+                obj, data = item
+                key = obj["Key"]
+                try:
+                    if isinstance(data, Exception):
+                        raise data
+                    result = await loop.run_in_executor(self.inference_executor, self.infer, key, data)
+                    result["etag"] = obj.get("ETag")
+                except Exception as e:
+                    summary["failed"] += 1
+                    yield {"filename": key, "error": str(e)}
+                    continue
+
+                summary["processed"] += 1
+                poster.add(result)
+                yield result
+
+            await asyncio.gather(*tasks)
+            await poster.close()
+            yield {"summary": summary}
+        finally:
+            for task in tasks:
+                task.cancel()
+            await poster.abort()
+            io_executor.shutdown(wait=False, cancel_futures=True)
+
+class _Poster:
+    # batches results into pooled, concurrent POSTs; a batch of one is sent as the bare object, as before.
+    # `on_posted(batch)` runs on a thread once the backend took a batch, or straight away without a backend
+
+    def __init__(self, url, batch_size, concurrency, summary, on_posted=None):
+        self.url = url
+        self.batch_size = batch_size
+        self.summary = summary
+        self.on_posted = on_posted
+        self.pending = []
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) if url else None
+
+    def add(self, result):
+        if self.client is None and self.on_posted is None:
+            return
+        self.pending.append(result)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self.post(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def post(self, batch):
+        async with self.semaphore:
+            if self.client is not None:
+                try:
+                    response = await self.client.post(self.url, json=batch[0] if len(batch) == 1 else batch)
+                    response.raise_for_status()
+                    self.summary["posted"] += len(batch)
+                except httpx.HTTPError:
+                    self.summary["post_errors"] += len(batch)
+                    return
+            if self.on_posted is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.on_posted, batch)
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def abort(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
@@ -0,0 +1,108 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+REFERENCE = "vit_h"
+DEFAULT_VARIANTS = "vit_h,vit_l,vit_b,vit_h:int8,vit_l:int8,vit_b:int8"
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def default_box(image):
+    # the middle 80% of the frame, like the fixed prompts the service uses
+    height, width = image.shape[:2]
+    return [width * 0.1, height * 0.1, width * 0.9, height * 0.9]
+
+def run_variant(variant, paths, threads, masks_path):
+    # runs in a fresh process, so its peak RSS is this variant's alone
+    import torch
+    from inference import segment_boxes
+    from variants import load_predictor
+
+    if threads:
+        torch.set_num_threads(threads)
+    model_type, _, precision = variant.partition(":")
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    predictor = load_predictor(model_type, quantize=precision == "int8")
+    load_s = time.perf_counter() - start
+    loaded = peak_rss_mb()
+
+    encode, decode, masks = [], [], {}
+    for path in paths:
+        image = cv2.imread(path)
+        start = time.perf_counter()
+        predictor.set_image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        encode.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        masks[os.path.basename(path)] = segment_boxes(predictor, [default_box(image)])[0]
+        decode.append(time.perf_counter() - start)
+    np.savez_compressed(masks_path, **masks)
+
+    return {
+        "variant": variant,
+        "load_s": round(load_s, 2),
+        "encode_ms": round(1000 * float(np.median(encode)), 1),
+        "decode_ms": round(1000 * float(np.median(decode)), 1),
+        "model_rss_mb": round(loaded - baseline),
+        "peak_rss_mb": round(peak_rss_mb()),
+    }
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+def benchmark(image_dir, variants, threads=None, limit=None):
+    paths = sorted(p for ext in ("jpg", "jpeg", "png") for p in glob.glob(os.path.join(image_dir, f"*.{ext}")))[:limit]
+    if not paths:
+        raise SystemExit(f"no images in {image_dir}")
+    if REFERENCE not in variants:
+        variants = [REFERENCE] + variants
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for variant in variants:
+            masks_path = os.path.join(tmp, variant.replace(":", "_") + ".npz")
+            # one process per variant, started clean rather than forked from a process holding torch
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results.append(executor.submit(run_variant, variant, paths, threads, masks_path).result())
+            results[-1]["masks"] = masks_path
+
+        reference = np.load(next(r["masks"] for r in results if r["variant"] == REFERENCE))
+        for result in results:
+            masks = np.load(result.pop("masks"))
+            scores = [iou(masks[name], reference[name]) for name in reference.files]
+            result["iou_mean"] = round(float(np.mean(scores)), 4)
+            result["iou_min"] = round(float(np.min(scores)), 4)
+
+    return {"images": len(paths), "threads": threads, "reference": REFERENCE, "results": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency, memory and mask IoU of SAM variants against vit_h.")
+    parser.add_argument("images", help="directory with a fixed set of test images")
+    parser.add_argument("--variants", default=DEFAULT_VARIANTS, help="comma separated, :int8 for the quantized encoder")
+    parser.add_argument("--threads", type=int, help="torch threads per variant (default: torch's choice)")
+    parser.add_argument("--limit", type=int, help="use only the first N images")
+    parser.add_argument("--output", help="also write the report as JSON here")
+    args = parser.parse_args()
+
+    report = benchmark(args.images, args.variants.split(","), args.threads, args.limit)
+    print(f"{'variant':<12}{'load s':>8}{'encode ms':>11}{'decode ms':>11}{'model MB':>10}{'peak MB':>9}"
+          f"{'IoU mean':>10}{'IoU min':>9}")
+    for r in report["results"]:
+        print(f"{r['variant']:<12}{r['load_s']:>8}{r['encode_ms']:>11}{r['decode_ms']:>11}{r['model_rss_mb']:>10}"
+              f"{r['peak_rss_mb']:>9}{r['iou_mean']:>10}{r['iou_min']:>9}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -1,16 +1,18 @@
-import os
-import torch
+import sys
+
+from variants import download_checkpoint, load_sam
 
-MODEL_DIR = "models"
 MODEL_TYPE = "vit_h"
 
-def download_model(model_type=MODEL_TYPE):
-    os.makedirs(MODEL_DIR, exist_ok=True)
-    model_path = os.path.join(MODEL_DIR, f"sam_{model_type}.pth")
-    if not os.path.exists(model_path):
-        url = f"https://dl.fbaipublicfiles.com/segment_anything/sam_{model_type}.pth"
-        torch.hub.download_url_to_file(url, model_path)
+def download_model(model_type=MODEL_TYPE, quantize=False):
+    model_path = download_checkpoint(model_type)
+    if quantize:
+        # builds and caches the int8 weights now rather than on the first request
+        load_sam(model_type, quantize=True)
     return model_path
 
 if __name__ == "__main__":
-    download_model()
\ No newline at end of file
+    # python download_pretrained_model.py [vit_b|vit_l|vit_h ...] [--int8]
+    types = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or [MODEL_TYPE]
+    for model_type in types:
+        print(download_model(model_type, quantize="--int8" in sys.argv))
\ No newline at end of file
@@ -0,0 +1,102 @@
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from inference import segment_boxes, use_features
+
+class EmbeddingCache:
+    """SAM image embeddings keyed by a hash of the image, so re-prompting skips the encoder.
+
+    The newest `max_items` embeddings stay in memory (about 4 MB each). With
+    `spill_dir`, older ones move to .npy files there and are memory-mapped
+    back on a hit (a CPU predictor uses the mapping as is, a GPU one gets a
+    copy on the device); at most `max_spill` files are kept.
+    """
+
+    def __init__(self, predictor, max_items=32, spill_dir=None, max_spill=512):
+        self.predictor = predictor
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.max_spill = max_spill
+        self.hits = self.spill_hits = self.misses = 0
+
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()
+        self._spilled = OrderedDict()
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            # embeddings spilled by an earlier run are still good
+            for path in sorted(glob.glob(os.path.join(spill_dir, "*.npy")), key=os.path.getmtime):
+                key, original, resized = os.path.basename(path)[:-4].split("-")
+                self._spilled[key] = (path, _size(original), _size(resized))
+
+    @staticmethod
+    def key(frame):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{frame.shape}{frame.dtype}".encode())
+        digest.update(np.ascontiguousarray(frame).data)
+        return digest.hexdigest()
+
+    def set_image(self, frame):
+        # `frame` is BGR as OpenCV reads it; leaves the predictor ready for predict()
+        key = self.key(frame)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            elif key in self._spilled:
+                self._spilled.move_to_end(key)
+                path, original_size, input_size = self._spilled[key]
+                # copy-on-write, so the tensor may be written to without touching the file
+                features = torch.from_numpy(np.load(path, mmap_mode="c")).to(self.predictor.device)
+                entry = self._remember(key, (features, original_size, input_size))
+                self.spill_hits += 1
+            else:
+                self.predictor.set_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                entry = self._remember(key, (self.predictor.features, self.predictor.original_size,
+                                             self.predictor.input_size))
+                self.misses += 1
+            use_features(self.predictor, *entry)
+        return key
+
+    def segment(self, frame, boxes):
+        """One mask per box; only the first prompt on an image pays for the encoder."""
+        with self._lock:
+            self.set_image(frame)
+            return segment_boxes(self.predictor, boxes)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        while len(self._memory) > self.max_items:
+            self._spill(*self._memory.popitem(last=False))
+        return entry
+
+    def _spill(self, key, entry):
+        # an embedding read back from disk is still there
+        if not self.spill_dir or key in self._spilled:
+            return
+        features, original_size, input_size = entry
+        path = os.path.join(self.spill_dir, f"{key}-{original_size[0]}x{original_size[1]}-"
+                                            f"{input_size[0]}x{input_size[1]}.npy")
+        np.save(path, features.detach().cpu().numpy())
+        self._spilled[key] = (path, original_size, input_size)
+        while len(self._spilled) > self.max_spill:
+            old, _, _ = self._spilled.popitem(last=False)[1]
+            os.remove(old)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "spill_hits": self.spill_hits, "misses": self.misses,
+                    "in_memory": len(self._memory), "spilled": len(self._spilled)}
+
+def _size(text):
+    height, width = text.split("x")
+    return int(height), int(width)
@@ -0,0 +1,18 @@
+import numpy as np
+
+def is_green(image):
+    # the API's check_green test on BGR pixels: green is not below both red and blue, nor more than 10 below
+    # either; in int16, so there is no uint8 wraparound
+    b, g, r = (image[..., i].astype(np.int16) for i in range(3))
+    return ((g >= r) | (g >= b)) & (g + 10 >= r) & (g + 10 >= b)
+
+def green_stats(green_pixels, mask_pixels, pixels, gsd=None):
+    # green pixels are the vegetation inside the mask; gsd is the ground sample distance in metres per pixel,
+    # when the image is georeferenced
+    stats = {"pixels": pixels, "mask_pixels": mask_pixels, "green_pixels": green_pixels,
+             "mask_fraction": round(mask_pixels / pixels, 6) if pixels else 0.0,
+             "green_fraction": round(green_pixels / pixels, 6) if pixels else 0.0}
+    if gsd:
+        stats["green_m2"] = round(green_pixels * gsd * gsd, 2)
+        stats["green_ha"] = round(green_pixels * gsd * gsd / 10000, 4)
+    return stats
@@ -0,0 +1,11 @@
+import os
+
+# The app (and with it the SAM weights) is imported once in the master and the
+# workers are forked afterwards, so they share the loaded model copy-on-write
+# instead of each loading their own.
+os.environ.setdefault("SAM_PRELOAD", "1")
+preload_app = True
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
@@ -2,25 +2,112 @@ import os
 import cv2
 import torch
 import numpy as np
-from segment_anything import SamPredictor, sam_model_registry
+from pipeline import run_pipeline
+from variants import load_predictor
 
-def load_sam_model(model_type="vit_h"):
-    model_path = os.path.join("models", f"sam_{model_type}.pth")
-    sam = sam_model_registry[model_type](checkpoint=model_path)
-    return SamPredictor(sam)
+# Rough peak memory of one 1024x1024 frame in the image encoder; the global
+# attention blocks dominate (heads x 4096 x 4096 float32 scores, twice over).
+FRAME_MEMORY = {"vit_h": 2200 * 2**20, "vit_l": 2200 * 2**20, "vit_b": 1700 * 2**20}
+MAX_BATCH_SIZE = 16
+
+# memory limit and usage files of the container's cgroup, v2 first, then v1
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_MEMORY_FILES = [("memory.max", "memory.current"),
+                       ("memory/memory.limit_in_bytes", "memory/memory.usage_in_bytes")]
+
+def load_sam_model(model_type="vit_h", quantize=False):
+    return load_predictor(model_type, quantize)
 
 def segment_frame(predictor, frame, bbox):
-    input_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-    predictor.set_image(input_frame)
-    masks, _, _ = predictor.predict(boxes=np.array([bbox]), multimask_output=False)
-    return masks[0]
+    predictor.set_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    return segment_boxes(predictor, [bbox])[0]
+
+def segment_boxes(predictor, boxes, logits=False):
+    # every box against the image already set on the predictor, in one mask-decoder pass;
+    # with `logits` the masks are left unthresholded (> 0 is inside)
+    boxes = torch.as_tensor(np.array(boxes, dtype=np.float32), device=predictor.device)
+    boxes = predictor.transform.apply_boxes_torch(boxes, predictor.original_size)
+    masks, _, _ = predictor.predict_torch(None, None, boxes=boxes, multimask_output=False, return_logits=logits)
+    return masks[:, 0].cpu().numpy()
+
+def available_memory(device):
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    # the host's free RAM, unless the container is held to less
+    free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    allowed = cgroup_memory_available()
+    return free if allowed is None else min(free, allowed)
+
+def cgroup_memory_available(root=CGROUP_ROOT):
+    # what the cgroup may still allocate, or None without a memory limit
+    for limit_file, usage_file in CGROUP_MEMORY_FILES:
+        limit, usage = _read_bytes(os.path.join(root, limit_file)), _read_bytes(os.path.join(root, usage_file))
+        if limit is not None and usage is not None:
+            return max(0, limit - usage)
+    return None
+
+def _read_bytes(path):
+    try:
+        with open(path) as f:
+            text = f.read().strip()
+    except OSError:
+        return None
+    # cgroup v2 writes "max" for no limit
+    return None if text == "max" else int(text)
+
+def auto_batch_size(predictor, model_type="vit_h", fraction=0.5):
+    # frames per encoder batch that fit in `fraction` of the memory free right now
+    budget = available_memory(predictor.device) * fraction
+    return int(max(1, min(MAX_BATCH_SIZE, budget // FRAME_MEMORY.get(model_type, FRAME_MEMORY["vit_h"]))))
+
+def encode_frames(predictor, frames):
+    # the same preprocessing as SamPredictor.set_image, but one encoder pass for all frames;
+    # frames of one video share a size, so their transformed tensors stack
+    images = [predictor.transform.apply_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in frames]
+    batch = torch.as_tensor(np.stack(images), device=predictor.device).permute(0, 3, 1, 2).contiguous()
+    with torch.inference_mode():
+        features = predictor.model.image_encoder(predictor.model.preprocess(batch))
+    return features, tuple(batch.shape[-2:])
+
+def use_features(predictor, features, original_size, input_size):
+    # what set_torch_image leaves behind, so predict() can run on a precomputed embedding
+    predictor.reset_image()
+    predictor.features = features
+    predictor.original_size = original_size
+    predictor.input_size = input_size
+    predictor.is_image_set = True
+
+def segment_batch(predictor, frames, bbox):
+    features, input_size = encode_frames(predictor, frames)
+    masks = []
+    for i, frame in enumerate(frames):
+        use_features(predictor, features[i:i + 1], frame.shape[:2], input_size)
+        masks.append(segment_boxes(predictor, [bbox])[0])
+    predictor.reset_image()
+    return masks
 
 def overlay_mask(frame, mask, color=(0, 255, 0), alpha=0.6):
     mask_rgb = np.zeros_like(frame)
     mask_rgb[:, :, 1] = mask * 255
     return cv2.addWeighted(frame, 1, mask_rgb, alpha, 0)
 
-def process_video(input_video, output_video, model_type="vit_h", bbox=(50, 50, 600, 400)):
+def read_frames(cap, count):
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret: break
+        frames.append(frame)
+    return frames
+
+def read_batches(cap, batch_size):
+    while True:
+        frames = read_frames(cap, batch_size)
+        if not frames: return
+        yield frames
+
+def process_video(input_video, output_video, model_type="vit_h", bbox=(50, 50, 600, 400), batch_size=None, depth=2,
+                  quantize=False):
     cap = cv2.VideoCapture(input_video)
     if not cap.isOpened(): raise IOError("Error opening video file")
 
@@ -29,19 +116,28 @@ def process_video(input_video, output_video, model_type="vit_h", bbox=(50, 50, 6
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     out = cv2.VideoWriter(output_video, cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_width, frame_height))
 
-    predictor = load_sam_model(model_type)
+    predictor = load_sam_model(model_type, quantize)
+    batch_size = batch_size or auto_batch_size(predictor, model_type)
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret: break
-        mask = segment_frame(predictor, frame, bbox)
-        out.write(overlay_mask(frame, mask))
-    
-    cap.release()
-    out.release()
+    def infer(frames):
+        return list(zip(frames, segment_batch(predictor, frames, bbox)))
+
+    def encode(segmented):
+        for frame, mask in segmented:
+            out.write(overlay_mask(frame, mask))
+
+    # decoding, inference and overlay/encoding overlap, each on its own thread
+    try:
+        wall, stats = run_pipeline(read_batches(cap, batch_size), [("infer", infer), ("encode", encode)], depth=depth)
+    finally:
+        cap.release()
+        out.release()
+
+    return {"wall_s": round(wall, 3), "frames_per_s": round(stats[0].frames / wall, 2) if wall else None,
+            "batch_size": batch_size, "stages": [stat.as_dict() for stat in stats]}
 
 if __name__ == "__main__":
-    input_video = "./videos/0012.MP4"  
+    input_video = "./videos/0012.MP4"
     output_video = "output/res_0012.mp4"
     bbox = (50, 50, 600, 400)  # Modify as needed
-    process_video(input_video, output_video, bbox=bbox)
\ No newline at end of file
+    print(process_video(input_video, output_video, bbox=bbox))
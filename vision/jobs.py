@@ -0,0 +1,218 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ledger import connect
+
+MAX_ERRORS = 20
+MAX_ATTEMPTS = 3  # claims of a job whose worker died before it is given up on
+
+COLUMNS = "id, status, params, progress, errors, error, cancel, created, started, finished, owner, attempts"
+
+class Jobs:
+    """Background processing jobs, kept in SQLite and run one at a time by each worker.
+
+    `run(params, summary)` returns the async iterator of one job's results
+    (BatchProcessor.run) and keeps its counts in `summary`. `submit` only
+    adds a queued row; every worker polls the table and claims the oldest
+    one, so jobs outlive the worker that accepted them. A running job's
+    worker renews its claim every `progress_interval` seconds, which is
+    also how often progress is saved and a cancel from another worker is
+    seen. A job whose worker went quiet for `stale_after` seconds (it was
+    killed or the host restarted) is queued again, and fails after
+    MAX_ATTEMPTS. On a clean shutdown running jobs go straight back.
+
+    The connection is used from one thread of its own, never on the loop.
+    """
+
+    def __init__(self, path, run, progress_interval=1.0, poll_interval=1.0, stale_after=30.0):
+        self.path = path
+        self.run = run
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._db = None
+        self._executor = None
+        self._worker = None
+        self._submitted = None
+        self._stopping = False
+        self._running = {}
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _execute(self, sql, args=()):
+        return await self._call(lambda: self._db.execute(sql, args).fetchall())
+
+    def _transaction(self, fn, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same row
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return result
+
+    async def start(self):
+        # needs the running loop, and the connection must not cross a fork, so call it at startup
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="jobs-db")
+        self._db = await self._call(connect, self.path)
+        await self._call(self._transaction, self._create)
+        self._submitted = asyncio.Event()
+        self._worker = asyncio.create_task(self._work())
+
+    def _create(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id TEXT PRIMARY KEY, status TEXT, params TEXT, progress TEXT, errors TEXT, error TEXT,"
+                         "cancel INTEGER DEFAULT 0, created REAL, started REAL, finished REAL)")
+        # tables from before jobs were claimed
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for name, kind in (("owner", "TEXT"), ("heartbeat", "REAL"), ("attempts", "INTEGER DEFAULT 0")):
+            if name not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._stopping = True
+        self._worker.cancel()
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(self._worker, *self._running.values(), return_exceptions=True)
+        # what this worker was running is picked up by the next one
+        await self._execute("UPDATE jobs SET status = 'queued', owner = NULL, attempts = attempts - 1 "
+                            "WHERE owner = ? AND status = 'running'", (self.owner,))
+        await self._call(self._db.close)
+        self._executor.shutdown()
+
+    async def submit(self, params):
+        job_id = uuid.uuid4().hex
+        await self._execute("INSERT INTO jobs (id, status, params, progress, errors, created) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (job_id, "queued", json.dumps(params), "{}", "[]", time.time()))
+        self._submitted.set()
+        return job_id
+
+    async def get(self, job_id):
+        rows = await self._execute(f"SELECT {COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+        return self._as_dict(rows[0]) if rows else None
+
+    async def list(self, limit=50):
+        rows = await self._execute(f"SELECT {COLUMNS} FROM jobs ORDER BY created DESC LIMIT ?", (limit,))
+        return [self._as_dict(row) for row in rows]
+
+    async def cancel(self, job_id):
+        # a queued job never starts; a running one here stops at once, elsewhere at its next heartbeat
+        await self._execute("UPDATE jobs SET status = 'cancelled', cancel = 1, finished = ? "
+                            "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        await self._execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        if job_id in self._running:
+            self._running[job_id].cancel()
+        return await self.get(job_id)
+
+    @staticmethod
+    def _as_dict(row):
+        job_id, status, params, progress, errors, error, cancel, created, started, finished, owner, attempts = row
+        return {"id": job_id, "status": status, "params": json.loads(params), "progress": json.loads(progress),
+                "errors": json.loads(errors), "error": error, "cancel_requested": bool(cancel),
+                "created": created, "started": started, "finished": finished, "worker": owner,
+                "attempts": attempts}
+
+    def _claim(self):
+        now = time.time()
+        stale = now - self.stale_after
+        # jobs whose worker stopped renewing its claim: cancelled ones are done, others are given another go
+        orphaned = "status = 'running' AND COALESCE(heartbeat, 0) < ?"
+        self._db.execute(f"UPDATE jobs SET status = 'cancelled', finished = ? WHERE {orphaned} AND cancel = 1",
+                         (now, stale))
+        self._db.execute(f"UPDATE jobs SET status = 'failed', error = 'interrupted', finished = ? "
+                         f"WHERE {orphaned} AND attempts >= ?", (now, stale, MAX_ATTEMPTS))
+        self._db.execute(f"UPDATE jobs SET status = 'queued', owner = NULL WHERE {orphaned}", (stale,))
+
+        row = self._db.execute("SELECT id, params FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE jobs SET status = 'running', owner = ?, started = ?, heartbeat = ?, "
+                         "attempts = attempts + 1 WHERE id = ?", (self.owner, now, now, row[0]))
+        return row[0], json.loads(row[1])
+
+    def _beat(self, job_id):
+        # False once the job was cancelled or handed to another worker
+        self._db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                         (time.time(), job_id, self.owner))
+        row = self._db.execute("SELECT cancel FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                               (job_id, self.owner)).fetchone()
+        return row is not None and not row[0]
+
+    async def _save(self, job_id, summary, errors):
+        await self._execute("UPDATE jobs SET progress = ?, errors = ? WHERE id = ? AND owner = ?",
+                            (json.dumps(summary), json.dumps(errors), job_id, self.owner))
+
+    async def _finish(self, job_id, status, error=None):
+        await self._execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ? AND owner = ?",
+                            (status, error, time.time(), job_id, self.owner))
+
+    async def _work(self):
+        while True:
+            self._submitted.clear()
+            claimed = await self._call(self._transaction, self._claim)
+            if claimed is None:
+                # woken early by a submit here; jobs submitted by other workers are found by polling
+                try:
+                    await asyncio.wait_for(self._submitted.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, params = claimed
+            task = self._running[job_id] = asyncio.create_task(self._run_job(job_id, params))
+            heartbeat = asyncio.create_task(self._heartbeat(job_id, task))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if self._stopping or not task.cancelled():
+                    raise
+                # cancelled before it got going
+                await self._finish(job_id, "cancelled")
+            finally:
+                heartbeat.cancel()
+                del self._running[job_id]
+
+    async def _heartbeat(self, job_id, task):
+        # separate from progress, so a single long image doesn't make the job look orphaned
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if not await self._call(self._beat, job_id):
+                task.cancel()
+                return
+
+    async def _run_job(self, job_id, params):
+        summary, errors = {}, []
+        saved = time.monotonic()
+        results = self.run(params, summary)
+        try:
+            async for result in results:
+                if "error" in result:
+                    errors = (errors + [result])[-MAX_ERRORS:]
+                if time.monotonic() - saved >= self.progress_interval:
+                    await self._save(job_id, summary, errors)
+                    saved = time.monotonic()
+            await self._save(job_id, summary, errors)
+            await self._finish(job_id, "done")
+        except asyncio.CancelledError:
+            await self._save(job_id, summary, errors)
+            if self._stopping:
+                raise  # stop() puts it back in the queue
+            await self._finish(job_id, "cancelled")
+        except Exception as e:
+            await self._save(job_id, summary, errors)
+            await self._finish(job_id, "failed", str(e))
+        finally:
+            await results.aclose()
@@ -0,0 +1,59 @@
+import json
+import sqlite3
+import threading
+import time
+
+def connect(path):
+    # several gunicorn workers share the file; WAL lets them read while one writes
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class Ledger:
+    """Which bucket objects have been processed, by key and ETag.
+
+    An object is current while its ETag matches the recorded one, so a
+    re-upload with new content is processed again and an unchanged one is
+    skipped.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                         "key TEXT PRIMARY KEY, etag TEXT, result TEXT, processed_at REAL)")
+
+    def is_current(self, key, etag):
+        with self._lock:
+            row = self._db.execute("SELECT etag FROM objects WHERE key = ?", (key,)).fetchone()
+        return row is not None and etag is not None and row[0] == etag
+
+    def record(self, results):
+        # `results` are the dicts BatchProcessor yields, with "filename" and "etag"
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                                 [(r["filename"], r.get("etag"), json.dumps(r), now) for r in results])
+            self._db.execute("COMMIT")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM objects WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def forget(self, key=None):
+        # one key, or everything when `key` is None
+        with self._lock:
+            if key is None:
+                self._db.execute("DELETE FROM objects")
+            else:
+                self._db.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def close(self):
+        self._db.close()
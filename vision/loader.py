@@ -0,0 +1,56 @@
+import threading
+import time
+from concurrent.futures import Future
+
+class ModelLoader:
+    """Runs `load()` once, either right away or in the background, and reports how far it got.
+
+    `load()` blocks the calling thread; use it before forking workers so they
+    share what was loaded. `start(executor)` loads on the executor instead
+    and returns at once. Either way `future` resolves to what `load()`
+    returned, or to its error.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self.future = None
+        self.started = self.load_s = None
+
+    def _timed(self):
+        start = time.perf_counter()
+        try:
+            return self._load()
+        finally:
+            self.load_s = round(time.perf_counter() - start, 2)
+
+    def load(self):
+        with self._lock:
+            if self.future is None:
+                self.started = time.time()
+                self.future = Future()
+                try:
+                    self.future.set_result(self._timed())
+                except Exception as e:
+                    self.future.set_exception(e)
+        return self.future.result()
+
+    def start(self, executor):
+        with self._lock:
+            if self.future is None:
+                self.started = time.time()
+                self.future = executor.submit(self._timed)
+        return self.future
+
+    @property
+    def ready(self):
+        return self.future is not None and self.future.done() and self.future.exception() is None
+
+    def status(self):
+        if self.future is None:
+            return {"state": "idle"}
+        if not self.future.done():
+            return {"state": "loading", "elapsed_s": round(time.time() - self.started, 2)}
+        if self.future.exception() is not None:
+            return {"state": "failed", "error": str(self.future.exception())}
+        return {"state": "ready", "load_s": self.load_s}
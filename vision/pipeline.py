@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.frames = 0
+        self.busy = 0.0     # doing the stage's own work
+        self.starved = 0.0  # waiting for the stage before
+        self.blocked = 0.0  # waiting for room in the queue after (backpressure)
+
+    def as_dict(self):
+        return {"stage": self.name, "items": self.items, "frames": self.frames,
+                "busy_s": round(self.busy, 3), "starved_s": round(self.starved, 3),
+                "blocked_s": round(self.blocked, 3),
+                "frames_per_s": round(self.frames / self.busy, 2) if self.busy else None}
+
+def run_pipeline(source, stages, depth=2, size=len):
+    """Run `source` (an iterable) and each `(name, fn)` of `stages` on its own thread.
+
+    Stages are joined by queues of `depth` items, so a fast stage waits for a
+    slow one instead of piling up frames in memory. The last stage's return
+    values are dropped. `size(item)` counts frames for the stats. Returns
+    the wall time and one StageStats per stage; the first error raised by
+    any stage stops the others and is re-raised here.
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=depth) for _ in stages]
+    stats = [StageStats("decode")] + [StageStats(name) for name, _ in stages]
+
+    def put(q, item, stat):
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stat.blocked += time.perf_counter() - start
+
+    def get(q, stat):
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        else:
+            item = _DONE
+        stat.starved += time.perf_counter() - start
+        return item
+
+    def produce():
+        stat = stats[0]
+        try:
+            items = iter(source)
+            while not stop.is_set():
+                start = time.perf_counter()
+                item = next(items, _DONE)
+                stat.busy += time.perf_counter() - start
+                if item is _DONE: break
+                stat.items += 1
+                stat.frames += size(item)
+                put(queues[0], item, stat)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(queues[0], _DONE, stat)
+
+    def work(i, fn):
+        stat = stats[i + 1]
+        try:
+            while True:
+                item = get(queues[i], stat)
+                if item is _DONE: break
+                start = time.perf_counter()
+                result = fn(item)
+                stat.busy += time.perf_counter() - start
+                stat.items += 1
+                stat.frames += size(item)
+                if i + 1 < len(stages):
+                    put(queues[i + 1], result, stat)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if i + 1 < len(stages):
+                put(queues[i + 1], _DONE, stat)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=produce, name="pipeline-decode", daemon=True)]
+    threads += [threading.Thread(target=work, args=(i, fn), name=f"pipeline-{name}", daemon=True)
+                for i, (name, fn) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start, stats
@@ -1,18 +1,14 @@
 import cv2
-import torch
-import os
-from segment_anything import SamPredictor, sam_model_registry
-import numpy as np
+import time
+from variants import load_predictor
+from inference import auto_batch_size, overlay_mask, read_frames, segment_batch
 
 # Load the SAM model
-def load_model(model_type="vit_h"):
-    model_path = os.path.join("models", f"sam_{model_type}.pth")
-    sam = sam_model_registry[model_type](checkpoint=model_path)
-    sam_predictor = SamPredictor(sam)
-    return sam_predictor
+def load_model(model_type="vit_h", quantize=False):
+    return load_predictor(model_type, quantize)
 
-# Process each frame of the video and perform tree segmentation
-def segment_trees_in_video(video_path, output_path, model_type="vit_h"):
+# Process the video in batches of frames and perform tree segmentation
+def segment_trees_in_video(video_path, output_path, model_type="vit_h", batch_size=None):
     # Load the video
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
@@ -30,36 +26,32 @@ def segment_trees_in_video(video_path, output_path, model_type="vit_h"):
     # Load the SAM predictor
     predictor = load_model(model_type)
 
+    # As many frames per encoder pass as fit in memory
+    batch_size = batch_size or auto_batch_size(predictor, model_type)
+    boxes = [50, 50, frame_width - 50, frame_height - 50]  # Example of a bounding box
+
     frame_num = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
+    start = time.perf_counter()
+    while True:
+        frames = read_frames(cap, batch_size)
+        if not frames:
             break
 
-        # Convert the frame to a format suitable for SAM (RGB and normalize)
-        input_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        input_frame = input_frame.astype(np.float32) / 255.0
-
-        # Predict the segmentation for the frame (Use a dummy prompt, you may fine-tune this later)
-        predictor.set_image(input_frame)
-        boxes = np.array([[50, 50, frame_width - 50, frame_height - 50]])  # Example of a bounding box
-        masks, _, _ = predictor.predict(boxes=boxes, multimask_output=False)
-
-        # Overlay the mask on the original frame
-        mask = masks[0]
-        mask_rgb = np.zeros_like(frame)
-        mask_rgb[:, :, 1] = mask * 255  # Green mask
-        overlaid_frame = cv2.addWeighted(frame, 1, mask_rgb, 0.6, 0)
+        # The encoder runs once for the whole batch, the mask decoder once per frame
+        masks = segment_batch(predictor, frames, boxes)
 
-        # Write the processed frame to the output video
-        out.write(overlaid_frame)
+        for frame, mask in zip(frames, masks):
+            # Overlay the mask on the original frame and write it to the output video
+            out.write(overlay_mask(frame, mask))
 
-        frame_num += 1
-        print(f"Processed frame {frame_num}")
+            frame_num += 1
+            print(f"Processed frame {frame_num}")
 
     cap.release()
     out.release()
-    print(f"Tree segmentation completed and saved to {output_path}")
+    elapsed = time.perf_counter() - start
+    print(f"Tree segmentation completed and saved to {output_path} "
+          f"({frame_num / elapsed:.2f} frames/s, batch size {batch_size})")
 
 if __name__ == "__main__":
     video_path = "./videos/0012.MP4"  
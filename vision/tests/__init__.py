@@ -0,0 +1,6 @@
+"""Tests of the vision service. Run them from vision/:
+
+    python -m unittest discover -s tests -t .
+
+Models, S3 and the backend are replaced by the stubs in tests/stubs.py.
+"""
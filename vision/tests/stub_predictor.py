@@ -0,0 +1,48 @@
+import torch
+
+
+class StubPredictor:
+    """Just enough of SamPredictor for inference.py, without a model.
+
+    The "encoder" averages each image's channels and the "decoder" fills
+    every box prompt, so the masks it returns are easy to predict.
+    """
+
+    def __init__(self):
+        self.device = torch.device("cpu")
+        self.transform = self.model = self
+        self.encoder_calls = 0
+        self.encoded = 0
+        self.reset_image()
+
+    def apply_image(self, image):
+        return image
+
+    def apply_boxes_torch(self, boxes, original_size):
+        return boxes
+
+    def preprocess(self, batch):
+        return batch.float()
+
+    def image_encoder(self, batch):
+        self.encoder_calls += 1
+        self.encoded += len(batch)
+        return batch.mean(dim=1, keepdim=True)
+
+    def set_image(self, image):
+        batch = torch.as_tensor(image[None]).permute(0, 3, 1, 2).contiguous()
+        self.reset_image()
+        self.features = self.image_encoder(self.preprocess(batch))
+        self.original_size = self.input_size = image.shape[:2]
+        self.is_image_set = True
+
+    def reset_image(self):
+        self.features = self.original_size = self.input_size = None
+        self.is_image_set = False
+
+    def predict_torch(self, point_coords, point_labels, boxes=None, multimask_output=True, return_logits=False):
+        height, width = self.original_size
+        masks = torch.full((len(boxes), 1, height, width), -8.0)
+        for i, (x0, y0, x1, y1) in enumerate(boxes.int().tolist()):
+            masks[i, 0, y0:y1, x0:x1] = 8.0
+        return (masks if return_logits else masks > 0), None, None
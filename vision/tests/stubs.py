@@ -0,0 +1,75 @@
+import base64
+import hashlib
+import io
+import threading
+import time
+
+
+class StubS3:
+    """An in-memory bucket with the boto3 S3 client calls the service makes.
+
+    `fail_listing_after` makes listing raise once that many pages were
+    returned, and `fail_part` makes that part number of a multipart upload
+    fail.
+    """
+
+    def __init__(self, objects=None, page_size=1000, fail_listing_after=None, fail_part=None):
+        self.objects = dict(objects or {})
+        self.page_size = page_size
+        self.fail_listing_after = fail_listing_after
+        self.fail_part = fail_part
+        self.downloads = []
+        self.uploads = {}
+        self.aborted = []
+        self.in_flight = self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def etag(data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for page, start in enumerate(range(0, len(keys), self.page_size)):
+            if page == self.fail_listing_after:
+                raise ConnectionError("listing failed")
+            yield {"Contents": [{"Key": key, "ETag": self.etag(self.objects[key])}
+                                for key in keys[start:start + self.page_size]]}
+
+    def get_object(self, Bucket, Key):
+        self.downloads.append(Key)
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        return {"ETag": self.etag(Body)}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.uploads[Key] = {}
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        assert ContentMD5 == base64.b64encode(hashlib.md5(Body).digest()).decode()
+        if PartNumber == self.fail_part:
+            raise ConnectionError(f"part {PartNumber} failed")
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        self.uploads[UploadId][PartNumber] = Body
+        with self._lock:
+            self.in_flight -= 1
+        return {"ETag": self.etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == sorted(parts)
+        return self.put_object(Bucket, Key, b"".join(parts[number] for number in sorted(parts)))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(Key)
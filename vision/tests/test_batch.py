@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest import mock
+
+import cv2
+import httpx
+import numpy as np
+
+import batch
+from batch import BatchProcessor
+from ledger import Ledger
+from tests.stubs import StubS3
+
+def png(green):
+    image = np.zeros((8, 8, 3), np.uint8)
+    image[:green, :, 1] = 255
+    return cv2.imencode(".png", image)[1].tobytes()
+
+def segment(image):
+    return image[:, :, 1] > 128
+
+def collect(results):
+    async def consume():
+        return [result async for result in results]
+    return asyncio.run(asyncio.wait_for(consume(), 10))
+
+class BatchProcessorTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.executor.shutdown)
+        self.s3 = StubS3({f"img/{i}.png": png(i) for i in range(5)}, page_size=2)
+        self.posted = []
+
+    def processor(self, **kwargs):
+        return BatchProcessor(self.s3, "bucket", segment, self.executor, download_concurrency=2, **kwargs)
+
+    def backend(self, status=200):
+        def handle(request):
+            self.posted.append(json.loads(request.content))
+            return httpx.Response(status)
+        client = partial(httpx.AsyncClient, transport=httpx.MockTransport(handle))
+        return mock.patch.object(batch.httpx, "AsyncClient", client)
+
+    def test_processes_every_object(self):
+        results = collect(self.processor().run())
+
+        summary = results.pop()["summary"]
+        self.assertEqual(sorted(result["filename"] for result in results), sorted(self.s3.objects))
+        self.assertEqual({result["filename"]: result["green_pixels"] for result in results},
+                         {f"img/{i}.png": i * 8 for i in range(5)})
+        self.assertEqual((summary["listed"], summary["processed"], summary["failed"]), (5, 5, 0))
+
+    def test_only_green_inside_the_mask_counts(self):
+        image = np.zeros((8, 8, 3), np.uint8)
+        image[:, :2, 1] = 255  # green
+        image[:, 2:4, 2] = 255  # red
+        self.s3.objects = {"mixed.png": cv2.imencode(".png", image)[1].tobytes()}
+        processor = BatchProcessor(self.s3, "bucket", lambda image: image.max(axis=2) > 0, self.executor)
+
+        result = collect(processor.run())[0]
+
+        self.assertEqual((result["mask_pixels"], result["green_pixels"]), (32, 16))
+        self.assertEqual(result["coverage"], 0.25)
+
+    def test_bad_object_is_reported_and_skipped(self):
+        self.s3.objects["img/9.png"] = b"not an image"
+
+        results = collect(self.processor().run())
+
+        errors = [result for result in results if "error" in result]
+        self.assertEqual([error["filename"] for error in errors], ["img/9.png"])
+        self.assertEqual(results[-1]["summary"]["failed"], 1)
+
+    def test_results_are_posted_in_batches(self):
+        with self.backend():
+            collect(self.processor(backend_url="http://backend/results", post_batch_size=2).run())
+
+        self.assertEqual(sorted(len(body) if isinstance(body, list) else 1 for body in self.posted), [1, 2, 2])
+
+    def test_post_errors_are_counted(self):
+        with self.backend(500):
+            results = collect(self.processor(backend_url="http://backend/results", post_batch_size=2).run())
+
+        self.assertEqual(results[-1]["summary"]["post_errors"], 5)
+        self.assertEqual(results[-1]["summary"]["posted"], 0)
+
+    def test_listing_error_is_raised(self):
+        self.s3.fail_listing_after = 1
+        seen = []
+
+        async def consume():
+            async for result in self.processor().run():
+                seen.append(result)
+
+        with self.assertRaisesRegex(ConnectionError, "listing failed"):
+            asyncio.run(asyncio.wait_for(consume(), 10))
+
+        # the first page was still processed
+        self.assertEqual(sorted(result["filename"] for result in seen), ["img/0.png", "img/1.png"])
+
+    def test_ledger_skips_processed_objects(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger = Ledger(os.path.join(tmp, "ledger.sqlite3"))
+            self.addCleanup(ledger.close)
+
+            collect(self.processor(ledger=ledger).run())
+            self.s3.objects["img/0.png"] = png(7)
+            self.s3.downloads.clear()
+            results = collect(self.processor(ledger=ledger).run())
+
+            self.assertEqual(self.s3.downloads, ["img/0.png"])
+            self.assertEqual(results[-1]["summary"]["skipped"], 4)
+            self.assertEqual(ledger.get("img/0.png")["green_pixels"], 56)
+
+            results = collect(self.processor(ledger=ledger).run(force=True))
+            self.assertEqual(results[-1]["summary"]["processed"], 5)
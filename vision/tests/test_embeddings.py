@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+import embeddings
+from embeddings import EmbeddingCache
+from tests.stub_predictor import StubPredictor
+
+def frame(value, height=24, width=32):
+    return np.full((height, width, 3), value, np.uint8)
+
+class EmbeddingCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.predictor = StubPredictor()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spill_dir.cleanup)
+
+    def test_hit_skips_the_encoder(self):
+        cache = EmbeddingCache(self.predictor)
+
+        first = cache.set_image(frame(1))
+        second = cache.set_image(frame(1))
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.predictor.encoder_calls, 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertTrue(self.predictor.is_image_set)
+
+    def test_segment_returns_a_mask_per_box(self):
+        cache = EmbeddingCache(self.predictor)
+
+        masks = cache.segment(frame(1), [[0, 0, 8, 8], [10, 4, 20, 12]])
+
+        self.assertEqual(masks.shape, (2, 24, 32))
+        self.assertEqual(int(masks[0].sum()), 64)
+        self.assertEqual(int(masks[1].sum()), 80)
+
+    def test_spill_hit_is_memory_mapped(self):
+        cache = EmbeddingCache(self.predictor, max_items=1, spill_dir=self.spill_dir.name)
+        cache.set_image(frame(1))
+        features = np.array(self.predictor.features)
+        cache.set_image(frame(2))
+
+        with mock.patch.object(embeddings.torch, "from_numpy", wraps=torch.from_numpy) as from_numpy:
+            cache.set_image(frame(1))
+
+        self.assertIsInstance(from_numpy.call_args[0][0], np.memmap)
+        np.testing.assert_array_equal(np.asarray(self.predictor.features), features)
+        self.assertEqual(self.predictor.encoder_calls, 2)
+        self.assertEqual(cache.stats()["spill_hits"], 1)
+
+    def test_spilled_embeddings_outlive_the_cache(self):
+        cache = EmbeddingCache(self.predictor, max_items=1, spill_dir=self.spill_dir.name)
+        cache.set_image(frame(1))
+        cache.set_image(frame(2))
+
+        reopened = EmbeddingCache(self.predictor, max_items=1, spill_dir=self.spill_dir.name)
+        reopened.set_image(frame(1))
+
+        self.assertEqual(reopened.stats()["spill_hits"], 1)
+        self.assertEqual(self.predictor.original_size, (24, 32))
+
+    def test_oldest_spill_files_are_removed(self):
+        cache = EmbeddingCache(self.predictor, max_items=1, spill_dir=self.spill_dir.name, max_spill=2)
+
+        for value in range(5):
+            cache.set_image(frame(value))
+
+        self.assertEqual(len(os.listdir(self.spill_dir.name)), 2)
+        self.assertEqual(cache.stats()["spilled"], 2)
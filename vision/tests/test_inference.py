@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+import inference
+from inference import (FRAME_MEMORY, MAX_BATCH_SIZE, auto_batch_size, available_memory, cgroup_memory_available,
+                       read_batches, read_frames, segment_batch)
+from tests.stub_predictor import StubPredictor
+
+class StubCapture:
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    def read(self):
+        if not self.frames:
+            return False, None
+        return True, self.frames.pop(0)
+
+def frames(count, height=32, width=48):
+    return [np.full((height, width, 3), i, np.uint8) for i in range(count)]
+
+class ReadFramesTests(unittest.TestCase):
+    def test_reads_up_to_count(self):
+        cap = StubCapture(frames(5))
+
+        self.assertEqual(len(read_frames(cap, 3)), 3)
+        self.assertEqual(len(read_frames(cap, 3)), 2)
+        self.assertEqual(read_frames(cap, 3), [])
+
+    def test_batches_keep_order(self):
+        batches = list(read_batches(StubCapture(frames(7)), 3))
+
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual([int(frame[0, 0, 0]) for batch in batches for frame in batch], list(range(7)))
+
+class AutoBatchSizeTests(unittest.TestCase):
+    def batch_size(self, free):
+        with mock.patch.object(inference, "available_memory", return_value=free):
+            return auto_batch_size(StubPredictor(), "vit_h")
+
+    def test_fits_half_the_free_memory(self):
+        self.assertEqual(self.batch_size(10 * FRAME_MEMORY["vit_h"]), 5)
+
+    def test_at_least_one(self):
+        self.assertEqual(self.batch_size(0), 1)
+
+    def test_capped(self):
+        self.assertEqual(self.batch_size(1000 * FRAME_MEMORY["vit_h"]), MAX_BATCH_SIZE)
+
+class AvailableMemoryTests(unittest.TestCase):
+    def cgroup(self, files):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, text in files.items():
+            path = os.path.join(tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text + "\n")
+        return tmp.name
+
+    def test_cgroup_v2(self):
+        root = self.cgroup({"memory.max": str(8 * 2**30), "memory.current": str(3 * 2**30)})
+
+        self.assertEqual(cgroup_memory_available(root), 5 * 2**30)
+
+    def test_cgroup_v1(self):
+        root = self.cgroup({"memory/memory.limit_in_bytes": "4096", "memory/memory.usage_in_bytes": "5000"})
+
+        self.assertEqual(cgroup_memory_available(root), 0)
+
+    def test_no_limit(self):
+        self.assertIsNone(cgroup_memory_available(self.cgroup({"memory.max": "max", "memory.current": "1"})))
+        self.assertIsNone(cgroup_memory_available(self.cgroup({})))
+
+    def test_cpu_takes_the_smaller_of_host_and_cgroup(self):
+        # 2**15 pages of 2**15 bytes free on the host
+        with mock.patch.object(inference.os, "sysconf", return_value=2**15):
+            for allowed, expected in [(2**20, 2**20), (2**40, 2**30), (None, 2**30)]:
+                with mock.patch.object(inference, "cgroup_memory_available", return_value=allowed):
+                    self.assertEqual(available_memory(SimpleNamespace(type="cpu")), expected)
+
+class SegmentBatchTests(unittest.TestCase):
+    def test_one_encoder_pass_per_batch(self):
+        predictor = StubPredictor()
+
+        masks = segment_batch(predictor, frames(3), (4, 2, 20, 10))
+
+        self.assertEqual(predictor.encoder_calls, 1)
+        self.assertEqual(predictor.encoded, 3)
+        self.assertFalse(predictor.is_image_set)
+
+        expected = np.zeros((32, 48), bool)
+        expected[2:10, 4:20] = True
+
+        for mask in masks:
+            np.testing.assert_array_equal(mask, expected)
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from jobs import MAX_ATTEMPTS, Jobs
+from ledger import Ledger
+
+class LedgerTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.ledger = Ledger(os.path.join(tmp.name, "ledger.sqlite3"))
+        self.addCleanup(self.ledger.close)
+
+    def test_current_while_the_etag_matches(self):
+        self.ledger.record([{"filename": "a.png", "etag": '"1"', "green_pixels": 3}])
+
+        self.assertTrue(self.ledger.is_current("a.png", '"1"'))
+        self.assertFalse(self.ledger.is_current("a.png", '"2"'))
+        self.assertFalse(self.ledger.is_current("a.png", None))
+        self.assertFalse(self.ledger.is_current("b.png", '"1"'))
+        self.assertEqual(self.ledger.get("a.png")["green_pixels"], 3)
+
+    def test_forget(self):
+        self.ledger.record([{"filename": name, "etag": '"1"'} for name in ("a.png", "b.png", "c.png")])
+
+        self.ledger.forget("a.png")
+        self.assertEqual(self.ledger.count(), 2)
+        self.assertIsNone(self.ledger.get("a.png"))
+
+        self.ledger.forget()
+        self.assertEqual(self.ledger.count(), 0)
+
+class JobsTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "ledger.sqlite3")
+        self.release = None
+        self.ran = []
+
+    async def run_job(self, params, summary):
+        self.ran.append(params)
+        summary["processed"] = 0
+        for i in range(params.get("count", 3)):
+            if params.get("block"):
+                await self.release.wait()
+            if i == params.get("fail_at"):
+                raise ConnectionError("listing failed")
+            summary["processed"] += 1
+            yield {"filename": f"{i}.png", "error": "not an image"} if i == params.get("bad") else {"filename": f"{i}.png"}
+
+    def jobs(self):
+        return Jobs(self.path, self.run_job, progress_interval=0.05, poll_interval=0.05, stale_after=0.5)
+
+    async def until(self, jobs, job_id, *statuses):
+        async def poll():
+            while (job := await jobs.get(job_id))["status"] not in statuses:
+                await asyncio.sleep(0.02)
+            return job
+        return await asyncio.wait_for(poll(), 5)
+
+    def run_async(self, main):
+        asyncio.run(asyncio.wait_for(main(), 10))
+
+    def insert(self, status, heartbeat, attempts, params=None):
+        db = sqlite3.connect(self.path)
+        db.execute("INSERT INTO jobs (id, status, params, progress, errors, created, owner, heartbeat, attempts) "
+                   "VALUES (?, ?, ?, '{}', '[]', ?, 'gone:1', ?, ?)",
+                   ("orphan", status, json.dumps(params or {}), time.time(), heartbeat, attempts))
+        db.commit()
+        db.close()
+
+    def create_table(self):
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            await jobs.stop()
+        self.run_async(main)
+
+    def test_job_runs_to_completion(self):
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            job_id = await jobs.submit({"prefix": "img/", "bad": 1})
+            job = await self.until(jobs, job_id, "done")
+            listed = await jobs.list()
+            await jobs.stop()
+
+            self.assertEqual(job["progress"], {"processed": 3})
+            self.assertEqual([error["filename"] for error in job["errors"]], ["1.png"])
+            self.assertEqual(job["params"]["prefix"], "img/")
+            self.assertEqual(job["attempts"], 1)
+            self.assertEqual([j["id"] for j in listed], [job_id])
+        self.run_async(main)
+
+    def test_failed_job_keeps_its_error(self):
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            job = await self.until(jobs, await jobs.submit({"fail_at": 2}), "failed")
+            await jobs.stop()
+            self.assertEqual(job["error"], "listing failed")
+            self.assertEqual(job["progress"], {"processed": 2})
+        self.run_async(main)
+
+    def test_cancel_queued_job(self):
+        async def main():
+            self.release = asyncio.Event()
+            jobs = self.jobs()
+            await jobs.start()
+            first = await jobs.submit({"block": True})
+            await self.until(jobs, first, "running")
+            second = await jobs.submit({"count": 1})
+
+            self.assertEqual((await jobs.cancel(second))["status"], "cancelled")
+            self.assertEqual((await jobs.cancel(first))["cancel_requested"], True)
+            await self.until(jobs, first, "cancelled")
+            await jobs.stop()
+        self.run_async(main)
+
+        self.assertEqual(self.ran, [{"block": True}])
+
+    def test_cancel_from_another_worker(self):
+        async def main():
+            self.release = asyncio.Event()
+            runner, other = self.jobs(), self.jobs()
+            await runner.start()
+            job_id = await runner.submit({"block": True})
+            await self.until(runner, job_id, "running")
+            await other.start()
+
+            await other.cancel(job_id)
+            job = await self.until(runner, job_id, "cancelled")
+            await other.stop()
+            await runner.stop()
+            self.assertEqual(job["worker"], runner.owner)
+        self.run_async(main)
+
+    def test_submitted_on_one_worker_run_by_another(self):
+        async def main():
+            submitter, runner = self.jobs(), self.jobs()
+            await submitter.start()
+            submitter._worker.cancel()  # a worker busy with something else
+            await runner.start()
+
+            job = await self.until(runner, await submitter.submit({}), "done")
+            await runner.stop()
+            await submitter.stop()
+            self.assertEqual(job["worker"], runner.owner)
+        self.run_async(main)
+
+    def test_stopped_worker_hands_its_job_back(self):
+        async def main():
+            self.release = asyncio.Event()
+            first = self.jobs()
+            await first.start()
+            job_id = await first.submit({"block": True})
+            await self.until(first, job_id, "running")
+            await first.stop()
+
+            second = self.jobs()
+            await second.start()
+            self.assertEqual((await second.get(job_id))["attempts"], 0)
+            self.release.set()
+            job = await self.until(second, job_id, "done")
+            await second.stop()
+            self.assertEqual(job["attempts"], 1)
+        self.run_async(main)
+
+        self.assertEqual(len(self.ran), 2)
+
+    def test_orphaned_job_is_run_again(self):
+        self.create_table()
+        self.insert("running", time.time() - 60, 1)
+
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            job = await self.until(jobs, "orphan", "done")
+            await jobs.stop()
+            self.assertEqual(job["attempts"], 2)
+            self.assertEqual(job["worker"], jobs.owner)
+        self.run_async(main)
+
+    def test_orphan_fails_after_max_attempts(self):
+        self.create_table()
+        self.insert("running", time.time() - 60, MAX_ATTEMPTS)
+
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            job = await self.until(jobs, "orphan", "failed")
+            await jobs.stop()
+            self.assertEqual(job["error"], "interrupted")
+        self.run_async(main)
+
+        self.assertEqual(self.ran, [])
+
+    def test_live_job_of_another_worker_is_left_alone(self):
+        self.create_table()
+        self.insert("running", time.time() + 60, 1)
+
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            await asyncio.sleep(0.3)
+            job = await jobs.get("orphan")
+            await jobs.stop()
+            self.assertEqual(job["status"], "running")
+        self.run_async(main)
+
+        self.assertEqual(self.ran, [])
+
+    def test_jobs_from_before_claiming_are_run(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT, params TEXT, progress TEXT, errors TEXT, "
+                   "error TEXT, cancel INTEGER DEFAULT 0, created REAL, started REAL, finished REAL)")
+        db.execute("INSERT INTO jobs (id, status, params, progress, errors, created) VALUES "
+                   "('old', 'running', '{}', '{}', '[]', 0)")
+        db.commit()
+        db.close()
+
+        async def main():
+            jobs = self.jobs()
+            await jobs.start()
+            await self.until(jobs, "old", "done")
+            await jobs.stop()
+        self.run_async(main)
@@ -0,0 +1,57 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from loader import ModelLoader
+
+class ModelLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def load(self):
+        self.calls += 1
+        return "model"
+
+    def test_loads_once(self):
+        loader = ModelLoader(self.load)
+
+        self.assertEqual(loader.status(), {"state": "idle"})
+        self.assertEqual(loader.load(), "model")
+        self.assertEqual(loader.load(), "model")
+
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(loader.ready)
+        self.assertEqual(loader.status()["state"], "ready")
+
+    def test_loads_in_the_background(self):
+        release = threading.Event()
+
+        def load():
+            release.wait(5)
+            return self.load()
+
+        loader = ModelLoader(load)
+        with ThreadPoolExecutor(1) as executor:
+            future = loader.start(executor)
+            self.assertIs(loader.start(executor), future)
+            self.assertFalse(loader.ready)
+            self.assertEqual(loader.status()["state"], "loading")
+
+            release.set()
+            self.assertEqual(future.result(5), "model")
+
+        self.assertEqual(loader.load(), "model")
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(loader.ready)
+
+    def test_failure_is_reported(self):
+        def load():
+            raise FileNotFoundError("models/sam_vit_h.pth")
+
+        loader = ModelLoader(load)
+
+        with self.assertRaises(FileNotFoundError):
+            loader.load()
+
+        self.assertFalse(loader.ready)
+        self.assertEqual(loader.status(), {"state": "failed", "error": "models/sam_vit_h.pth"})
@@ -0,0 +1,56 @@
+import threading
+import time
+import unittest
+
+from pipeline import run_pipeline
+
+class RunPipelineTests(unittest.TestCase):
+    def test_stages_see_every_item_in_order(self):
+        seen = []
+
+        wall, stats = run_pipeline([[1, 2], [3], [4, 5, 6]], [("double", lambda item: [x * 2 for x in item]),
+                                                              ("collect", seen.extend)])
+
+        self.assertEqual(seen, [2, 4, 6, 8, 10, 12])
+        self.assertEqual([stat.name for stat in stats], ["decode", "double", "collect"])
+        self.assertEqual([(stat.items, stat.frames) for stat in stats], [(3, 6)] * 3)
+        self.assertGreaterEqual(wall, 0)
+
+    def test_queues_bound_how_far_the_source_runs_ahead(self):
+        produced, release = [], threading.Event()
+
+        def source():
+            for i in range(20):
+                produced.append(i)
+                yield [i]
+
+        def slow(item):
+            release.wait()
+
+        thread = threading.Thread(target=run_pipeline, args=(source(), [("slow", slow)]), kwargs={"depth": 2})
+        thread.start()
+        time.sleep(0.3)
+        ahead = len(produced)
+        release.set()
+        thread.join(5)
+
+        # one item in the stage, `depth` in its queue and one waiting to be put
+        self.assertLessEqual(ahead, 4)
+        self.assertEqual(len(produced), 20)
+
+    def test_stage_error_stops_the_pipeline_and_is_raised(self):
+        def fail(item):
+            if item == [3]:
+                raise ValueError("bad frame")
+            return item
+
+        with self.assertRaisesRegex(ValueError, "bad frame"):
+            run_pipeline(([i] for i in range(1000)), [("fail", fail), ("sink", lambda item: None)])
+
+    def test_source_error_is_raised(self):
+        def source():
+            yield [1]
+            raise IOError("decode failed")
+
+        with self.assertRaisesRegex(IOError, "decode failed"):
+            run_pipeline(source(), [("sink", lambda item: None)])
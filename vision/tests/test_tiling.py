@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from tests.stub_predictor import StubPredictor
+from tiling import blend_weights, green_stats, is_green, segment_tiled, window_prompts, window_starts
+
+class WindowTests(unittest.TestCase):
+    def test_starts_cover_the_length(self):
+        self.assertEqual(window_starts(100, 128, 32), [0])
+        self.assertEqual(window_starts(128, 128, 32), [0])
+        self.assertEqual(window_starts(300, 128, 32), [0, 96, 172])
+
+    def test_weights_feather_towards_the_edges(self):
+        weights = blend_weights(64, 96, 8)
+
+        self.assertEqual(weights.shape, (64, 96))
+        self.assertEqual(weights[32, 48], 1)
+        self.assertAlmostEqual(float(weights[0, 48]), 1 / 9, places=6)
+        self.assertGreater(weights.min(), 0)
+        np.testing.assert_allclose(weights, weights[::-1, ::-1])
+
+    def test_prompts_are_clipped_to_the_window(self):
+        boxes = [[10, 10, 50, 50], [200, 200, 220, 220]]
+
+        self.assertEqual(window_prompts(boxes, 0, 32, 64, 64), [[0, 10, 18, 50]])
+        self.assertEqual(window_prompts(boxes, 100, 100, 64, 64), [])
+        self.assertEqual(window_prompts(None, 0, 0, 64, 96), [[0, 0, 96, 64]])
+
+class GreenTests(unittest.TestCase):
+    def test_is_green(self):
+        # BGR
+        pixels = np.array([[[0, 200, 0], [0, 0, 200], [200, 0, 0], [100, 100, 100], [95, 90, 200], [250, 255, 250]]],
+                          np.uint8)
+
+        self.assertEqual(is_green(pixels).tolist(), [[True, False, False, True, False, True]])
+
+    def test_stats(self):
+        stats = green_stats(250, 400, 1000, gsd=0.1)
+
+        self.assertEqual(stats["mask_fraction"], 0.4)
+        self.assertEqual(stats["green_fraction"], 0.25)
+        self.assertEqual(stats["green_m2"], 2.5)
+        self.assertEqual(stats["green_ha"], 0.0003)
+        self.assertNotIn("green_m2", green_stats(0, 0, 0))
+
+class SegmentTiledTests(unittest.TestCase):
+    def setUp(self):
+        self.predictor = StubPredictor()
+        self.image = np.zeros((300, 500, 3), np.uint8)
+        self.image[:, :250, 1] = 200  # green left half
+        self.image[:, 250:, 2] = 200  # red right half
+
+    def test_mask_matches_the_boxes_across_windows(self):
+        boxes = [[20, 30, 260, 200], [400, 250, 480, 290]]
+
+        mask, stats = segment_tiled(self.predictor, self.image, boxes, tile=128, overlap=32, batch_size=4)
+
+        expected = np.zeros((300, 500), bool)
+        for x0, y0, x1, y1 in boxes:
+            expected[y0:y1, x0:x1] = True
+        np.testing.assert_array_equal(mask, expected)
+
+        self.assertEqual(stats["windows"], 3 * 5)
+        self.assertEqual(stats["encoded"], self.predictor.encoded)
+        self.assertLess(stats["encoded"], stats["windows"])  # windows no box reaches are skipped
+        self.assertEqual(stats["mask_pixels"], int(expected.sum()))
+        self.assertEqual(stats["green_pixels"], 170 * 230)
+        self.assertFalse(self.predictor.is_image_set)
+
+    def test_whole_image_without_boxes(self):
+        mask, stats = segment_tiled(self.predictor, self.image, tile=128, overlap=32, batch_size=2, gsd=0.5)
+
+        self.assertTrue(mask.all())
+        self.assertEqual(stats["encoded"], 15)
+        self.assertEqual(self.predictor.encoder_calls, 3 * 3)  # five windows per strip, two at a time
+        self.assertEqual(stats["green_fraction"], 0.5)
+        self.assertEqual(stats["green_m2"], 300 * 250 * 0.25)
+
+    def test_writes_into_a_memory_map(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mask.npy")
+            out = np.lib.format.open_memmap(path, "w+", bool, (300, 500))
+
+            mask, _ = segment_tiled(self.predictor, self.image, [[0, 0, 100, 100]], tile=128, overlap=32,
+                                    batch_size=4, out=out)
+            out.flush()
+
+            self.assertIs(mask, out)
+            self.assertEqual(int(np.load(path).sum()), 100 * 100)
+            del mask, out
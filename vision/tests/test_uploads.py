@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import io
+import threading
+import unittest
+from unittest import mock
+
+import uploads
+from uploads import MIN_PART_SIZE, ChecksumMismatch, StreamReader, upload_stream
+from tests.stubs import StubS3
+
+sha256 = hashlib.sha256
+
+class RecordingSha256:
+    # hashlib.sha256 that remembers which threads fed it
+    def __init__(self, threads):
+        self._digest = sha256()
+        self._threads = threads
+
+    def update(self, data):
+        self._threads.append(threading.current_thread())
+        self._digest.update(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+class UploadStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.s3 = StubS3()
+
+    def upload(self, data, **kwargs):
+        stream = io.BytesIO(data)
+
+        async def read(size):
+            return stream.read(size)
+
+        async def main():
+            return await upload_stream(self.s3, "bucket", "big.tif", read, **kwargs)
+        return asyncio.run(asyncio.wait_for(main(), 30))
+
+    def test_small_file_is_one_put(self):
+        report = self.upload(b"tiny")
+
+        self.assertEqual(self.s3.objects["big.tif"], b"tiny")
+        self.assertEqual(report["parts"], 1)
+        self.assertEqual(report["sha256"], hashlib.sha256(b"tiny").hexdigest())
+
+    def test_large_file_goes_up_in_parts(self):
+        data = bytes(range(256)) * (MIN_PART_SIZE * 5 // 2 // 256)
+
+        report = self.upload(data, part_size=MIN_PART_SIZE, concurrency=2,
+                             expected_sha256=hashlib.sha256(data).hexdigest().upper())
+
+        self.assertEqual(self.s3.objects["big.tif"], data)
+        self.assertEqual((report["parts"], report["size"]), (3, len(data)))
+        self.assertLessEqual(self.s3.max_in_flight, 2)
+
+    def test_parts_are_at_least_the_s3_minimum(self):
+        report = self.upload(b"x" * (MIN_PART_SIZE + 1), part_size=1024)
+
+        self.assertEqual(report["parts"], 2)
+
+    def test_checksum_mismatch_aborts(self):
+        with self.assertRaises(ChecksumMismatch):
+            self.upload(b"x" * (MIN_PART_SIZE + 1), part_size=MIN_PART_SIZE, expected_sha256="00" * 32)
+
+        self.assertEqual(self.s3.aborted, ["big.tif"])
+        self.assertNotIn("big.tif", self.s3.objects)
+
+    def test_small_file_checksum_mismatch_leaves_nothing(self):
+        with self.assertRaises(ChecksumMismatch):
+            self.upload(b"tiny", expected_sha256="00" * 32)
+
+        self.assertNotIn("big.tif", self.s3.objects)
+
+    def test_failed_part_aborts(self):
+        self.s3.fail_part = 2
+
+        with self.assertRaisesRegex(ConnectionError, "part 2"):
+            self.upload(b"x" * (MIN_PART_SIZE * 3), part_size=MIN_PART_SIZE)
+
+        self.assertEqual(self.s3.aborted, ["big.tif"])
+        self.assertEqual(self.s3.uploads, {})
+
+    def test_hashing_stays_off_the_loop(self):
+        threads = []
+        content_md5 = uploads.content_md5
+
+        def recording_md5(data):
+            threads.append(threading.current_thread())
+            return content_md5(data)
+
+        with mock.patch.object(uploads.hashlib, "sha256", lambda: RecordingSha256(threads)), \
+                mock.patch.object(uploads, "content_md5", recording_md5):
+            self.upload(b"x" * (MIN_PART_SIZE * 2 + 1), part_size=MIN_PART_SIZE)
+
+        self.assertGreaterEqual(len(threads), 6)  # three parts, each hashed twice
+        self.assertNotIn(threading.main_thread(), threads)
+
+class StreamReaderTests(unittest.TestCase):
+    def test_reads_across_chunks(self):
+        async def chunks():
+            for chunk in (b"ab", b"", b"cde", b"f"):
+                yield chunk
+
+        async def main():
+            reader = StreamReader(chunks())
+            return [await reader.read(4), await reader.read(4), await reader.read(4)]
+
+        self.assertEqual(asyncio.run(main()), [b"abcd", b"ef", b""])
@@ -0,0 +1,26 @@
+import unittest
+from unittest import mock
+
+import variants
+from variants import checkpoint_path, load_sam, load_state_dict, quantized_path
+
+class VariantsTests(unittest.TestCase):
+    def test_unknown_model_type(self):
+        with self.assertRaisesRegex(ValueError, "vit_x"):
+            load_sam("vit_x")
+
+    def test_checkpoint_paths(self):
+        self.assertEqual(checkpoint_path("vit_b"), "models/sam_vit_b.pth")
+        self.assertEqual(quantized_path("vit_b"), "models/sam_vit_b_int8.pth")
+
+    def test_state_dict_is_memory_mapped(self):
+        with mock.patch.object(variants.torch, "load", return_value={"w": 1}) as load:
+            self.assertEqual(load_state_dict("sam.pth"), {"w": 1})
+
+        load.assert_called_once_with("sam.pth", map_location="cpu", mmap=True, weights_only=True)
+
+    def test_old_checkpoints_are_read_in_full(self):
+        with mock.patch.object(variants.torch, "load", side_effect=[RuntimeError("not a zip"), {"w": 1}]) as load:
+            self.assertEqual(load_state_dict("sam.pth"), {"w": 1})
+
+        self.assertEqual(load.call_args, mock.call("sam.pth", map_location="cpu", weights_only=True))
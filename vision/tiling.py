@@ -0,0 +1,129 @@
+import argparse
+import json
+
+import cv2
+import numpy as np
+
+from greenness import green_stats, is_green
+from inference import auto_batch_size, encode_frames, segment_boxes, use_features
+
+# SAM's encoder input is 1024x1024; windows of that size reach it without any downscaling
+TILE_SIZE = 1024
+TILE_OVERLAP = 128
+
+def window_starts(length, tile, overlap):
+    # evenly strided, with the last window flush against the far edge
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile]
+
+def blend_weights(height, width, overlap):
+    # feathered towards every edge, so where windows overlap the one whose middle is nearer
+    # counts more and seams fade out; never zero, so an image edge only one window covers keeps its value
+    def ramp(n):
+        distance = np.minimum(np.arange(n), np.arange(n)[::-1]) + 1
+        return np.minimum(distance / (overlap + 1), 1).astype(np.float32)
+    return np.outer(ramp(height), ramp(width))
+
+def window_prompts(boxes, y0, x0, height, width):
+    # the whole window without boxes, otherwise the boxes (image coordinates) that reach into it, clipped
+    if boxes is None:
+        return [[0, 0, width, height]]
+    prompts = []
+    for bx0, by0, bx1, by1 in boxes:
+        box = [max(bx0 - x0, 0), max(by0 - y0, 0), min(bx1 - x0, width), min(by1 - y0, height)]
+        if box[2] > box[0] and box[3] > box[1]:
+            prompts.append(box)
+    return prompts
+
+def segment_tiled(predictor, image, boxes=None, tile=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=None, out=None,
+                  gsd=None, model_type="vit_h"):
+    """Segment a BGR `image` of any size in overlapping `tile` windows; returns (mask, stats).
+
+    Windows are encoded `batch_size` at a time (by default as many as fit
+    in half the free memory) and their mask probabilities are blended with
+    feathered weights, so seams don't show. Work goes one strip of windows
+    at a time and rows are written to `out` as soon as no later window
+    covers them, so besides `image` and `out` memory stays at about two
+    float rows of `tile` x width. For orthomosaics larger than memory, pass
+    both as memory-mapped arrays (np.load(mmap_mode="r") and
+    np.lib.format.open_memmap). The stats count the mask and, within it,
+    the pixels is_green takes for vegetation.
+    """
+    height, width = image.shape[:2]
+    tile_h, tile_w = min(tile, height), min(tile, width)
+    ys, xs = window_starts(height, tile, overlap), window_starts(width, tile, overlap)
+    weights = blend_weights(tile_h, tile_w, overlap)
+    batch_size = batch_size or auto_batch_size(predictor, model_type)
+    if out is None:
+        out = np.zeros((height, width), bool)
+
+    # weighted probability and weight sums for the rows the current strip covers, from image row `top`
+    acc = np.zeros((tile_h, width), np.float32)
+    total = np.zeros((tile_h, width), np.float32)
+    top, masked, green = 0, 0, 0
+
+    def flush(rows):
+        nonlocal top, masked, green
+        final = acc[:rows] > 0.5 * total[:rows]
+        out[top:top + rows] = final
+        masked += int(np.count_nonzero(final))
+        green += int(np.count_nonzero(final & is_green(image[top:top + rows])))
+        acc[:-rows], total[:-rows] = acc[rows:], total[rows:]
+        acc[-rows:], total[-rows:] = 0, 0
+        top += rows
+
+    encoded = 0
+    for y0 in ys:
+        if y0 > top:
+            flush(y0 - top)
+        windows = [(x0, window_prompts(boxes, y0, x0, tile_h, tile_w)) for x0 in xs]
+        for x0, _ in windows:
+            total[:, x0:x0 + tile_w] += weights
+        # windows without a prompt stay at probability 0 and aren't encoded at all
+        windows = [(x0, prompts) for x0, prompts in windows if prompts]
+        for start in range(0, len(windows), batch_size):
+            batch = windows[start:start + batch_size]
+            crops = [np.ascontiguousarray(image[y0:y0 + tile_h, x0:x0 + tile_w]) for x0, _ in batch]
+            features, input_size = encode_frames(predictor, crops)
+            for i, (x0, prompts) in enumerate(batch):
+                use_features(predictor, features[i:i + 1], (tile_h, tile_w), input_size)
+                logits = segment_boxes(predictor, prompts, logits=True).max(axis=0)
+                acc[:, x0:x0 + tile_w] += weights * (0.5 + 0.5 * np.tanh(logits / 2))  # sigmoid, without overflow
+            encoded += len(batch)
+    flush(height - top)
+    predictor.reset_image()
+
+    stats = green_stats(green, masked, height * width, gsd)
+    stats.update({"windows": len(ys) * len(xs), "encoded": encoded, "tile": tile, "overlap": overlap,
+                  "batch_size": batch_size})
+    return out, stats
+
+if __name__ == "__main__":
+    from variants import load_predictor
+
+    parser = argparse.ArgumentParser(description="Tiled SAM segmentation of a large image or orthomosaic.")
+    parser.add_argument("image", help="an image file, or a BGR .npy array (memory-mapped, for very large mosaics)")
+    parser.add_argument("output", help="mask as .png, or .npy (written through a memory map)")
+    parser.add_argument("--boxes", help="JSON list of [x0, y0, x1, y1] prompts; default: every window whole")
+    parser.add_argument("--tile", type=int, default=TILE_SIZE)
+    parser.add_argument("--overlap", type=int, default=TILE_OVERLAP)
+    parser.add_argument("--batch-size", type=int, help="windows per encoder pass (default: fit in free memory)")
+    parser.add_argument("--gsd", type=float, help="metres per pixel, for green area in m2 and ha")
+    parser.add_argument("--model-type", default="vit_h")
+    parser.add_argument("--int8", action="store_true", help="use the quantized encoder")
+    args = parser.parse_args()
+
+    image = np.load(args.image, mmap_mode="r") if args.image.endswith(".npy") else cv2.imread(args.image)
+    if image is None: raise SystemExit(f"cannot read {args.image}")
+    out = np.lib.format.open_memmap(args.output, "w+", bool, image.shape[:2]) if args.output.endswith(".npy") else None
+
+    predictor = load_predictor(args.model_type, args.int8)
+    mask, stats = segment_tiled(predictor, image, json.loads(args.boxes) if args.boxes else None, args.tile,
+                                args.overlap, args.batch_size, out, args.gsd, args.model_type)
+    if out is None:
+        cv2.imwrite(args.output, mask.astype(np.uint8) * 255)
+    else:
+        out.flush()
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,124 @@
+import asyncio
+import base64
+import hashlib
+import time
+from functools import partial
+
+MIN_PART_SIZE = 5 * 2**20  # S3's minimum for every part but the last
+
+class ChecksumMismatch(ValueError):
+    pass
+
+class StreamReader:
+    """`read(n)` over an async iterator of byte chunks, such as Request.stream()."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+        self._done = False
+
+    async def read(self, size):
+        while len(self._buffer) < size and not self._done:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+async def read_part(read, size):
+    # read(n) may return less than n before the end
+    chunks, got = [], 0
+    while got < size:
+        chunk = await read(size - got)
+        if not chunk: break
+        chunks.append(chunk)
+        got += len(chunk)
+    return b"".join(chunks)
+
+def content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+async def upload_stream(s3, bucket, key, read, part_size=8 * 2**20, concurrency=2, expected_sha256=None):
+    """Upload what `read(n)` returns to `bucket`/`key` without holding all of it.
+
+    Anything larger than one part goes up as a multipart upload. At most
+    `concurrency` parts are in flight while the next one is read, so memory
+    stays at a few times part_size whatever the size of the file.
+    Each part carries its MD5 for the server to check. The SHA-256 of the
+    whole stream is returned and, with `expected_sha256`, checked before
+    the upload is completed; a failed or mismatched upload is aborted and
+    leaves no object behind. Hashing, like the S3 calls, runs on the
+    default executor rather than the event loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    def call(fn, **kwargs):
+        return loop.run_in_executor(None, partial(fn, Bucket=bucket, Key=key, **kwargs))
+
+    def send_part(fn, data, **kwargs):
+        # the part's MD5 is taken on the executor thread along with the request
+        def send():
+            return fn(Bucket=bucket, Key=key, Body=data, ContentMD5=content_md5(data), **kwargs)
+        return loop.run_in_executor(None, send)
+
+    def hash_part(data):
+        # parts are hashed in order, one at a time, while earlier ones upload
+        return loop.run_in_executor(None, digest.update, data)
+
+    def check():
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            raise ChecksumMismatch(f"{key}: sha256 is {digest.hexdigest()}, expected {expected_sha256}")
+
+    part_size = max(part_size, MIN_PART_SIZE)
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    data = await read_part(read, part_size)
+    await hash_part(data)
+    size = len(data)
+
+    if size < part_size:
+        # it all fit in one part
+        check()
+        response = await send_part(s3.put_object, data)
+        return _report(key, size, digest, response["ETag"], 1, start)
+
+    upload_id = (await call(s3.create_multipart_upload))["UploadId"]
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+
+    async def send(number, data):
+        try:
+            response = await send_part(s3.upload_part, data, UploadId=upload_id, PartNumber=number)
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            semaphore.release()
+
+    try:
+        while data:
+            await semaphore.acquire()
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            tasks.append(asyncio.create_task(send(len(tasks) + 1, data)))
+            data = await read_part(read, part_size)
+            await hash_part(data)
+            size += len(data)
+
+        parts = await asyncio.gather(*tasks)
+        check()
+        response = await call(s3.complete_multipart_upload, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await call(s3.abort_multipart_upload, UploadId=upload_id)
+        raise
+
+    return _report(key, size, digest, response["ETag"], len(parts), start)
+
+def _report(key, size, digest, etag, parts, start):
+    seconds = time.perf_counter() - start
+    return {"key": key, "size": size, "sha256": digest.hexdigest(), "etag": etag, "parts": parts,
+            "seconds": round(seconds, 3), "mb_per_s": round(size / 2**20 / seconds, 2) if seconds else None}
@@ -0,0 +1,80 @@
+import os
+import torch
+from segment_anything import SamPredictor, sam_model_registry
+
+MODEL_DIR = "models"
+
+# Official SAM checkpoints, stored locally as models/sam_<type>.pth
+CHECKPOINT_URLS = {
+    "vit_b": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth",
+    "vit_l": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth",
+    "vit_h": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth",
+}
+
+# Sam's defaults for normalising input pixels
+SAM_PIXEL_MEAN = [123.675, 116.28, 103.53]
+SAM_PIXEL_STD = [58.395, 57.12, 57.375]
+
+def checkpoint_path(model_type):
+    return os.path.join(MODEL_DIR, f"sam_{model_type}.pth")
+
+def quantized_path(model_type):
+    return os.path.join(MODEL_DIR, f"sam_{model_type}_int8.pth")
+
+def download_checkpoint(model_type):
+    path = checkpoint_path(model_type)
+    if not os.path.exists(path):
+        os.makedirs(MODEL_DIR, exist_ok=True)
+        torch.hub.download_url_to_file(CHECKPOINT_URLS[model_type], path)
+    return path
+
+def quantize_encoder(sam):
+    # int8 weights for the encoder's Linear layers (attention qkv/proj and the MLPs, nearly all
+    # of its FLOPs); activations are quantized on the fly, so no calibration set is needed.
+    # The prompt encoder and mask decoder are small and stay float.
+    sam.image_encoder = torch.ao.quantization.quantize_dynamic(sam.image_encoder, {torch.nn.Linear},
+                                                              dtype=torch.qint8)
+    return sam
+
+def load_state_dict(path):
+    # mmap leaves the weights in the page cache instead of copying them into this process:
+    # loading is near instant and every process reading the same file shares one copy.
+    # Checkpoints in the old (non-zip) format can't be mapped and are read in full.
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+def load_mapped(model_type):
+    # built on the meta device, so no memory goes to random initial weights that are replaced
+    # anyway; assign=True makes the parameters the mapped tensors rather than copies of them
+    with torch.device("meta"):
+        sam = sam_model_registry[model_type](checkpoint=None)
+    sam.load_state_dict(load_state_dict(checkpoint_path(model_type)), assign=True)
+    # the normalisation constants are non-persistent buffers, not in the checkpoint
+    sam.register_buffer("pixel_mean", torch.tensor(SAM_PIXEL_MEAN).view(-1, 1, 1), False)
+    sam.register_buffer("pixel_std", torch.tensor(SAM_PIXEL_STD).view(-1, 1, 1), False)
+    return sam.eval()
+
+def load_sam(model_type="vit_h", quantize=False):
+    if model_type not in CHECKPOINT_URLS:
+        raise ValueError(f"unknown SAM model type {model_type!r}, expected one of {sorted(CHECKPOINT_URLS)}")
+    if not quantize:
+        return load_mapped(model_type)
+
+    # dynamic quantization runs on CPU only; converting vit_h takes a while, so the
+    # converted weights are cached next to the float checkpoint and reused
+    cached = quantized_path(model_type)
+    if os.path.exists(cached):
+        sam = quantize_encoder(sam_model_registry[model_type](checkpoint=None).eval())
+        sam.load_state_dict(torch.load(cached, map_location="cpu"))
+        return sam
+
+    sam = quantize_encoder(sam_model_registry[model_type](checkpoint=checkpoint_path(model_type)).eval())
+    tmp = cached + ".tmp"
+    torch.save(sam.state_dict(), tmp)
+    os.replace(tmp, cached)
+    return sam
+
+def load_predictor(model_type="vit_h", quantize=False):
+    return SamPredictor(load_sam(model_type, quantize))